@@ -0,0 +1,213 @@
+#!/usr/bin/env python2
+'''Benchmark delivery of a stream of messages to each type of destination.
+
+usage: bench_delivery.py [MESSAGES [CUR_COUNT]]
+
+Delivers a stream of MESSAGES (default 500) synthetic messages, of mixed sizes
+and envelope recipients, to each destination type in turn: a Maildir, a
+Maildir with CUR_COUNT (default 100000) messages already in cur/, a growing
+mboxrd file, MDA_external and MDA_qmaillocal running a trivial script which
+reads the message and exits, and MultiDestination, MultiSorter, and
+MultiGuesser delivering to Maildirs and mboxrd files.  Everything is created
+in a scratch directory, removed afterwards.
+
+For each, reports messages delivered per second, and the number of fork(),
+fsync() (or fdatasync()), and exec calls made per message, in getmail and in
+the child processes it forks, counted by wrapping those functions in the os
+module.
+
+getmail refuses to deliver as root, so run this as an ordinary user.
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from getmailcore.message import Message
+from getmailcore.destinations import Maildir, Mboxrd, MDA_external, \
+    MDA_qmaillocal, MultiDestination, MultiSorter, MultiGuesser
+import getmailcore.logging
+
+RECIPIENTS = (
+    'alice@example.org',
+    'bob@example.org',
+    'carol@example.org',
+)
+
+# Reads the message and exits, as quickly as a delivery program could
+MDA_SCRIPT = '#!/bin/sh\nexec cat >/dev/null\n'
+
+# One letter is written to the counter file for each call, from whichever
+# process makes it
+COUNTED = (
+    ('fork', 'F'),
+    ('fsync', 'S'),
+    ('fdatasync', 'S'),
+    ('execl', 'X'),
+)
+_counter_fd = None
+
+#######################################
+class BenchRetriever(object):
+    '''What destinations use of a retriever.'''
+    received_from = 'mail.example.org (192.0.2.1)'
+    received_with = 'POP3'
+    received_by = 'localhost'
+    mailbox_selected = False
+
+#######################################
+def count_calls():
+    def wrap(function, letter):
+        def counted(*args):
+            if _counter_fd is not None:
+                os.write(_counter_fd, letter)
+            return function(*args)
+        return counted
+    for (name, letter) in COUNTED:
+        function = getattr(os, name, None)
+        if function is not None:
+            setattr(os, name, wrap(function, letter))
+
+def make_stream(count):
+    rng = random.Random(45)
+    stream = []
+    for i in xrange(count):
+        recipient = RECIPIENTS[i % len(RECIPIENTS)]
+        if rng.random() < 0.05:
+            size = rng.randint(50000, 200000)
+        else:
+            size = rng.randint(1000, 8000)
+        lines = [
+            'Return-Path: <sender%d@example.com>' % (i % 7),
+            'Delivered-To: %s' % recipient,
+            'From: sender%d@example.com' % (i % 7),
+            'To: %s' % recipient,
+            'Subject: message %d' % i,
+            'Message-ID: <%d.%x@example.com>' % (i, rng.getrandbits(64)),
+            '',
+        ]
+        line = 'x' * 75
+        lines.extend([line] * (size // 77))
+        lines.append('')
+        stream.append(('\r\n'.join(lines), recipient))
+    return stream
+
+#######################################
+def make_maildir(path, cur_count=0):
+    for sub in ('tmp', 'cur', 'new'):
+        os.makedirs(os.path.join(path, sub))
+    cur = os.path.join(path, 'cur')
+    for i in xrange(cur_count):
+        open(os.path.join(cur, '%d.M0P0Q%d.bench:2,S' % (i, i)), 'wb').close()
+    return path + '/'
+
+def make_mbox(path):
+    open(path, 'wb').close()
+    return path
+
+def make_script(path):
+    f = open(path, 'wb')
+    f.write(MDA_SCRIPT)
+    f.close()
+    os.chmod(path, 0755)
+    return path
+
+def destinations(base, cur_count):
+    '''Return [(label, destination factory), ...].'''
+    def p(name):
+        return os.path.join(base, name)
+    def locals_(prefix):
+        return str(((r'^alice@', make_maildir(p(prefix + '-alice'))),
+                    (r'^bob@', make_mbox(p(prefix + '-bob.mbox')))))
+    return [
+        ('Maildir', lambda: Maildir(path=make_maildir(p('maildir')))),
+        ('Maildir cur/', lambda: Maildir(
+            path=make_maildir(p('bigcur'), cur_count)
+        )),
+        ('Mboxrd', lambda: Mboxrd(path=make_mbox(p('mbox')))),
+        ('MDA_external', lambda: MDA_external(
+            path=make_script(p('mda')), arguments="('%(recipient)', )"
+        )),
+        ('MDA_qmaillocal', lambda: MDA_qmaillocal(
+            qmaillocal=make_script(p('qmail-local')), homedir=base,
+            localdomain='example.org'
+        )),
+        ('MultiDestination', lambda: MultiDestination(
+            destinations=str((make_maildir(p('multi')),
+                              make_mbox(p('multi.mbox'))))
+        )),
+        ('MultiSorter', lambda: MultiSorter(
+            default=make_maildir(p('sorter')), locals=locals_('sorter')
+        )),
+        ('MultiGuesser', lambda: MultiGuesser(
+            default=make_maildir(p('guesser')), locals=locals_('guesser')
+        )),
+    ]
+
+#######################################
+def run(base, dest, stream):
+    '''Deliver stream to dest; return (seconds, {letter: count}).'''
+    global _counter_fd
+    dest.retriever_info(BenchRetriever())
+    msgs = []
+    for (raw, recipient) in stream:
+        msg = Message(fromstring=raw)
+        msg.recipient = recipient
+        msgs.append(msg)
+    counter = os.path.join(base, 'counter')
+    _counter_fd = os.open(counter, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0600)
+    try:
+        t = time.time()
+        for msg in msgs:
+            dest.deliver_message(msg)
+        elapsed = time.time() - t
+    finally:
+        os.close(_counter_fd)
+        _counter_fd = None
+    f = open(counter, 'rb')
+    letters = f.read()
+    f.close()
+    os.unlink(counter)
+    counts = {}
+    for (unused, letter) in COUNTED:
+        counts[letter] = letters.count(letter)
+    return (elapsed, counts)
+
+#######################################
+def main():
+    count = 500
+    cur_count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        cur_count = int(sys.argv[2])
+    if os.name == 'posix' and (os.geteuid() == 0 or os.getegid() == 0):
+        raise SystemExit('getmail refuses to deliver as root; '
+                         'run as an ordinary user')
+    # Destinations log every delivery
+    getmailcore.logging.Logger().addhandler(open(os.devnull, 'w'), 0)
+    count_calls()
+    stream = make_stream(count)
+    base = tempfile.mkdtemp(prefix='bench_delivery.')
+    try:
+        print '%-17s %9s %10s %9s %9s %9s' % (
+            'destination', 'messages', 'msgs/sec', 'forks', 'fsyncs', 'execs'
+        )
+        for (label, make) in destinations(base, cur_count):
+            (elapsed, counts) = run(base, make(), stream)
+            print '%-17s %9d %10.1f %9.2f %9.2f %9.2f' % (
+                label, count, count / elapsed, float(counts['F']) / count,
+                float(counts['S']) / count, float(counts['X']) / count
+            )
+    finally:
+        shutil.rmtree(base)
+
+if __name__ == '__main__':
+    main()
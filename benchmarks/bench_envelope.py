@@ -0,0 +1,169 @@
+#!/usr/bin/env python2
+'''Benchmark finding envelope recipients in messages with large headers.
+
+usage: bench_envelope.py [RECEIVED_COUNT ...]
+
+For messages with each RECEIVED_COUNT (default 10, 100, and 500) Received:
+header fields, times finding the envelope recipient as the multidrop POP3
+and IMAP retrievers do, and the addresses MultiGuesser matches, both the way
+getmail used to (building a dict of every header field, decoding every field
+for IMAP, and a search of the parsed header per field for MultiGuesser) and
+with Message.header_fields().  MultiGuesser is timed with a message with
+Delivered-To: fields, the first it looks for, and one without, when it looks
+for all of them.  Results are checked to be the same, and reported in
+microseconds per message.
+'''
+
+import os
+import sys
+import gc
+import time
+import email.Utils
+from email.Header import decode_header
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from getmailcore.message import Message
+from getmailcore.destinations import GUESSER_FIELDNAMES, GUESSER_FIELDS
+
+ENVELOPE_FIELD = 'delivered-to'
+ENVELOPE_NUMBER = 1
+MESSAGES = 200
+
+#######################################
+def make_message(received_count):
+    lines = ['Return-Path: <sender@example.com>',
+             'Delivered-To: postmaster@example.org',
+             'Delivered-To: user@example.org']
+    for i in range(received_count):
+        lines.extend([
+            'Received: from relay%d.example.net (relay%d.example.net '
+            '[192.0.2.%d])' % (i, i, i % 254 + 1),
+            '\tby mx%d.example.org (Postfix) with ESMTPS id %08X' % (i, i),
+            '\tfor <user@example.org>; Mon, 3 Oct 2011 12:00:00 +0000',
+        ])
+    lines.extend([
+        'From: =?utf-8?q?S=C3=A9nder?= <sender@example.com>',
+        'To: user@example.org, other@example.org',
+        'Cc: third@example.org',
+        'Subject: many hops',
+        '',
+        'body',
+        '',
+    ])
+    return '\r\n'.join(lines)
+
+#######################################
+def pop_before(msg):
+    data = {}
+    for (name, val) in msg.headers():
+        name = name.lower()
+        val = val.strip()
+        if name in data:
+            data[name].append(val)
+        else:
+            data[name] = [val]
+    return data[ENVELOPE_FIELD][ENVELOPE_NUMBER]
+
+def pop_after(msg):
+    return msg.header_fields((ENVELOPE_FIELD, ))[ENVELOPE_FIELD][
+        ENVELOPE_NUMBER
+    ]
+
+def imap_before(msg):
+    data = {}
+    for (name, encoded_value) in msg.headers():
+        name = name.lower()
+        for (val, encoding) in decode_header(encoded_value):
+            val = val.strip()
+            if name in data:
+                data[name].append(val)
+            else:
+                data[name] = [val]
+    return data[ENVELOPE_FIELD][ENVELOPE_NUMBER]
+
+def imap_after(msg):
+    values = []
+    for encoded_value in msg.header_fields(
+        (ENVELOPE_FIELD, )
+    )[ENVELOPE_FIELD]:
+        values.extend([val.strip() for (val, encoding)
+                       in decode_header(encoded_value)])
+        if len(values) > ENVELOPE_NUMBER:
+            break
+    return values[ENVELOPE_NUMBER]
+
+def guesser_before(msg):
+    header_addrs = []
+    for fields in GUESSER_FIELDNAMES:
+        for field in fields:
+            header_addrs.extend(
+                [addr for (name, addr) in email.Utils.getaddresses(
+                    msg.get_all(field, [])
+                 ) if addr]
+            )
+        if header_addrs:
+            break
+    return header_addrs
+
+def guesser_after(msg):
+    header_addrs = []
+    values = msg.header_fields(GUESSER_FIELDS)
+    for fields in GUESSER_FIELDNAMES:
+        for field in fields:
+            header_addrs.extend(
+                [addr for (name, addr) in email.Utils.getaddresses(
+                    values[field]
+                 ) if addr]
+            )
+        if header_addrs:
+            break
+    return header_addrs
+
+def imap_message(raw):
+    msg = Message(fromstring=raw)
+    # As the IMAP retrievers do before finding the envelope
+    msg.add_header('X-getmail-retrieved-from-mailbox', 'INBOX')
+    return msg
+
+def to_only_message(raw):
+    # MultiGuesser goes through all the other fields first
+    return imap_message(raw.replace('Delivered-To:', 'X-Original-To:'))
+
+CASES = (
+    ('POP3', lambda raw: Message(fromlines=raw.split('\r\n')), pop_before,
+     pop_after),
+    ('IMAP', imap_message, imap_before, imap_after),
+    ('MultiGuesser', imap_message, guesser_before, guesser_after),
+    ('MultiGuesser To:', to_only_message, guesser_before, guesser_after),
+)
+
+#######################################
+def timed(function, msgs):
+    gc.disable()
+    try:
+        t = time.time()
+        for msg in msgs:
+            function(msg)
+        return (time.time() - t) / len(msgs)
+    finally:
+        gc.enable()
+
+#######################################
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10, 100, 500]
+    for count in counts:
+        raw = make_message(count)
+        for (label, make, before, after) in CASES:
+            msgs = [make(raw) for i in xrange(MESSAGES)]
+            if before(msgs[0]) != after(msgs[0]):
+                raise SystemExit('%s: %r != %r' % (label, before(msgs[0]),
+                                                   after(msgs[0])))
+            old = timed(before, msgs)
+            new = timed(after, msgs)
+            print '%4d Received: %-19s before %8.1f us, after %8.1f us ' \
+                  '(%.1fx)' % (count, label, old * 1e6, new * 1e6, old / new)
+
+if __name__ == '__main__':
+    main()
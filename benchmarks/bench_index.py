@@ -0,0 +1,100 @@
+#!/usr/bin/env python2
+'''Benchmark the memory used to index a large IMAP mailbox.
+
+usage: bench_index.py [MESSAGES]
+
+Builds the per-message state of an IMAP retriever for a mailbox of MESSAGES
+messages (default 1000000), all of them already retrieved and so listed in
+the oldmail file, once with the dicts and lists getmail used to keep and once
+with getmailcore.msgindex.  Each is built in a child process, and the growth
+of the child's peak resident size is reported per message, along with the
+time taken to build it and to look up every message.
+'''
+
+import os
+import sys
+import time
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from getmailcore.msgindex import mailboxindex, oldmailmap
+
+UIDVALIDITY = 1234567890
+TIMESTAMP = 1300000000
+
+#######################################
+def build_dicts(count):
+    msgnum_by_msgid = {}
+    mboxuids = {}
+    mboxuidorder = []
+    msgsizes = {}
+    oldmail = {}
+    for uid in xrange(1, count + 1):
+        msgid = '%s/%s' % (UIDVALIDITY, uid)
+        mboxuids[msgid] = str(uid)
+        mboxuidorder.append(msgid)
+        msgnum_by_msgid[msgid] = None
+        msgsizes[msgid] = 2000 + uid % 50000
+        # As read back from the oldmail file, a separate string
+        oldmail['%s/%s' % (UIDVALIDITY, uid)] = TIMESTAMP
+    def lookup():
+        for msgid in mboxuidorder:
+            msgsizes[msgid]
+            oldmail.get(msgid)
+    return ((msgnum_by_msgid, mboxuids, mboxuidorder, msgsizes, oldmail),
+            lookup)
+
+def build_index(count):
+    index = mailboxindex(UIDVALIDITY)
+    oldmail = oldmailmap()
+    for uid in xrange(1, count + 1):
+        index.append(uid, 2000 + uid % 50000)
+        oldmail['%s/%s' % (UIDVALIDITY, uid)] = TIMESTAMP
+    def lookup():
+        for i in xrange(len(index)):
+            msgid = index[i]
+            index.size(msgid)
+            oldmail.get(msgid)
+    return ((index, oldmail), lookup)
+
+#######################################
+def measure(build, count):
+    '''Run build in a child process; return (bytes per message, build
+    seconds, lookup seconds).
+    '''
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t = time.time()
+        (unused, lookup) = build(count)
+        built = time.time() - t
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t = time.time()
+        lookup()
+        looked = time.time() - t
+        # ru_maxrss is in kilobytes on Linux
+        os.write(w, '%d %f %f' % ((after - before) * 1024, built, looked))
+        os._exit(0)
+    os.close(w)
+    result = os.read(r, 1024)
+    os.close(r)
+    os.waitpid(pid, 0)
+    (grown, built, looked) = result.split()
+    return (float(grown) / count, float(built), float(looked))
+
+#######################################
+def main():
+    count = 1000000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    for (label, build) in (('dicts', build_dicts), ('msgindex', build_index)):
+        (per_message, built, looked) = measure(build, count)
+        print '%-9s %d messages: %6.1f bytes/message, build %.2fs, ' \
+              'lookup %.2fs' % (label, count, per_message, built, looked)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python2
+'''Benchmark delivery into a Maildir with many messages in cur/.
+
+usage: bench_maildir.py [CUR_COUNT [DELIVERIES]]
+
+Creates a scratch maildir, fills cur/ with CUR_COUNT empty message files,
+and times DELIVERIES deliveries into it, once with the algorithm getmail used
+to deliver with, which globbed cur/ for a clashing name and opened
+/dev/urandom for each message, and once with deliver_maildir().  The old
+algorithm's time grows with the size of cur/; deliver_maildir()'s should not.
+'''
+
+import os
+import sys
+import glob
+import time
+import shutil
+import signal
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from getmailcore.exceptions import getmailDeliveryError
+from getmailcore.utilities import deliver_maildir, is_maildir, safe_open, \
+    alarm_handler
+
+MESSAGE = 'From: a@example.org\nSubject: benchmark\n\n' + 'x' * 2000 + '\n'
+
+#######################################
+def old_deliver_maildir(maildirpath, data, hostname, dcount=None,
+                        filemode=0600):
+    '''deliver_maildir() as it was before it stopped listing the maildir.'''
+    if not is_maildir(maildirpath):
+        raise getmailDeliveryError('not a Maildir (%s)' % maildirpath)
+
+    signal.signal(signal.SIGALRM, alarm_handler)
+    signal.alarm(24 * 60 * 60)
+
+    info = {
+        'deliverycount' : dcount,
+        'hostname' : hostname.split('.')[0].replace('/', '\\057').replace(
+            ':', '\\072'),
+        'pid' : os.getpid(),
+    }
+    dir_tmp = os.path.join(maildirpath, 'tmp')
+    dir_new = os.path.join(maildirpath, 'new')
+
+    for unused in range(3):
+        t = time.time()
+        info['secs'] = int(t)
+        info['usecs'] = int((t - int(t)) * 1000000)
+        info['unique'] = 'M%(usecs)dP%(pid)s' % info
+        if info['deliverycount'] is not None:
+            info['unique'] += 'Q%(deliverycount)s' % info
+        try:
+            info['unique'] += 'R%s' % ''.join(
+                ['%02x' % ord(char)
+                 for char in open('/dev/urandom', 'rb').read(8)]
+            )
+        except StandardError:
+            pass
+
+        filename = '%(secs)s.%(unique)s.%(hostname)s' % info
+        fname_tmp = os.path.join(dir_tmp, filename)
+        fname_new = os.path.join(dir_new, filename)
+
+        if os.path.exists(fname_tmp):
+            time.sleep(2)
+            continue
+
+        curpat = os.path.join(maildirpath, 'cur', filename) + ':*'
+        collision = glob.glob(curpat)
+        if collision:
+            raise getmailDeliveryError('collision with %s' % collision)
+
+        break
+    else:
+        signal.alarm(0)
+        raise getmailDeliveryError('failed to allocate file in maildir')
+
+    s_maildir = os.stat(maildirpath)
+
+    try:
+        f = safe_open(fname_tmp, 'wb', filemode)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+    except IOError, o:
+        signal.alarm(0)
+        raise getmailDeliveryError('failure writing file %s (%s)'
+                                   % (fname_tmp, o))
+
+    try:
+        os.link(fname_tmp, fname_new)
+        os.unlink(fname_tmp)
+    except OSError:
+        signal.alarm(0)
+        try:
+            os.unlink(fname_tmp)
+        except StandardError:
+            pass
+        raise getmailDeliveryError('failure renaming "%s" to "%s"'
+                                   % (fname_tmp, fname_new))
+
+    signal.alarm(0)
+    return filename
+
+#######################################
+def make_maildir(cur_count):
+    path = tempfile.mkdtemp(prefix='bench_maildir.')
+    for sub in ('tmp', 'cur', 'new'):
+        os.mkdir(os.path.join(path, sub))
+    cur = os.path.join(path, 'cur')
+    for i in xrange(cur_count):
+        open(os.path.join(cur, '%d.M0P0Q%d.bench:2,S' % (i, i)), 'wb').close()
+    return path + '/'
+
+#######################################
+def run(deliver, path, deliveries):
+    t = time.time()
+    for i in xrange(deliveries):
+        deliver(path, MESSAGE, 'bench.example.org', i)
+    return time.time() - t
+
+#######################################
+def main():
+    cur_count = 300000
+    deliveries = 200
+    if len(sys.argv) > 1:
+        cur_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        deliveries = int(sys.argv[2])
+    path = make_maildir(cur_count)
+    try:
+        for (label, deliver) in (('old', old_deliver_maildir),
+                                 ('new', deliver_maildir)):
+            elapsed = run(deliver, path, deliveries)
+            print '%-4s %d deliveries, %d in cur/: %.3fs (%.3f ms each)' % (
+                label, deliveries, cur_count, elapsed,
+                elapsed * 1000.0 / deliveries
+            )
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
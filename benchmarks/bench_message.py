@@ -0,0 +1,327 @@
+#!/usr/bin/env python2
+'''Benchmark parsing, editing, and flattening messages.
+
+usage: bench_message.py [ATTACHMENT_KB [ROUNDS]]
+
+Generates a corpus of messages of the kinds getmail has trouble with: a tiny
+notification, deeply nested MIME, malformed 8-bit spam, a message with a
+base64 attachment of ATTACHMENT_KB kilobytes (default 8192), and a message
+with many lines starting with "From ".  Each is put through the operations
+getmail performs on a retrieved message: parsing it as from an IMAP server
+(a string) and a POP server (a list of lines), the corrupt_message() fallback,
+adding and removing a header field as filters do, rewrapping its header
+fields with format_header(), and flatten() as each kind of destination calls
+it, with and without the result cached by an earlier destination.
+
+For each, the best of ROUNDS (default 3) timed runs is reported in
+microseconds per message and nanoseconds per byte of message.  Python 2 has
+no allocation counter, so allocations are reported as the peak memory used
+by the operation, per byte of message, and the number of objects tracked by
+the garbage collector it leaves behind, per message; these are measured in a
+child process, with the operation applied to enough copies of the message to
+make a difference to the peak resident size.
+'''
+
+import os
+import sys
+import gc
+import time
+import random
+import base64
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from getmailcore.message import Message, corrupt_message
+from getmailcore.utilities import format_header
+import getmailcore.logging
+
+# Messages as an IMAP server returns them
+EOL = '\r\n'
+
+# Bytes of messages to process in each timed round, and at once in a child
+# process when measuring memory
+TIMED_BYTES = 4 * 1024 * 1024
+MEMORY_BYTES = 16 * 1024 * 1024
+
+# Removing a header field not in the message clears flatten()'s cache
+NO_SUCH_HEADER = 'X-Benchmark-Not-Present'
+
+#######################################
+def _received(rng, n):
+    return [
+        'Received: from relay%d.example.net (relay%d.example.net '
+        '[192.0.2.%d])%s\tby mx%d.example.org (Postfix) with ESMTPS id '
+        '%X%s\tfor <user@example.org>; Mon, 3 Oct 2011 12:%02d:%02d +0000'
+        % (i, i, rng.randint(1, 254), EOL, i, rng.getrandbits(40), EOL,
+           rng.randint(0, 59), rng.randint(0, 59))
+        for i in range(n)
+    ]
+
+def tiny_notification(rng):
+    lines = [
+        'Return-Path: <noreply@example.com>',
+    ] + _received(rng, 2) + [
+        'From: Example Service <noreply@example.com>',
+        'To: user@example.org',
+        'Subject: Your build has finished',
+        'Date: Mon, 3 Oct 2011 12:00:00 +0000',
+        'Message-ID: <%x@example.com>' % rng.getrandbits(64),
+        'MIME-Version: 1.0',
+        'Content-Type: text/plain; charset=us-ascii',
+        '',
+        'Build #1234 finished successfully.',
+        '',
+        '-- ',
+        'Example Service',
+        '',
+    ]
+    return EOL.join(lines)
+
+def _text(rng, words):
+    vocabulary = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+                  'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor')
+    lines = []
+    line = []
+    for i in range(words):
+        line.append(rng.choice(vocabulary))
+        if len(line) == 11:
+            lines.append(' '.join(line))
+            line = []
+    lines.append(' '.join(line))
+    return EOL.join(lines)
+
+def _nested(rng, depth, width):
+    boundary = '==boundary-%d-%x==' % (depth, rng.getrandbits(32))
+    lines = ['Content-Type: multipart/mixed; boundary="%s"' % boundary, '']
+    for i in range(width):
+        lines.append('--' + boundary)
+        if i == 0 and depth:
+            lines.append(_nested(rng, depth - 1, width))
+        elif i == 1 and depth and depth % 4 == 0:
+            # An attached message, itself MIME
+            lines.extend(['Content-Type: message/rfc822', '',
+                          'From: inner@example.com',
+                          'Subject: forwarded at depth %d' % depth,
+                          'MIME-Version: 1.0',
+                          _nested(rng, 0, 2)])
+        else:
+            lines.extend(['Content-Type: text/plain; charset=us-ascii', '',
+                          _text(rng, 60)])
+    lines.extend(['--' + boundary + '--', ''])
+    return EOL.join(lines)
+
+def nested_mime(rng):
+    return EOL.join([
+        'From: sender@example.com',
+        'To: user@example.org',
+        'Subject: nested',
+        'MIME-Version: 1.0',
+        _nested(rng, 24, 3),
+    ])
+
+def spam_8bit(rng):
+    def junk(n):
+        return ''.join([chr(rng.randint(128, 255)) for i in range(n)])
+    lines = _received(rng, 6) + [
+        'From: =?utf-8?B?broken-encoded-word <%s@example.biz>' % junk(6),
+        'To: undisclosed-recipients:;',
+        'Subject: =?windows-1251?Q?=CF=F0=E8=E2=E5=F2?= %s' % junk(30),
+        'Date: someday',
+        'X-Mailer: %s' % junk(40),
+        'a header field without a colon',
+        'MIME-Version: 1.0',
+        # The boundary doesn't match the parts, which don't end
+        'Content-Type: multipart/alternative; boundary="----=_wrong"',
+        '',
+        '------=_NextPart_000',
+        'Content-Type: text/plain; charset="koi8-r"',
+        'Content-Transfer-Encoding: 8bit',
+        '',
+    ]
+    for i in range(150):
+        lines.append(junk(70))
+    lines.extend([
+        '------=_NextPart_000',
+        'Content-Type: text/html',
+        'Content-Transfer-Encoding: base64',
+        '',
+        # Not valid base64
+        '%%%s!!' % base64.encodestring(junk(3000)).replace('\n', '*' + EOL),
+        '',
+    ])
+    return EOL.join(lines)
+
+def huge_base64(rng, kilobytes):
+    boundary = '==attachment-%x==' % rng.getrandbits(32)
+    # Repeating a random block keeps generating the corpus quick
+    block = ''.join([chr(rng.getrandbits(8)) for i in range(57 * 64)])
+    data = block * (kilobytes * 1024 // len(block) + 1)
+    encoded = base64.encodestring(data[:kilobytes * 1024])
+    del data
+    return EOL.join([
+        'From: sender@example.com',
+        'To: user@example.org',
+        'Subject: the files',
+        'MIME-Version: 1.0',
+        'Content-Type: multipart/mixed; boundary="%s"' % boundary,
+        '',
+        '--' + boundary,
+        'Content-Type: text/plain',
+        '',
+        'Attached.',
+        '--' + boundary,
+        'Content-Type: application/octet-stream; name="files.tar"',
+        'Content-Transfer-Encoding: base64',
+        '',
+        encoded.replace('\n', EOL) + '--' + boundary + '--',
+        '',
+    ])
+
+def from_lines(rng):
+    lines = [
+        'From: list@example.com',
+        'To: user@example.org',
+        'Subject: digest',
+        '',
+    ]
+    for i in range(2000):
+        n = rng.randint(0, 9)
+        if n < 2:
+            lines.append('From the desk of user %d: %s' % (i, _text(rng, 8)))
+        elif n < 3:
+            lines.append('%sFrom quoted %d' % ('>' * rng.randint(1, 3), i))
+        else:
+            lines.append(_text(rng, 10))
+    lines.append('')
+    return EOL.join(lines)
+
+def make_corpus(attachment_kb):
+    rng = random.Random(44)
+    return [
+        ('tiny', tiny_notification(rng)),
+        ('nested-mime', nested_mime(rng)),
+        ('8bit-spam', spam_8bit(rng)),
+        ('base64-%dk' % attachment_kb, huge_base64(rng, attachment_kb)),
+        ('from-lines', from_lines(rng)),
+    ]
+
+#######################################
+# Operations, as (label, prepare(raw), operate(prepared)); prepare does
+# whatever shouldn't be counted, once per message operated on.
+
+def parsed(raw):
+    msg = Message(fromstring=raw)
+    msg.recipient = 'user@example.org'
+    msg.received_from = 'imap.example.org'
+    msg.received_by = 'localhost'
+    msg.received_with = 'IMAP4-SSL'
+    return msg
+
+def cached(raw):
+    msg = parsed(raw)
+    msg.flatten(True, True)
+    return msg
+
+def header_edit(msg):
+    msg.add_header('X-getmail-filter-classifier', 'spam probability 0.99')
+    msg.remove_header('X-getmail-filter-classifier')
+
+def rewrap_headers(msg):
+    for (name, value) in msg.headers():
+        format_header(name, str(value))
+
+def flatten_cold(msg, *args):
+    msg.remove_header(NO_SUCH_HEADER)
+    return msg.flatten(*args)
+
+OPERATIONS = (
+    ('parse-string', lambda raw: raw,
+     lambda raw: Message(fromstring=raw)),
+    ('parse-lines', lambda raw: raw.split(EOL),
+     lambda lines: Message(fromlines=lines)),
+    ('corrupt', lambda raw: raw,
+     lambda raw: corrupt_message('benchmark', fromstring=raw)),
+    ('header-edit', parsed, header_edit),
+    ('format-header', parsed, rewrap_headers),
+    # MDA_external, MDA_qmaillocal
+    ('flatten', parsed, lambda msg: flatten_cold(msg, False, False)),
+    # Maildir
+    ('flatten-maildir', parsed, lambda msg: flatten_cold(msg, True, True)),
+    # Mboxrd
+    ('flatten-mboxrd', parsed,
+     lambda msg: flatten_cold(msg, True, True, True, True)),
+    # A second destination for the same message
+    ('flatten-cached', cached, lambda msg: msg.flatten(True, True)),
+)
+
+#######################################
+def timed(prepare, operate, raw, rounds):
+    '''Return the best time, in seconds per message, of rounds runs.'''
+    count = max(1, TIMED_BYTES // len(raw))
+    best = None
+    for i in range(rounds):
+        prepared = [prepare(raw) for j in xrange(count)]
+        t = time.time()
+        for item in prepared:
+            operate(item)
+        elapsed = (time.time() - t) / count
+        del prepared
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def memory(prepare, operate, raw):
+    '''Apply operate to copies of raw in a child process; return (peak bytes
+    per byte of message, objects kept per message).
+    '''
+    count = max(1, MEMORY_BYTES // len(raw))
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        gc.collect()
+        gc.disable()
+        prepared = [prepare(raw) for j in xrange(count)]
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        objects = gc.get_count()[0]
+        results = [operate(item) for item in prepared]
+        objects = gc.get_count()[0] - objects
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux
+        os.write(w, '%d %d' % ((after - before) * 1024, objects))
+        os._exit(0)
+    os.close(w)
+    result = os.read(r, 1024)
+    os.close(r)
+    os.waitpid(pid, 0)
+    (grown, objects) = result.split()
+    return (float(grown) / (count * len(raw)), float(objects) / count)
+
+#######################################
+def main():
+    attachment_kb = 8192
+    rounds = 3
+    if len(sys.argv) > 1:
+        attachment_kb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        rounds = int(sys.argv[2])
+    # corrupt_message() logs an error each time
+    getmailcore.logging.Logger().addhandler(open(os.devnull, 'w'), 0)
+    corpus = make_corpus(attachment_kb)
+    print '%-12s %-16s %10s %12s %9s %11s %9s' % (
+        'message', 'operation', 'bytes', 'us/message', 'ns/byte',
+        'peak B/byte', 'objects'
+    )
+    for (name, raw) in corpus:
+        for (label, prepare, operate) in OPERATIONS:
+            seconds = timed(prepare, operate, raw, rounds)
+            (peak, objects) = memory(prepare, operate, raw)
+            print '%-12s %-16s %10d %12.1f %9.2f %11.2f %9.1f' % (
+                name, label, len(raw), seconds * 1e6,
+                seconds * 1e9 / len(raw), peak, objects
+            )
+
+if __name__ == '__main__':
+    main()
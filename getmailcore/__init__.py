@@ -20,14 +20,22 @@ __version__ = '4.48.0'
 
 __all__ = [
     'baseclasses',
+    'batch',
     'compatibility',
     'constants',
     'destinations',
+    'duplicates',
     'exceptions',
     'filters',
+    'imap_pipeline',
     'imap_utf7',
     'logging',
+    'msgindex',
     'message',
+    'pipeline',
+    'planning',
+    'profiling',
     'retrievers',
+    'spool',
     'utilities',
 ]
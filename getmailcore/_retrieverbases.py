@@ -19,12 +19,18 @@ Base classes:
   MultidropPOP3RetrieverBase
   IMAPRetrieverBase
   MultidropIMAPRetrieverBase
+  LocalRetrieverBase
+  MaildirRetrieverBase
+  MboxRetrieverBase
 '''
 
 __all__ = [
     'IMAPinitMixIn',
     'IMAPRetrieverBase',
     'IMAPSSLinitMixIn',
+    'LocalRetrieverBase',
+    'MaildirRetrieverBase',
+    'MboxRetrieverBase',
     'MultidropPOP3RetrieverBase',
     'MultidropIMAPRetrieverBase',
     'POP3_ssl_port',
@@ -36,6 +42,10 @@ __all__ = [
 
 import sys
 import os
+import errno
+import mmap
+import fcntl
+import array
 import socket
 import time
 import email
@@ -43,6 +53,7 @@ import poplib
 import imaplib
 import re
 import select
+import threading
 
 try:
     # do we have a recent pykerberos?
@@ -63,6 +74,11 @@ try:
     import hashlib
 except ImportError:
     hashlib = None
+try:
+    from hashlib import sha1
+except ImportError:
+    # Python < 2.5
+    from sha import new as sha1
 
 # If we have an ssl module:
 if ssl:
@@ -178,6 +194,9 @@ from getmailcore.message import *
 from getmailcore.utilities import *
 from getmailcore._pop3ssl import POP3SSL, POP3_ssl_port
 from getmailcore.baseclasses import *
+from getmailcore.imap_pipeline import IMAPPipeline
+from getmailcore.msgindex import mailboxindex, oldmailmap, msgid_sortkey, \
+    UINT32_TYPECODE
 import getmailcore.imap_utf7        # registers imap4-utf-7 codec
 
 
@@ -201,6 +220,41 @@ VANISHED_AGE = (60 * 60 * 24 * 30)
 # Regex used to remove problematic characters from oldmail filenames
 STRIP_CHAR_RE = r'[/\:;<>|]+'
 
+# Messages delivered since an oldmail file was last written are appended to
+# a journal next to it, in the same format, which is replayed when the
+# oldmail file is next read and removed once it has been rewritten.  Each
+# entry is written immediately, so it survives getmail being killed; the
+# journal is synced to disk after this many entries or seconds, whichever
+# comes first, so a system crash loses at most that much, and before getmail
+# waits on the server for a message, so none are left unsynced meanwhile.
+OLDMAIL_JOURNAL_SUFFIX = '.journal'
+JOURNAL_SYNC_COUNT = 20
+JOURNAL_SYNC_INTERVAL = 1.0
+
+# The protocol libraries create their sockets with the default timeout, which
+# is process-wide; it is set only while a retriever connects, one at a time,
+# so each connection gets its own retriever's timeout.
+CONNECT_LOCK = threading.Lock()
+
+# Seconds to wait before reconnecting after the connection to the server is
+# lost, multiplied by the number of attempts made so far
+RECONNECT_DELAY = 5
+
+# Parameters of IMAP retrievers which must be the same for two retrievers to
+# share a session, besides the server, port, username, and password; see
+# IMAPRetrieverBase.session_key()
+IMAP_SESSION_PARAMETERS = (
+    'timeout',
+    'use_kerberos',
+    'use_cram_md5',
+    'keyfile',
+    'certfile',
+    'ca_certs',
+    'ssl_version',
+    'ssl_ciphers',
+    'ssl_fingerprints',
+)
+
 # Kerberos authentication state constants
 (GSS_STATE_STEP, GSS_STATE_WRAP) = (0, 1)
 
@@ -223,6 +277,53 @@ IMAP_LISTPARTS = re.compile(
 )
 
 
+# Messages per UID FETCH when retrieving headers in bulk
+IMAP_HEADER_BATCH = 100
+# Messages per FETCH when listing a mailbox, and number of such FETCHes kept in
+# flight while the listing is read
+IMAP_LIST_WINDOW = 5000
+IMAP_LIST_AHEAD = 2
+IMAP_UID_RE = re.compile(r'\bUID (\d+)')
+
+# Gmail IMAP extension items requested along with each message, and regexes
+# to pick them out of the FETCH response.  Labels may be quoted strings
+# containing parentheses.
+GMAIL_FETCH_ITEMS = 'X-GM-LABELS X-GM-THRID X-GM-MSGID'
+GMAIL_METADATA_RE = (
+    ('LABELS', re.compile(r'X-GM-LABELS \(((?:"(?:[^"\\]|\\.)*"|[^()"])*)\)')),
+    ('THRID', re.compile(r'X-GM-THRID (\d+)')),
+    ('MSGID', re.compile(r'X-GM-MSGID (\d+)')),
+)
+
+# Mailbox status items recorded in IMAP oldmail files when a mailbox is left
+# with nothing more to do, so that it can be skipped on the next run if a
+# STATUS (or LIST-STATUS) shows it hasn't changed.  The record is written as a
+# line without a NUL, which older versions' oldmail readers ignore.
+IMAP_STATUS_ITEMS = ('UIDVALIDITY', 'UIDNEXT', 'MESSAGES')
+OLDMAIL_STATUS_PREFIX = 'STATUS '
+IMAP_STATUSPARTS = re.compile(
+    r'^\s*(?:"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<atom>[^\s"(]+))'
+    r'\s+\((?P<items>[^()]*)\)\s*$'
+)
+
+# The subdirectories of a maildir messages are read from, the separator
+# between the unique part of a maildir file name and its flags, and the size
+# some delivery agents record in the unique part
+MAILDIR_SUBDIRS = ('new', 'cur')
+MAILDIR_INFO_SEP = ':'
+MAILDIR_SIZE_RE = re.compile(r',S=(\d+)')
+
+# mboxrd quoting of From_ lines in message bodies, and the header fields mail
+# readers add to or rewrite in messages in mbox files, which are left out of
+# the digest identifying a message
+MBOX_QUOTED_FROMLINE_RE = re.compile(r'^>(>*From )', re.MULTILINE)
+MBOX_VOLATILE_FIELDS_RE = re.compile(
+    r'^(?:status|x-status|x-keywords|x-uid|x-mozilla-status2?'
+    r'|content-length|lines)[ \t]*:.*\n(?:[ \t].*\n)*',
+    re.IGNORECASE | re.MULTILINE
+)
+
+
 # Constants used in socket module
 NO_OBJ = object()
 EAI_NONAME = getattr(socket, 'EAI_NONAME', NO_OBJ)
@@ -708,7 +809,10 @@ class RetrieverSkeleton(ConfigurableBase):
                           Message identifiers must be unique and persistent
                           across instantiations.  Also store message sizes (in
                           octets) in a dictionary self.msgsizes, using the
-                          message identifiers as keys.
+                          message identifiers as keys.  Sub-classes which
+                          keep their own index (see
+                          getmailcore.msgindex) override __len__(),
+                          __getitem__() and _getmsgsizebyid() instead.
 
       _delmsgbyid(self, msgid) - delete a message from the message store based
                                  on its message identifier.
@@ -728,6 +832,11 @@ class RetrieverSkeleton(ConfigurableBase):
                                  possible.  It should be returned in the same
                                  format.
 
+      _setenvelope(self, msgid, msg) - reconstruct the message envelope for a
+                                 message or message header returned by the
+                                 above, for retrievers which can.  The default
+                                 does nothing.
+
       showconf(self) - should invoke self.log.info() to display the
                                 configuration of the class instance.
 
@@ -740,29 +849,38 @@ class RetrieverSkeleton(ConfigurableBase):
       checkconf(self)
     '''
     def __init__(self, **args):
-        self.headercache = {}
         self.deleted = {}
         self.set_new_timestamp()
         self.__oldmail_written = False
         self.__initialized = False
         self.gotmsglist = False
+        self.__journal = None
         self._clear_state()
         self.conn = None
         self.supports_idle = False
+        # Serializes use of the connection when messages are retrieved in a
+        # background thread; see getmailcore.pipeline
+        self.lock = threading.RLock()
         ConfigurableBase.__init__(self, **args)
 
     def set_new_timestamp(self):
         self.timestamp = int(time.time())
 
     def _clear_state(self):
+        self._close_journal()
         self.msgnum_by_msgid = {}
         self.msgid_by_msgnum = {}
         self.sorted_msgnum_msgid = ()
         self.msgsizes = {}
-        self.oldmail = {}
+        self.oldmail = oldmailmap()
         self.__delivered = {}
+        # IMAP msgids are only unique within a mailbox
+        self.headercache = {}
         self.mailbox_selected = False
-        
+        # Mailbox status read from / to be written to the oldmail file
+        self.oldmail_status = None
+        self.mailbox_status = None
+
     def setup_received(self, sock):
         serveraddr = sock.getpeername()
         if len(serveraddr) == 2:
@@ -816,8 +934,11 @@ class RetrieverSkeleton(ConfigurableBase):
         return filename
 
     def oldmail_exists(self, mailbox):
-        '''Test whether an oldmail file exists for a specified mailbox.'''
-        return os.path.isfile(self._oldmail_filename(mailbox))
+        '''Test whether an oldmail file, or a journal of messages delivered
+        since it was last written, exists for a specified mailbox.'''
+        filename = self._oldmail_filename(mailbox)
+        return (os.path.isfile(filename)
+                or os.path.isfile(filename + OLDMAIL_JOURNAL_SUFFIX))
 
     def read_oldmailfile(self, mailbox):
         '''Read contents of an oldmail file.  For POP, mailbox must be 
@@ -835,10 +956,14 @@ class RetrieverSkeleton(ConfigurableBase):
         except IOError:
             self.log.moreinfo('no oldmail file for %s%s'
                               % (logname, os.linesep))
+            self._replay_journal(mailbox)
             return
             
         for line in f:
             line = line.strip()
+            if line.startswith(OLDMAIL_STATUS_PREFIX) and not '\0' in line:
+                self.oldmail_status = self._parse_oldmailstatus(line)
+                continue
             if not line or not '\0' in line:
                 # malformed
                 continue
@@ -862,9 +987,115 @@ class RetrieverSkeleton(ConfigurableBase):
             'read %i uids for %s%s'
             % (len(self.oldmail), logname, os.linesep)
         )
+        self._replay_journal(mailbox)
         self.log.moreinfo('read %i uids in total for %s%s'
                           % (len(self.oldmail), logname, os.linesep))
 
+    def _replay_journal(self, mailbox):
+        '''Add messages recorded in the journal of a session which ended
+        without writing its oldmail file to the list of old messages.
+        '''
+        filename = self._oldmail_filename(mailbox) + OLDMAIL_JOURNAL_SUFFIX
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return
+        replayed = 0
+        try:
+            for line in f:
+                if not line.endswith('\n'):
+                    # Partly-written last entry
+                    break
+                try:
+                    (msgid, timestamp) = line.rstrip().split('\0', 1)
+                    self.oldmail[msgid] = int(timestamp)
+                    replayed += 1
+                except ValueError:
+                    # malformed
+                    continue
+        finally:
+            f.close()
+        self.log.info('recovered %i uids from journal for %s:%s%s'
+                      % (replayed, self, mailbox or '', os.linesep))
+
+    def _journal_delivered(self, msgid):
+        '''Append a delivered message to the oldmail journal.'''
+        if self.__journal is None:
+            filename = (self._oldmail_filename(self.mailbox_selected)
+                        + OLDMAIL_JOURNAL_SUFFIX)
+            try:
+                fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                             0600)
+            except OSError, o:
+                self.log.warning('failed opening oldmail journal %s (%s)%s'
+                                 % (filename, o, os.linesep))
+                self.__journal = False
+                return
+            self.__journal = {'fd' : fd, 'unsynced' : 0,
+                              'synced' : time.time()}
+        elif self.__journal is False:
+            # Couldn't be opened
+            return
+        journal = self.__journal
+        try:
+            os.write(journal['fd'],
+                     '%s\0%i\n' % (msgid, self.timestamp))
+            journal['unsynced'] += 1
+        except OSError, o:
+            self.log.warning('failed writing oldmail journal (%s)%s'
+                             % (o, os.linesep))
+            return
+        if (journal['unsynced'] >= JOURNAL_SYNC_COUNT
+                or time.time() - journal['synced'] >= JOURNAL_SYNC_INTERVAL):
+            self.sync_journal()
+
+    def sync_journal(self):
+        '''Sync the oldmail journal to disk, if anything has been written to
+        it since it last was.  Called before waiting on the server, so
+        delivered messages are not recorded only in memory for that long.
+        '''
+        journal = self.__journal
+        if not journal or not journal['unsynced']:
+            return
+        try:
+            os.fsync(journal['fd'])
+            journal['unsynced'] = 0
+            journal['synced'] = time.time()
+        except OSError, o:
+            self.log.warning('failed syncing oldmail journal (%s)%s'
+                             % (o, os.linesep))
+
+    def _close_journal(self, sync=True):
+        '''Close the oldmail journal, first syncing it to disk if sync is set.
+        '''
+        journal = self.__journal
+        self.__journal = None
+        if not journal:
+            return
+        try:
+            if journal['unsynced'] and sync:
+                os.fsync(journal['fd'])
+            os.close(journal['fd'])
+        except OSError, o:
+            self.log.warning('failed closing oldmail journal (%s)%s'
+                             % (o, os.linesep))
+
+    def _parse_oldmailstatus(self, line):
+        '''Parse a mailbox status line from an oldmail file into a dict of
+        item names and integer values.  Returns None if malformed.
+        '''
+        parts = line[len(OLDMAIL_STATUS_PREFIX):].split()
+        if not parts or len(parts) % 2:
+            return None
+        status = {}
+        try:
+            while parts:
+                name = parts.pop(0).upper()
+                status[name] = int(parts.pop(0))
+        except ValueError:
+            return None
+        return status
+
     def write_oldmailfile(self, mailbox):
         '''Write oldmail info to oldmail file.'''
         self.log.trace('mailbox=%s' % mailbox)
@@ -874,20 +1105,39 @@ class RetrieverSkeleton(ConfigurableBase):
         
         oldmailfile = None
         wrote = 0
-        msgids = frozenset(
-            self.__delivered.keys()
-        ).union(frozenset(self.oldmail.keys()))
+        # Written in UID order, so the file is read back into a few ranges
+        delivered = [msgid for msgid in self.__delivered.keys()
+                     if msgid not in self.oldmail]
+        delivered.sort(key=msgid_sortkey)
         try:
             oldmailfile = updatefile(filename)
-            for msgid in msgids:
-                self.log.debug('msgid %s ...' % msgid)
-                t = self.oldmail.get(msgid, self.timestamp)
-                self.log.debug(' timestamp %s' % t + os.linesep)
+            for (msgid, t) in self.oldmail.iteritems():
+                self.log.debug('msgid %s timestamp %s' % (msgid, t)
+                               + os.linesep)
                 oldmailfile.write('%s\0%i%s' % (msgid, t, os.linesep))
                 wrote += 1
+            for msgid in delivered:
+                self.log.debug('msgid %s timestamp %s' % (msgid, self.timestamp)
+                               + os.linesep)
+                oldmailfile.write('%s\0%i%s' % (msgid, self.timestamp,
+                                                 os.linesep))
+                wrote += 1
+            if self.mailbox_status:
+                oldmailfile.write('%s%s%s' % (
+                    OLDMAIL_STATUS_PREFIX,
+                    ' '.join(['%s %i' % item
+                              for item in sorted(self.mailbox_status.items())]),
+                    os.linesep
+                ))
             oldmailfile.close()
             self.log.moreinfo('wrote %i uids for %s%s'
                               % (wrote, logname, os.linesep))
+            # The oldmail file now includes everything in the journal
+            self._close_journal(sync=False)
+            try:
+                os.unlink(filename + OLDMAIL_JOURNAL_SUFFIX)
+            except OSError:
+                pass
         except IOError, o:
             self.log.error('failed writing oldmail file for %s (%s)'
                            % (logname, o) + os.linesep)
@@ -900,20 +1150,11 @@ class RetrieverSkeleton(ConfigurableBase):
         # aren't used in initializing the retriever.
         self.log.trace()
         self.checkconf()
-        # socket.ssl() and socket timeouts are incompatible in Python 2.3
-        if 'timeout' in self.conf:
-            socket.setdefaulttimeout(self.conf['timeout'])
-        else:
-            # Explicitly set to None in case it was previously set
-            socket.setdefaulttimeout(None)
 
         # Construct base filename for oldmail files.
         # strip problematic characters from oldmail filename.  Mostly for
         # non-Unix systems; only / is illegal in a Unix path component
-        oldmail_filename = re.sub(
-            STRIP_CHAR_RE, '-',
-            'oldmail-%(server)s-%(port)i-%(username)s' % self.conf
-        )
+        oldmail_filename = re.sub(STRIP_CHAR_RE, '-', self._oldmail_basename())
         self.oldmail_filename = os.path.join(self.conf['getmaildir'], 
                                              oldmail_filename)
 
@@ -921,6 +1162,82 @@ class RetrieverSkeleton(ConfigurableBase):
         self.app_options = options
         self.__initialized = True
 
+    def _oldmail_basename(self):
+        '''Return the name of the oldmail file, before problematic characters
+        are stripped from it and without the mailbox.
+        '''
+        return 'oldmail-%(server)s-%(port)i-%(username)s' % self.conf
+
+    def session_key(self):
+        '''Return a key identifying the session this retriever opens with the
+        server, if its session can be handed on to another retriever with the
+        same key when it is done, or None if it can't.  Retrievers which
+        can hand their sessions on implement use_session() and
+        release_session().
+        '''
+        return None
+
+    def _open_connection(self):
+        '''Connect to the server, with the timeout configured for this
+        retriever applying to the new connection's socket only.
+        '''
+        # socket.ssl() and socket timeouts are incompatible in Python 2.3, so
+        # the SSL retrievers may have no timeout
+        timeout = self.conf.get('timeout', None)
+        CONNECT_LOCK.acquire()
+        try:
+            previous = socket.getdefaulttimeout()
+            socket.setdefaulttimeout(timeout)
+            try:
+                self._connect()
+            finally:
+                socket.setdefaulttimeout(previous)
+        finally:
+            CONNECT_LOCK.release()
+
+    def _retry(self, method, *args):
+        '''Call method, and if the connection to the server is lost or times
+        out, reconnect and call it again, up to the number of times set by
+        the reconnect_attempts option.  Messages delivered and deleted so far
+        are kept, so the session carries on where it left off.  Must be
+        called with self.lock held.
+        '''
+        attempts = self.app_options.get('reconnect_attempts', 0)
+        attempt = 0
+        while True:
+            try:
+                if attempt:
+                    self._reconnect()
+                return method(*args)
+            except (socket.error, getmailConnectionError), o:
+                if attempt >= attempts or self.mailbox_selected is False:
+                    raise
+                attempt += 1
+                self.log.warning('%s: connection lost (%s), reconnecting '
+                                 '(attempt %d of %d)'
+                                 % (self, o, attempt, attempts) + os.linesep)
+                self._drop_connection()
+                time.sleep(RECONNECT_DELAY * attempt)
+
+    def _drop_connection(self):
+        '''Close the connection without logging out, keeping the session's
+        state.
+        '''
+        if self.conn is None:
+            return
+        for name in ('file', 'sock', 'rawsock'):
+            try:
+                getattr(self.conn, name).close()
+            except (AttributeError, socket.error):
+                pass
+        self.conn = None
+
+    def _reconnect(self):
+        '''Reconnect and log in, and select the mailbox selected before the
+        connection was lost, with the state of the session intact.
+        '''
+        raise getmailOperationError('%s cannot reconnect' % self)
+
     def quit(self):
         if self.mailbox_selected is not False:
             self.write_oldmailfile(self.mailbox_selected)
@@ -934,31 +1251,96 @@ class RetrieverSkeleton(ConfigurableBase):
 
     def delivered(self, msgid):
         self.__delivered[msgid] = None
+        self._journal_delivered(msgid)
+
+    def seen(self, msgid):
+        '''Return True if the message was retrieved in a previous session or
+        delivered in this one.
+        '''
+        return msgid in self.oldmail or msgid in self.__delivered
+
+    def _remove_vanished(self, present):
+        '''Forget old messages which are no longer in the mailbox, but only
+        if they were retrieved long enough ago (30 days for now).  This is
+        because IMAP users can have one state file but multiple IMAP folders
+        in different configuration rc files.
+        '''
+        vanished = self.oldmail.vanished(present,
+                                         self.timestamp - VANISHED_AGE)
+        for msgid in vanished:
+            self.log.debug('removing vanished old message id %s' % msgid
+                           + os.linesep)
+        self.oldmail.discard(vanished)
+
+    def _setenvelope(self, msgid, msg):
+        pass
 
     def getheader(self, msgid):
         if not self.__initialized:
             raise getmailOperationError('not initialized')
-        if not msgid in self.headercache:
-            self.headercache[msgid] = self._getheaderbyid(msgid)
-        return self.headercache[msgid]
+        self.lock.acquire()
+        try:
+            if not msgid in self.headercache:
+                self.headercache[msgid] = self._retry(self._getheaderbyid,
+                                                      msgid)
+            return self.headercache[msgid]
+        finally:
+            self.lock.release()
+
+    def prefetch_headers(self, msgids):
+        '''Retrieve the headers of the specified messages into the header cache
+        ahead of getheader() calls.  Sub-classes which can retrieve them more
+        efficiently in bulk should override this.
+        '''
+        pass
+
+    def request_message(self, msgid):
+        '''Hint that a message will be retrieved soon, so that retrievers
+        which can start retrieving it without waiting for it can do so.
+        Returns True if the retriever has started retrieving it, False if it
+        can't or can't yet, in which case it may be requested again later.
+        '''
+        if not self.__initialized:
+            raise getmailOperationError('not initialized')
+        self.lock.acquire()
+        try:
+            return self._retry(self._requestmsgbyid, msgid)
+        finally:
+            self.lock.release()
+
+    def _requestmsgbyid(self, msgid):
+        return False
 
     def getmsg(self, msgid):
         if not self.__initialized:
             raise getmailOperationError('not initialized')
-        return self._getmsgbyid(msgid)
+        self.lock.acquire()
+        try:
+            # Header no longer needed once the whole message is here
+            self.headercache.pop(msgid, None)
+            return self._retry(self._getmsgbyid, msgid)
+        finally:
+            self.lock.release()
 
     def getmsgsize(self, msgid):
         if not self.__initialized:
             raise getmailOperationError('not initialized')
         try:
-            return self.msgsizes[msgid]
+            return self._getmsgsizebyid(msgid)
         except KeyError:
             raise getmailOperationError('no such message ID %s' % msgid)
 
+    def _getmsgsizebyid(self, msgid):
+        return self.msgsizes[msgid]
+
     def delmsg(self, msgid):
         if not self.__initialized:
             raise getmailOperationError('not initialized')
-        self._delmsgbyid(msgid)
+        self.lock.acquire()
+        try:
+            self._retry(self._delmsgbyid, msgid)
+        finally:
+            self.lock.release()
         self.deleted[msgid] = True
 
 
@@ -991,72 +1373,105 @@ class POP3RetrieverBase(RetrieverSkeleton):
             raise getmailOperationError('no such message ID %s' % msgid)
         return self.msgnum_by_msgid[msgid]
 
+    def _longcmd(self, cmd):
+        '''Send a command with a multi-line response, and yield the lines of
+        the response as they are read.  poplib collects the whole response
+        before returning it, which for UIDL or LIST on a very large mailbox
+        takes a lot of memory.  The caller must read all the lines before
+        sending another command, even if it gives up on them part way;
+        otherwise the next command reads the rest as its response.
+        '''
+        self.conn._putcmd(cmd)
+        response = self.conn._getresp()
+        self.log.debug('%s response "%s"' % (cmd, response) + os.linesep)
+        (line, octets) = self.conn._getline()
+        while line != '.':
+            # Undo byte-stuffing
+            if line[:2] == '..':
+                line = line[1:]
+            yield line
+            (line, octets) = self.conn._getline()
+
     def _getmsglist(self):
         self.log.trace()
         try:
-            (response, msglist, octets) = self.conn.uidl()
-            self.log.debug('UIDL response "%s", %d octets'
-                           % (response, octets) + os.linesep)
-            for (i, line) in enumerate(msglist):
-                try:
-                    (msgnum, msgid) = line.split(None, 1)
-                    # Don't allow / in UIDs we store, as we look for that to 
-                    # detect old-style oldmail files.  Shouldn't occur in POP3
-                    # anyway.
-                    msgid = msgid.replace('/', '-')
-                except ValueError:
-                    # Line didn't contain two tokens.  Server is broken.
-                    raise getmailOperationError(
-                        '%s failed to identify message index %d in UIDL output'
-                        ' -- see documentation or use '
-                        'BrokenUIDLPOP3Retriever instead'
-                        % (self, i)
-                    )
-                msgnum = int(msgnum)
-                if msgid in self.msgnum_by_msgid:
-                    # UIDL "unique" identifiers weren't unique.
-                    # Server is broken.
-                    if self.conf.get('delete_dup_msgids', False):
-                        self.log.debug('deleting message %s with duplicate '
-                                       'msgid %s' % (msgnum, msgid)
-                                       + os.linesep)
-                        self.conn.dele(msgnum)
-                    else:
+            msglist = []
+            duplicates = []
+            lines = self._longcmd('UIDL')
+            try:
+                for (i, line) in enumerate(lines):
+                    try:
+                        (msgnum, msgid) = line.split(None, 1)
+                        # Don't allow / in UIDs we store, as we look for
+                        # that to detect old-style oldmail files.  Shouldn't
+                        # occur in POP3 anyway.
+                        msgid = msgid.replace('/', '-')
+                    except ValueError:
+                        # Line didn't contain two tokens.  Server is broken.
                         raise getmailOperationError(
-                            '%s does not uniquely identify messages '
-                            '(got %s twice) -- see documentation or use '
+                            '%s failed to identify message index %d in UIDL '
+                            'output -- see documentation or use '
                             'BrokenUIDLPOP3Retriever instead'
-                            % (self, msgid)
+                            % (self, i)
                         )
-                else:
-                    self.msgnum_by_msgid[msgid] = msgnum
-                    self.msgid_by_msgnum[msgnum] = msgid
-            self.log.debug('Message IDs: %s'
-                           % sorted(self.msgnum_by_msgid.keys()) + os.linesep)
-            self.sorted_msgnum_msgid = sorted(self.msgid_by_msgnum.items())
-            (response, msglist, octets) = self.conn.list()
-            for line in msglist:
-                msgnum = int(line.split()[0])
-                msgsize = int(line.split()[1])
-                msgid = self.msgid_by_msgnum.get(msgnum, None)
-                # If no msgid found, it's a message that wasn't in the UIDL
-                # response above.  Ignore it and we'll get it next time.
-                if msgid is not None:
-                    self.msgsizes[msgid] = msgsize
+                    msgnum = int(msgnum)
+                    if msgid in self.msgnum_by_msgid:
+                        # UIDL "unique" identifiers weren't unique.
+                        # Server is broken.
+                        if self.conf.get('delete_dup_msgids', False):
+                            self.log.debug('deleting message %s with '
+                                           'duplicate msgid %s'
+                                           % (msgnum, msgid) + os.linesep)
+                            # Can't send DELE in the middle of the UIDL
+                            # response
+                            duplicates.append(msgnum)
+                        else:
+                            raise getmailOperationError(
+                                '%s does not uniquely identify messages '
+                                '(got %s twice) -- see documentation or use '
+                                'BrokenUIDLPOP3Retriever instead'
+                                % (self, msgid)
+                            )
+                    else:
+                        self.msgnum_by_msgid[msgid] = msgnum
+                        self.msgid_by_msgnum[msgnum] = msgid
+                        msglist.append((msgnum, msgid))
+            finally:
+                # Read the rest of the response, if a bad line ended the loop
+                for line in lines:
+                    pass
+            for msgnum in duplicates:
+                self.conn.dele(msgnum)
+            self.log.debug('got %d message IDs' % len(msglist) + os.linesep)
+            # Servers list messages in order, so this rarely has to sort
+            for i in xrange(1, len(msglist)):
+                if msglist[i][0] < msglist[i - 1][0]:
+                    msglist.sort()
+                    break
+            self.sorted_msgnum_msgid = msglist
+            lines = self._longcmd('LIST')
+            try:
+                for line in lines:
+                    parts = line.split()
+                    msgnum = int(parts[0])
+                    msgid = self.msgid_by_msgnum.get(msgnum, None)
+                    # If no msgid found, it's a message that wasn't in the
+                    # UIDL response above.  Ignore it and we'll get it next
+                    # time.
+                    if msgid is not None:
+                        self.msgsizes[msgid] = int(parts[1])
+            finally:
+                for line in lines:
+                    pass
 
             # Remove messages from state file that are no longer in mailbox,
             # but only if the timestamp for them are old (30 days for now).
             # This is because IMAP users can have one state file but multiple
             # IMAP folders in different configuration rc files.
-            for msgid in self.oldmail.keys():
-                timestamp = self.oldmail[msgid]
-                age = self.timestamp - timestamp
-                if not self.msgsizes.has_key(msgid) and age > VANISHED_AGE:
-                    self.log.debug('removing vanished old message id %s' % msgid
-                                   + os.linesep)
-                    del self.oldmail[msgid]
+            self._remove_vanished(self.msgsizes)
 
         except poplib.error_proto, o:
+            self._check_dropped(o)
             raise getmailOperationError(
                 'POP error (%s) - if your server does not support the UIDL '
                 'command, use BrokenUIDLPOP3Retriever instead'
@@ -1064,10 +1479,21 @@ class POP3RetrieverBase(RetrieverSkeleton):
             )
         self.gotmsglist = True
 
+    def _check_dropped(self, o):
+        '''Raise getmailConnectionError if poplib.error_proto o means the
+        server closed the connection, rather than refused a command.
+        '''
+        if str(o) == '-ERR EOF':
+            raise getmailConnectionError('POP error (%s)' % o)
+
     def _delmsgbyid(self, msgid):
         self.log.trace()
         msgnum = self._getmsgnumbyid(msgid)
-        self.conn.dele(msgnum)
+        try:
+            self.conn.dele(msgnum)
+        except poplib.error_proto, o:
+            self._check_dropped(o)
+            raise
 
     def _getmsgbyid(self, msgid):
         self.log.debug('msgid %s' % msgid + os.linesep)
@@ -1078,8 +1504,10 @@ class POP3RetrieverBase(RetrieverSkeleton):
             self.log.debug('RETR response "%s", %d octets'
                            % (response, octets) + os.linesep)
             msg = Message(fromlines=lines+[''])
+            self._setenvelope(msgid, msg)
             return msg
         except poplib.error_proto, o:
+            self._check_dropped(o)
             raise getmailRetrievalError(
                 'failed to retrieve msgid %s; server said %s' 
                 % (msgid, o)
@@ -1088,9 +1516,19 @@ class POP3RetrieverBase(RetrieverSkeleton):
     def _getheaderbyid(self, msgid):
         self.log.trace()
         msgnum = self._getmsgnumbyid(msgid)
-        response, headerlist, octets = self.conn.top(msgnum, 0)
-        parser = email.Parser.HeaderParser()
-        return parser.parsestr(os.linesep.join(headerlist))
+        try:
+            response, headerlist, octets = self.conn.top(msgnum, 0)
+            self.log.debug('TOP response "%s", %d octets'
+                           % (response, octets) + os.linesep)
+        except poplib.error_proto, o:
+            self._check_dropped(o)
+            raise getmailRetrievalError(
+                'failed to retrieve header of msgid %s; server said %s' 
+                % (msgid, o)
+            )
+        msg = Message(fromlines=headerlist+[''])
+        self._setenvelope(msgid, msg)
+        return msg
 
     def initialize(self, options):
         self.log.trace()
@@ -1103,26 +1541,38 @@ class POP3RetrieverBase(RetrieverSkeleton):
                 self.received_with, self.log
             )
         RetrieverSkeleton.initialize(self, options)
+        self._open_connection()
+        self._login()
+        # The messages are listed when the mailbox is selected
+
+    def _login(self):
         try:
-            self._connect()
             if self.conf['use_apop']:
                 self.conn.apop(self.conf['username'], self.conf['password'])
             else:
                 self.conn.user(self.conf['username'])
                 self.conn.pass_(self.conf['password'])
-            self._getmsglist()
-            self.log.debug('msgids: %s'
-                           % sorted(self.msgnum_by_msgid.keys()) + os.linesep)
-            self.log.debug('msgsizes: %s' % self.msgsizes + os.linesep)
-            # Remove messages from state file that are no longer in mailbox
-            for msgid in self.oldmail.keys():
-                if not self.msgsizes.has_key(msgid):
-                    self.log.debug('removing vanished message id %s' % msgid
-                                   + os.linesep)
-                    del self.oldmail[msgid]
         except poplib.error_proto, o:
             raise getmailOperationError('POP error (%s)' % o)
 
+    def _reconnect(self):
+        self.log.trace()
+        self._open_connection()
+        self._login()
+        # Message numbers belong to the POP session, so list the messages
+        # again; their msgids are unchanged
+        self.msgnum_by_msgid = {}
+        self.msgid_by_msgnum = {}
+        self.sorted_msgnum_msgid = ()
+        self.msgsizes = {}
+        self._getmsglist()
+        # The server forgets messages marked for deletion when a session
+        # ends without QUIT, so mark them again
+        for msgid in self.deleted:
+            if msgid in self.msgnum_by_msgid:
+                self.conn.dele(self.msgnum_by_msgid[msgid])
+        self.log.info('%s: reconnected' % self + os.linesep)
+
     def abort(self):
         self.log.trace()
         RetrieverSkeleton.abort(self)
@@ -1187,27 +1637,38 @@ class MultidropPOP3RetrieverBase(POP3RetrieverBase):
                 'invalid envelope_recipient specification format (%s)' % o
             )
 
-    def _getmsgbyid(self, msgid):
+    def _setenvelope(self, msgid, msg):
         self.log.trace()
-        msg = POP3RetrieverBase._getmsgbyid(self, msgid)
-        data = {}
-        for (name, val) in msg.headers():
-            name = name.lower()
-            val = val.strip()
-            if name in data:
-                data[name].append(val)
-            else:
-                data[name] = [val]
-
+        values = msg.header_fields((self.envrecipname, ))[self.envrecipname]
         try:
-            line = data[self.envrecipname][self.envrecipnum]
-        except (KeyError, IndexError), unused:
+            line = values[self.envrecipnum]
+        except IndexError:
             raise getmailConfigurationError(
                 'envelope_recipient specified header missing (%s)'
                 % self.conf['envelope_recipient']
             )
         msg.recipient = address_no_brackets(line.strip())
-        return msg
+
+
+#######################################
+class IMAPSession(object):
+    '''A logged-in IMAP connection, with no mailbox selected, handed on from
+    one retriever to another for the same account.
+    '''
+    def __init__(self, conn, received_from, supports_idle):
+        self.conn = conn
+        self.received_from = received_from
+        self.supports_idle = supports_idle
+
+    def __str__(self):
+        return 'IMAPSession(%s)' % self.received_from
+
+    def close(self):
+        '''Log out, for a session no retriever took over.'''
+        try:
+            self.conn.logout()
+        except (imaplib.IMAP4.error, socket.error):
+            pass
 
 
 #######################################
@@ -1220,19 +1681,34 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         self.gss_step = 0
         self.gss_vc = None
         self.gssapi = False
+        # Mailbox status from LIST-STATUS, keyed by encoded mailbox name
+        self._listed_status = {}
+        # Pipelined commands, once logged in
+        self.pipeline = None
+        self._requested = {}
+        self._delete_queue = []
+        # Session left by another retriever, to be taken over when
+        # initialized
+        self._session = None
+        # Digest of the configured credentials, for session_key()
+        self._credentials = None
 
     def _clear_state(self):
         RetrieverSkeleton._clear_state(self)
         self.mailbox = None
         self.uidvalidity = None
-        self.msgnum_by_msgid = {}
-        self.msgid_by_msgnum = {}
-        self.sorted_msgnum_msgid = ()
-        self._mboxuids = {}
-        self._mboxuidorder = []
-        self.msgsizes = {}
-        self.oldmail = {}
-        self.__delivered = {}
+        # UIDs and sizes of the messages in the selected mailbox
+        self._index = mailboxindex()
+        # Listing FETCH commands in flight, and how far the listing has got
+        self._listing = []
+        self._listed_to = 0
+        self._msgcount = 0
+        self._select_status = None
+        # Message FETCH commands sent ahead of getmsg(), by msgid
+        self._requested = {}
+        # Messages to be flagged as deleted, and UIDs of those which have been
+        self._delete_queue = []
+        self._flagged = array.array(UINT32_TYPECODE)
 
     def checkconf(self):
         RetrieverSkeleton.checkconf(self)
@@ -1268,19 +1744,36 @@ class IMAPRetrieverBase(RetrieverSkeleton):
  
     def _getmboxuidbymsgid(self, msgid):
         self.log.trace()
-        if not msgid in self.msgnum_by_msgid:
+        uid = self._index.uid(msgid)
+        if uid is None:
             raise getmailOperationError('no such message ID %s' % msgid)
-        uid = self._mboxuids[msgid]
         return uid
 
+    def _imap_sync(self):
+        '''Wait for pipelined commands to complete, so the imaplib connection
+        can be used directly.
+        '''
+        if self.pipeline is None:
+            return
+        self._flush_deletes()
+        try:
+            self.pipeline.sync()
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+
     def _parse_imapcmdresponse(self, cmd, *args):
         self.log.trace()
+        self._imap_sync()
         try:
             result, resplist = getattr(self.conn, cmd)(*args)
         except imaplib.IMAP4.error, o:
             if cmd == 'login':
                 # Percolate up
                 raise
+            elif isinstance(o, imaplib.IMAP4.abort):
+                raise getmailConnectionError('IMAP error (%s)' % o)
             else:
                 raise getmailOperationError('IMAP error (%s)' % o)
         if result != 'OK':
@@ -1298,28 +1791,53 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             )
         return resplist
 
-    def _parse_imapuidcmdresponse(self, cmd, *args):
+    def _submit_imapcmd(self, cmd, *args, **kwargs):
+        '''Send a pipelined command; its response is read by
+        _imapcmdresult().  Keyword arguments are those of
+        imap_pipeline.IMAPCommand.
+        '''
         self.log.trace()
         try:
-            result, resplist = self.conn.uid(cmd, *args)
+            return self.pipeline.submit(cmd, *args, **kwargs)
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
         except imaplib.IMAP4.error, o:
-            if cmd == 'login':
-                # Percolate up
-                raise
-            else:
-                raise getmailOperationError('IMAP error (%s)' % o)
+            raise getmailOperationError('IMAP error (%s)' % o)
+
+    def _submit_imapuidcmd(self, cmd, *args, **kwargs):
+        self.log.trace()
+        try:
+            return self.pipeline.uid(cmd, *args, **kwargs)
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+
+    def _imapcmdresult(self, command):
+        '''Wait for a pipelined command to complete and return its
+        untagged responses.
+        '''
+        try:
+            result, resplist = self.pipeline.wait(command)
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
         if result != 'OK':
             raise getmailOperationError(
                 'IMAP error (command %s returned %s %s)'
-                % ('%s %s' % (cmd, args), result, resplist)
+                % (command, result, resplist)
             )
-        self.log.debug('command uid %s response %s'
-                       % ('%s %s' % (cmd, args), resplist) + os.linesep)
+        self.log.debug('command %s response %s' % (command, resplist)
+                       + os.linesep)
         return resplist
 
+    def _parse_imapuidcmdresponse(self, cmd, *args):
+        self.log.trace()
+        return self._imapcmdresult(self._submit_imapuidcmd(cmd, *args))
+
     def _parse_imapattrresponse(self, line):
-        self.log.trace('parsing attributes response line %s' % line
-                       + os.linesep)
+        # Called for every message listed; no trace
         r = {}
         try:
             parts = line[line.index('(') + 1:line.rindex(')')].split()
@@ -1342,14 +1860,38 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 'IMAP error (failed to parse attr response line "%s": %s)' 
                 % (line, o)
             )
-        self.log.trace('got %s' % r + os.linesep)
         return r
 
-    def list_mailboxes(self):
-        '''List (selectable) IMAP folders in account.'''
+    def _parse_imapstatusresponse(self, line):
+        '''Parse a STATUS response line into the (encoded) mailbox name and a
+        dict of status items.  Returns None if the line can't be parsed.
+        '''
+        self.log.trace('parsing status response line %s' % line
+                       + os.linesep)
+        if not isinstance(line, str):
+            # Mailbox name sent as a literal; not worth handling
+            return None
+        m = IMAP_STATUSPARTS.match(line)
+        if not m:
+            return None
+        if m.group('quoted') is not None:
+            mailbox = re.sub(r'\\(.)', r'\1', m.group('quoted'))
+        else:
+            mailbox = m.group('atom')
+        parts = m.group('items').split()
+        if len(parts) % 2:
+            return None
+        status = {}
+        try:
+            while parts:
+                name = parts.pop(0).upper()
+                status[name] = int(parts.pop(0))
+        except ValueError:
+            return None
+        return (mailbox, status)
+
+    def _parse_imaplistresponse(self, resplist):
         mailboxes = []
-        cmd = ('LIST', )
-        resplist = self._parse_imapcmdresponse(*cmd)
         for item in resplist:
             m = IMAP_LISTPARTS.match(item)
             if not m:
@@ -1371,25 +1913,169 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                                             % g['mailbox'])
         return mailboxes
 
+    def list_mailboxes(self):
+        '''List (selectable) IMAP folders in account.'''
+        cmd = ('LIST', )
+        resplist = self._parse_imapcmdresponse(*cmd)
+        return self._parse_imaplistresponse(resplist)
+
+    def list_mailboxes_status(self):
+        '''List (selectable) IMAP folders in account, collecting the status of
+        each in the same command with the LIST-STATUS extension (RFC 5819).
+        '''
+        self.log.trace()
+        items = '(STATUS (%s))' % ' '.join(IMAP_STATUS_ITEMS)
+        self._imap_sync()
+        try:
+            (result, resplist) = self.conn._simple_command(
+                'LIST', '""', '*', 'RETURN', items
+            )
+            (result, resplist) = self.conn._untagged_response(result, resplist,
+                                                              'LIST')
+            (unused, statuslist) = self.conn.response('STATUS')
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+        if result != 'OK':
+            raise getmailOperationError(
+                'IMAP error (command LIST RETURN %s returned %s %s)'
+                % (items, result, resplist)
+            )
+        self.log.debug('command LIST RETURN %s response %s, %s'
+                       % (items, resplist, statuslist) + os.linesep)
+        for line in statuslist:
+            if not line:
+                continue
+            r = self._parse_imapstatusresponse(line)
+            if r:
+                self._listed_status[r[0]] = r[1]
+        return self._parse_imaplistresponse(resplist)
+
+    def _status_skip_allowed(self):
+        '''Unchanged mailboxes can only be skipped if re-processing them would
+        do nothing.  With read_all every message is retrieved again, and with
+        delete_after messages become eligible for deletion as time passes.
+        '''
+        return not (self.app_options['read_all']
+                    or self.app_options['delete_after'])
+
+    def _status_policy(self):
+        # Deletion settings in effect when a mailbox status is recorded; a
+        # mailbox settled without deleting is not settled for a configuration
+        # which deletes.
+        return {
+            'DELETE' : int(bool(self.app_options['delete'])),
+            'DELETEBIGGERTHAN' : self.app_options['delete_bigger_than'] or 0,
+        }
+
+    def _getmailboxstatus(self, mailbox):
+        '''Get current status items for a mailbox (encoded name) from the
+        LIST-STATUS results, or with a STATUS command.
+        '''
+        self.log.trace()
+        if mailbox in self._listed_status:
+            return self._listed_status.pop(mailbox)
+        self._imap_sync()
+        try:
+            (result, resplist) = self.conn.status(
+                mailbox, '(%s)' % ' '.join(IMAP_STATUS_ITEMS)
+            )
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
+        except imaplib.IMAP4.error, o:
+            self.log.debug('STATUS failed (%s)' % o + os.linesep)
+            return {}
+        self.log.debug('command STATUS %s response %s %s'
+                       % (mailbox, result, resplist) + os.linesep)
+        if result != 'OK':
+            return {}
+        for line in resplist:
+            r = self._parse_imapstatusresponse(line)
+            if r:
+                return r[1]
+        return {}
+
+    def _mailbox_unchanged(self, mailbox):
+        '''Return True if the mailbox was settled at the end of the last run
+        and the server reports it hasn't changed since.
+        '''
+        if not self.oldmail_status or not self._status_skip_allowed():
+            return False
+        status = self._getmailboxstatus(mailbox.encode('imap4-utf-7'))
+        for item in IMAP_STATUS_ITEMS:
+            if item not in status:
+                return False
+        current = self._status_policy()
+        for item in IMAP_STATUS_ITEMS:
+            current[item] = status[item]
+        self.log.debug('mailbox status %s, recorded %s'
+                       % (current, self.oldmail_status) + os.linesep)
+        return current == self.oldmail_status
+
+    def _settled_status(self):
+        '''If every message in the selected mailbox has been retrieved (and
+        deleted, if so configured), return the status to record in the oldmail
+        file; otherwise None.
+        '''
+        if (not self._select_status or not self.gotmsglist
+                or not self._status_skip_allowed()):
+            # Messages not listed can't have been retrieved
+            return None
+        delete = self.app_options['delete']
+        delete_bigger_than = self.app_options['delete_bigger_than']
+        deleted = 0
+        for i in xrange(len(self._index)):
+            msgid = self._index[i]
+            if msgid in self.deleted:
+                deleted += 1
+            elif not self.seen(msgid):
+                return None
+            elif delete or (delete_bigger_than 
+                            and self._index.sizes[i] > delete_bigger_than):
+                return None
+        status = self._status_policy()
+        status.update(self._select_status)
+        # Deleted messages are expunged when the mailbox is closed
+        status['MESSAGES'] -= deleted
+        return status
+
     def close_mailbox(self):
+        if self.mailbox_selected is False:
+            # Skipped as unchanged, or never selected
+            return
         # Close current mailbox so deleted mail is expunged.  One getmail
         # user had a buggy IMAP server that didn't do the automatic expunge,
         # so we do it explicitly here.
-        self.conn.expunge()
-        self.conn.close()
+        self.lock.acquire()
+        try:
+            self._retry(self._expunge)
+        finally:
+            self.lock.release()
+        self.mailbox_status = self._settled_status()
         self.write_oldmailfile(self.mailbox_selected)
         # And clear some state
         self.mailbox_selected = False
         self.mailbox = None
         self.uidvalidity = None
-        self.msgnum_by_msgid = {}
-        self.msgid_by_msgnum = {}
-        self.sorted_msgnum_msgid = ()
-        self._mboxuids = {}
-        self._mboxuidorder = []
-        self.msgsizes = {}
-        self.oldmail = {}
+        self._index = mailboxindex()
+        self._listing = []
+        self._listed_to = 0
+        self._msgcount = 0
+        self._select_status = None
+        self.oldmail_status = None
+        self.mailbox_status = None
+        self.oldmail = oldmailmap()
         self.__delivered = {}
+        self._requested = {}
+        self._delete_queue = []
+        self._flagged = array.array(UINT32_TYPECODE)
+
+    def _expunge(self):
+        self._imap_sync()
+        try:
+            self.conn.expunge()
+            self.conn.close()
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
 
     def select_mailbox(self, mailbox):
         self.log.trace()
@@ -1404,8 +2090,37 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         if self.oldmail_exists(mailbox):
             self.read_oldmailfile(mailbox)
 
+        if self._mailbox_unchanged(mailbox):
+            self.log.moreinfo('mailbox "%s" unchanged since last run, skipping'
+                              % mailbox + os.linesep)
+            return 0
+
         self.log.debug('selecting mailbox "%s"' % mailbox + os.linesep)
+        (count, uidvalidity, uidnext) = self._select(mailbox)
+        self.mailbox_selected = mailbox
+        self.log.debug('select(%s) returned message count of %d'
+                       % (mailbox, count) + os.linesep)
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
         try:
+            self._select_status = {
+                'UIDVALIDITY' : int(uidvalidity),
+                'UIDNEXT' : int(uidnext),
+                'MESSAGES' : count,
+            }
+        except (TypeError, ValueError):
+            # No UIDNEXT from server; can't tell if the mailbox changes
+            self._select_status = None
+
+        self._getmsglist(count)
+
+        return count
+
+    def _select(self, mailbox):
+        '''Select mailbox, and return (message count, UIDVALIDITY, UIDNEXT).
+        '''
+        try:
+            self._imap_sync()
             if (self.app_options['delete'] or self.app_options['delete_after'] 
                     or self.app_options['delete_bigger_than']):
                 read_only = False
@@ -1417,10 +2132,12 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 # Specified mailbox doesn't exist, no permissions, etc.
                 raise getmailMailboxSelectError(mailbox)
                 
-            self.mailbox_selected = mailbox
             # use *last* EXISTS returned
             count = int(count[-1])
             uidvalidity = self.conn.response('UIDVALIDITY')[1][0]
+            uidnext = self.conn.response('UIDNEXT')[1][-1]
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
         except imaplib.IMAP4.error, o:
             raise getmailOperationError('IMAP error (%s)' % o)
         except (IndexError, ValueError), o:
@@ -1428,86 +2145,225 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 'IMAP server failed to return correct SELECT response (%s)'
                 % o
             )
-        self.log.debug('select(%s) returned message count of %d'
-                       % (mailbox, count) + os.linesep)
-        self.mailbox = mailbox
-        self.uidvalidity = uidvalidity
+        return (count, uidvalidity, uidnext)
 
-        self._getmsglist(count)
-
-        return count
+    def _reconnect(self):
+        self.log.trace()
+        self.pipeline = None
+        # Not needed until now if the session was taken over from another
+        # retriever
+        self._get_password()
+        self._open_connection()
+        self._login()
+        (count, uidvalidity, unused) = self._select(self.mailbox_selected)
+        self.pipeline = IMAPPipeline(self.conn)
+        if uidvalidity != self.uidvalidity:
+            # The msgids of the messages retrieved so far no longer mean
+            # anything
+            raise getmailOperationError(
+                'UIDVALIDITY of mailbox %s changed from %s to %s while '
+                'reconnecting' % (self.mailbox_selected, self.uidvalidity,
+                                  uidvalidity)
+            )
+        # FETCHes sent ahead are lost with the connection
+        self._requested = {}
+        # Some of the STOREs sent before the connection was lost may not
+        # have reached the server; send them again
+        uids = [str(uid) for uid in self._flagged]
+        while uids:
+            batch = uids[:IMAP_HEADER_BATCH]
+            del uids[:IMAP_HEADER_BATCH]
+            self._submit_imapuidcmd('STORE', ','.join(batch), 'FLAGS',
+                                    '(\Deleted)', deferred=True)
+        if not self.gotmsglist:
+            # Carry on listing from the message after the last one listed.
+            # Messages expunged by another client since would shift the
+            # rest down, so the listing carries on by UID, not by message
+            # number, with the rest of the mailbox listed at once.
+            self._listing = []
+            self._msgcount = count
+            if self._index.uids and count:
+                self._listing.append(self._submit_imapuidcmd(
+                    'FETCH', '%d:*' % (self._index.uids[-1] + 1),
+                    '(UID RFC822.SIZE)', callback=self._listmsg
+                ))
+                self._listed_to = count
+            else:
+                self._listed_to = 0
+                self._request_listing()
+            if not self._listing:
+                self._finish_listing()
+        self.log.info('%s: reconnected' % self + os.linesep)
 
     def _getmsglist(self, msgcount):
+        '''Start listing the messages in the selected mailbox.  The listing
+        is read in windows of IMAP_LIST_WINDOW messages as __getitem__() asks
+        for them, so messages can be retrieved before the whole mailbox has
+        been listed, and no more than a few windows of FETCH responses are
+        held in memory.
+        '''
         self.log.trace()
-        try:
-            if msgcount:
-                # Get UIDs and sizes for all messages in mailbox
-                response = self._parse_imapcmdresponse(
-                    'FETCH', '1:%d' % msgcount, '(UID RFC822.SIZE)'
-                )
-                for line in response:
-                    if not line:
-                        # One user had a server that returned a null response
-                        # somehow -- try to just skip.
-                        continue
-                    r = self._parse_imapattrresponse(line)
-                    # Don't allow / in UIDs we store, as we look for that to 
-                    # detect old-style oldmail files.  Can occur with IMAP, at 
-                    # least with some servers.
-                    uid = r['uid'].replace('/', '-')
-                    msgid = '%s/%s' % (self.uidvalidity, uid)
-                    self._mboxuids[msgid] = r['uid']
-                    self._mboxuidorder.append(msgid)
-                    self.msgnum_by_msgid[msgid] = None
-                    self.msgsizes[msgid] = int(r['rfc822.size'])
+        self._index = mailboxindex(self.uidvalidity)
+        self._msgcount = msgcount
+        self._listed_to = 0
+        self._listing = []
+        self.gotmsglist = False
+        self._request_listing()
+        if not self._listing:
+            self._finish_listing()
 
-            # Remove messages from state file that are no longer in mailbox,
-            # but only if the timestamp for them are old (30 days for now).
-            # This is because IMAP users can have one state file but multiple
-            # IMAP folders in different configuration rc files.
-            for msgid in self.oldmail.keys():
-                timestamp = self.oldmail[msgid]
-                age = self.timestamp - timestamp
-                if not self.msgsizes.has_key(msgid) and age > VANISHED_AGE:
-                    self.log.debug('removing vanished old message id %s' % msgid
-                                   + os.linesep)
-                    del self.oldmail[msgid]
+    def _request_listing(self):
+        '''Send FETCH commands for the next windows of the listing, keeping
+        IMAP_LIST_AHEAD of them in flight.
+        '''
+        while (len(self._listing) < IMAP_LIST_AHEAD
+                and self._listed_to < self._msgcount):
+            first = self._listed_to + 1
+            last = min(self._listed_to + IMAP_LIST_WINDOW, self._msgcount)
+            # Get UIDs and sizes for this window of messages; responses are
+            # added to the index as they arrive
+            self._listing.append(self._submit_imapcmd(
+                'FETCH', '%d:%d' % (first, last), '(UID RFC822.SIZE)',
+                untagged='FETCH', msgnums=(first, last),
+                callback=self._listmsg
+            ))
+            self._listed_to = last
+
+    def _listmsg(self, parts):
+        '''Add a message from a listing FETCH response to the index.'''
+        for line in parts:
+            if not line or not isinstance(line, str):
+                # One user had a server that returned a null response
+                # somehow -- try to just skip.
+                continue
+            r = self._parse_imapattrresponse(line)
+            if not ('uid' in r and 'rfc822.size' in r):
+                # Unsolicited, such as a flag change
+                continue
+            try:
+                uid = int(r['uid'])
+                if (self._index.uids and uid <= self._index.uids[-1]
+                        and '%s/%d' % (self.uidvalidity, uid) in self._index):
+                    # Already listed; UID FETCH n:* after reconnecting
+                    # returns the last message even if its UID is below n
+                    continue
+                self._index.append(uid, int(r['rfc822.size']))
+            except (ValueError, OverflowError), o:
+                raise getmailOperationError(
+                    'IMAP error (bad UID or size in FETCH response "%s": %s)'
+                    % (line, o)
+                )
 
-        except imaplib.IMAP4.error, o:
-            raise getmailOperationError('IMAP error (%s)' % o)
+    def _extend_listing(self):
+        '''Read the next window of the listing.'''
+        self.log.trace()
+        if self._listing:
+            self._imapcmdresult(self._listing.pop(0))
+            self._request_listing()
+        if not self._listing:
+            self._finish_listing()
+
+    def _finish_listing(self):
+        self.log.debug('listed %d messages' % len(self._index) + os.linesep)
+        self._remove_vanished(self._index)
         self.gotmsglist = True
 
+    def __len__(self):
+        if self.gotmsglist:
+            return len(self._index)
+        # Still listing; the count from SELECT
+        return self._msgcount
+
     def __getitem__(self, i):
-        return self._mboxuidorder[i]
+        if i >= len(self._index) and not self.gotmsglist:
+            # The prefetch thread may be using the connection
+            self.lock.acquire()
+            try:
+                while i >= len(self._index) and not self.gotmsglist:
+                    self._retry(self._extend_listing)
+            finally:
+                self.lock.release()
+        return self._index[i]
+
+    def _getmsgsizebyid(self, msgid):
+        size = self._index.size(msgid)
+        if size is None:
+            raise KeyError(msgid)
+        return size
+
+    def delmsg(self, msgid):
+        '''Queue a message for deletion.  Queued messages are flagged as
+        deleted by whichever thread next uses the connection, so deleting
+        never waits for a retrieval in progress in another thread.
+        '''
+        self._getmboxuidbymsgid(msgid)
+        self._delete_queue.append(msgid)
+        self.deleted[msgid] = True
 
     def _delmsgbyid(self, msgid):
         self.log.trace()
+        self._delete_queue.append(msgid)
+        self._flush_deletes()
+
+    def _flush_deletes(self):
+        '''Send the commands to delete the queued messages.'''
+        if not self._delete_queue:
+            return
         try:
-            uid = self._getmboxuidbymsgid(msgid)
-            #self._selectmailbox(mailbox)
-            # Delete message
-            if self.conf['move_on_delete']:
-                self.log.debug('copying message to folder "%s"'
-                               % self.conf['move_on_delete'] + os.linesep)
-                response = self._parse_imapuidcmdresponse(
-                    'COPY', uid, self.conf['move_on_delete']
-                )
-            self.log.debug('deleting message "%s"' % uid + os.linesep)
-            response = self._parse_imapuidcmdresponse(
-                'STORE', uid, 'FLAGS', '(\Deleted)'
-            )
+            # Other threads only ever append to the queue.  Messages stay in
+            # it until their STORE has been sent, so none are forgotten if
+            # the connection is lost.
+            while self._delete_queue:
+                batch = self._delete_queue[:IMAP_HEADER_BATCH]
+                uids = ','.join([self._getmboxuidbymsgid(msgid)
+                                 for msgid in batch])
+                if self.conf['move_on_delete']:
+                    self.log.debug('copying messages %s to folder "%s"'
+                                   % (uids, self.conf['move_on_delete'])
+                                   + os.linesep)
+                    # The copy must be known to have succeeded before the
+                    # messages are marked for deletion
+                    self._parse_imapuidcmdresponse(
+                        'COPY', uids, self.conf['move_on_delete']
+                    )
+                self.log.debug('deleting messages %s' % uids + os.linesep)
+                # Nothing waits for this to complete; a failure is reported
+                # when the pipeline is next synchronized, before the mailbox
+                # is expunged.
+                self._submit_imapuidcmd('STORE', uids, 'FLAGS', '(\Deleted)',
+                                        deferred=True)
+                del self._delete_queue[:len(batch)]
+                self._flagged.extend([int(uid) for uid in uids.split(',')])
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
         except imaplib.IMAP4.error, o:
             raise getmailOperationError('IMAP error (%s)' % o)
 
-    def _getmsgpartbyid(self, msgid, part):
+    def _fetchmsgpart(self, msgid, part):
+        '''Send the UID FETCH command for part of a message.'''
+        uid = self._getmboxuidbymsgid(msgid)
+        # google extensions: ask for labels, etc. in the same FETCH as the
+        # message itself instead of making a second round trip for them
+        if 'X-GM-EXT-1' in self.conn.capabilities:
+            part = '%s %s)' % (part[:-1], GMAIL_FETCH_ITEMS)
+        # Retrieve message
+        self.log.debug('retrieving body for message "%s"' % uid
+                       + os.linesep)
+        return self._submit_imapuidcmd('FETCH', uid, part)
+
+    def _getmsgpartbyid(self, msgid, part, command=None):
+        '''Retrieve part of a message, with the FETCH command already sent
+        for it, if any.
+        '''
         self.log.trace()
         try:
-            uid = self._getmboxuidbymsgid(msgid)
-            # Retrieve message
-            self.log.debug('retrieving body for message "%s"' % uid
-                           + os.linesep)
+            gmail = 'X-GM-EXT-1' in self.conn.capabilities
             try:
-                response = self._parse_imapuidcmdresponse('FETCH', uid, part)
+                if command is None:
+                    command = self._fetchmsgpart(msgid, part)
+                response = self._imapcmdresult(command)
+            except getmailConnectionError:
+                raise
             except (imaplib.IMAP4.error, getmailOperationError), o:
                 # server gave a negative/NO response, most likely.  Bad server,
                 # no doughnut.
@@ -1525,86 +2381,172 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             #   ')',
             #   <maybe more>
             # ]
+            #
+            # With the Gmail items requested as well, they can show up either
+            # before the literal or in the trailing ')' part:
+            #
+            #   (
+            #       '1 (X-GM-THRID 1 X-GM-MSGID 2 X-GM-LABELS () UID 1 '
+            #           'BODY[] {704}',
+            #       'message text here with CRLF EOL'
+            #   ),
+            #   ')'
             
-            # MSExchange is broken -- if a message is badly formatted enough
-            # (virus, spam, trojan), it can completely fail to return the
-            # message when requested.
-            try:
-                try:
-                    sbody = response[0][1]
-                except Exception, o:
-                    sbody = None
-                if not sbody:
-                    self.log.error('bad message from server!')
-                    sbody = str(response)
-                msg = Message(fromstring=sbody)
-            except TypeError, o:
-                # response[0] is None instead of a message tuple
-                raise getmailRetrievalError('failed to retrieve msgid %s' 
-                                            % msgid)
-
-            # record mailbox retrieved from in a header
-            msg.add_header('X-getmail-retrieved-from-mailbox', 
-                           self.mailbox_selected)
-
-            # google extensions: apply labels, etc
-            if 'X-GM-EXT-1' in self.conn.capabilities:
-                metadata = self._getgmailmetadata(uid, msg)
-                for (header, value) in metadata.items():
-                    msg.add_header(header, value)
-
-            return msg
+            return self._msgfromresponse(msgid, response, gmail)
 
         except imaplib.IMAP4.error, o:
             raise getmailOperationError('IMAP error (%s)' % o)
 
-    def _getgmailmetadata(self, uid, msg):
+    def _msgfromresponse(self, msgid, response, gmail):
+        '''Construct a Message from the FETCH response for one message.'''
+        # MSExchange is broken -- if a message is badly formatted enough
+        # (virus, spam, trojan), it can completely fail to return the
+        # message when requested.
+        try:
+            try:
+                sbody = response[0][1]
+            except Exception, o:
+                sbody = None
+            if not sbody:
+                self.log.error('bad message from server!')
+                sbody = str(response)
+            msg = Message(fromstring=sbody)
+        except TypeError, o:
+            # response[0] is None instead of a message tuple
+            raise getmailRetrievalError('failed to retrieve msgid %s' 
+                                        % msgid)
+
+        # record mailbox retrieved from in a header
+        msg.add_header('X-getmail-retrieved-from-mailbox', 
+                       self.mailbox_selected)
+
+        # google extensions: apply labels, etc
+        if gmail:
+            metadata = self._parse_gmailmetadata(response)
+            for (header, value) in metadata.items():
+                msg.add_header(header, value)
+
+        self._setenvelope(msgid, msg)
+        return msg
+
+    def prefetch_headers(self, msgids):
+        '''Retrieve the headers of many messages with a few UID FETCH commands
+        instead of one per message.
+        '''
+        self.log.trace()
+        msgid_by_uid = {}
+        for msgid in msgids:
+            if msgid not in self.headercache:
+                msgid_by_uid[self._getmboxuidbymsgid(msgid)] = msgid
+        if not msgid_by_uid:
+            return
+        if self.conf.get('use_peek', True):
+            part = '(BODY.PEEK[header])'
+        else:
+            part = '(RFC822[header])'
+        gmail = 'X-GM-EXT-1' in self.conn.capabilities
+        if gmail:
+            part = '%s %s)' % (part[:-1], GMAIL_FETCH_ITEMS)
+        uids = sorted(msgid_by_uid.keys(), key=int)
+        # Send all the FETCH commands before reading any of the responses
+        commands = []
+        try:
+            while uids:
+                batch = uids[:IMAP_HEADER_BATCH]
+                del uids[:IMAP_HEADER_BATCH]
+                self.log.debug('retrieving headers for %d messages'
+                               % len(batch) + os.linesep)
+                commands.append(self._submit_imapuidcmd(
+                    'FETCH', ','.join(batch), part
+                ))
+        except (socket.error, getmailConnectionError), o:
+            # getheader() reconnects, if configured to, and retrieves them
+            # individually
+            self.log.debug('connection lost during bulk header FETCH (%s)'
+                           % o + os.linesep)
+            return
+        for command in commands:
+            try:
+                response = self._imapcmdresult(command)
+            except (socket.error, getmailConnectionError), o:
+                self.log.debug('connection lost during bulk header FETCH '
+                               '(%s)' % o + os.linesep)
+                return
+            except getmailOperationError, o:
+                # Leave these for getheader() to retrieve individually
+                self.log.debug('bulk header FETCH failed (%s)' % o
+                               + os.linesep)
+                continue
+            # Split the response into the parts for each message; each
+            # starts with a (attributes, literal) tuple.
+            parts = []
+            for item in response:
+                if isinstance(item, tuple):
+                    parts.append([item])
+                elif parts and isinstance(item, str):
+                    parts[-1].append(item)
+            for msgresponse in parts:
+                m = IMAP_UID_RE.search(' '.join([
+                    (isinstance(item, tuple) and item[0]) or item
+                    for item in msgresponse
+                ]))
+                msgid = m and msgid_by_uid.get(m.group(1))
+                if msgid is None:
+                    continue
+                self.headercache[msgid] = self._msgfromresponse(
+                    msgid, msgresponse, gmail
+                )
+
+    def _parse_gmailmetadata(self, response):
         """
-        Add Gmail labels and other metadata which Google exposes through an
-        IMAP extension to headers in the message.
+        Extract Gmail labels and other metadata which Google exposes through an
+        IMAP extension from a FETCH response, for adding to the message header.
         
         See https://developers.google.com/google-apps/gmail/imap_extensions
         """
-        try:
-            # ['976 (X-GM-THRID 1410134259107225671 X-GM-MSGID '
-            #   '1410134259107225671 X-GM-LABELS (labels space '
-            #   'separated) UID 167669)']
-            response = self._parse_imapuidcmdresponse('FETCH', uid,
-                '(X-GM-LABELS X-GM-THRID X-GM-MSGID)')
-        except imaplib.IMAP4.error, o:
-            self.log.warning('Could not fetch google imap extensions: %s' % o)
-            return {}
+        # The items are in the non-literal parts of the response, in whatever
+        # order the server chose to send them.
+        attrs = []
+        for item in response:
+            if isinstance(item, tuple):
+                attrs.append(item[0])
+            elif isinstance(item, str):
+                attrs.append(item)
+        attrs = ' '.join(attrs)
 
-        if not response:
-            return {}
-            
-        ext = re.search(
-            'X-GM-THRID (?P<THRID>\d+) X-GM-MSGID (?P<MSGID>\d+)'
-            ' X-GM-LABELS \((?P<LABELS>.*)\) UID',
-            response[0]
-        )
-        if not ext:
+        metadata = {}
+        for (item, regex) in GMAIL_METADATA_RE:
+            m = regex.search(attrs)
+            if m and m.group(1):
+                metadata['X-GMAIL-%s' % item] = m.group(1)
+        if not metadata:
             self.log.warning(
                 'Could not parse google imap extensions. Server said: %s'
-                % repr(response)
+                % repr(attrs) + os.linesep
             )
-            return {}
-
-        results = ext.groupdict()
-        metadata = {}
-        for item in ('LABELS', 'THRID', 'MSGID'):
-            if item in results and results[item]:
-                metadata['X-GMAIL-%s' % item] = results[item]
 
         return metadata
 
+    def _msgpart(self):
+        if self.conf.get('use_peek', True):
+            return '(BODY.PEEK[])'
+        return '(RFC822)'
+
+    def _requestmsgbyid(self, msgid):
+        self._flush_deletes()
+        if msgid in self._requested:
+            return True
+        if len(self._requested) >= self.pipeline.depth - 1:
+            # Leave room in the pipeline for other commands
+            return False
+        self._requested[msgid] = self._fetchmsgpart(msgid, self._msgpart())
+        return True
+
     def _getmsgbyid(self, msgid):
         self.log.trace()
-        if self.conf.get('use_peek', True):
-            part = '(BODY.PEEK[])'
-        else:
-            part = '(RFC822)'
-        return self._getmsgpartbyid(msgid, part)
+        self._flush_deletes()
+        return self._getmsgpartbyid(msgid, self._msgpart(),
+                                    self._requested.pop(msgid, None))
 
     def _getheaderbyid(self, msgid):
         self.log.trace()
@@ -1617,36 +2559,14 @@ class IMAPRetrieverBase(RetrieverSkeleton):
     def initialize(self, options):
         self.log.trace()
         self.mailboxes = self.conf.get('mailboxes', ('INBOX', ))
-        # Handle password
-        if (self.conf.get('password', None) is None
-                and not (HAVE_KERBEROS_GSS and self.conf['use_kerberos'])):
-            self.conf['password'] = get_password(
-                self, self.conf['username'], self.conf['server'], 
-                self.received_with, self.log
-            )
-            
         RetrieverSkeleton.initialize(self, options)
         try:
-            self.log.trace('trying self._connect()' + os.linesep)
-            self._connect()
-            try:
-                self.log.trace('logging in' + os.linesep)
-                if self.conf['use_kerberos'] and HAVE_KERBEROS_GSS:
-                    self.conn.authenticate('GSSAPI', self.gssauth)
-                elif self.conf['use_cram_md5']:
-                    self._parse_imapcmdresponse(
-                        'login_cram_md5', self.conf['username'],
-                        self.conf['password']
-                    )
-                else:
-                    self._parse_imapcmdresponse('login', self.conf['username'],
-                                                self.conf['password'])
-            except imaplib.IMAP4.abort, o:
-                raise getmailLoginRefusedError(o)
-            except imaplib.IMAP4.error, o:
-                raise getmailCredentialError(o)
-
-            self.log.trace('logged in' + os.linesep)
+            if not self._adopt_session():
+                self._get_password()
+                self.log.trace('trying self._connect()' + os.linesep)
+                self._open_connection()
+                self._login()
+            self.pipeline = IMAPPipeline(self.conn)
             """
             self.log.trace('logged in, getting message list' + os.linesep)
             self._getmsglist()
@@ -1665,21 +2585,20 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                                    + os.linesep)
                     del self.oldmail[msgid]
             """
-            # Some IMAP servers change the available capabilities after 
-            # authentication, i.e. they present a limited set before login.
-            # The Python stlib IMAP4 class doesn't take this into account
-            # and just checks the capabilities immediately after connecting.
-            # Force a re-check now that we've authenticated.
-            (typ, dat) = self.conn.capability()
-            if dat == [None]:
-                # No response, don't update the stored capabilities
-                self.log.warn('no post-login CAPABILITY response from server\n')
-            else:
-                self.conn.capabilities = tuple(dat[-1].upper().split())
 
-            if 'IDLE' in self.conn.capabilities:
-                self.supports_idle = True
-                imaplib.Commands['IDLE'] = ('AUTH', 'SELECTED')
+            if ('LIST-STATUS' in self.conn.capabilities
+                    and self._status_skip_allowed()
+                    and (len(self.mailboxes) > 1
+                         or self.mailboxes == ('ALL', ))):
+                # Get the status of all mailboxes in one round trip instead
+                # of a STATUS command for each
+                try:
+                    mailboxes = self.list_mailboxes_status()
+                except getmailOperationError, o:
+                    self.log.debug('LIST-STATUS failed (%s)' % o + os.linesep)
+                    mailboxes = None
+                if mailboxes is not None and self.mailboxes == ('ALL', ):
+                    self.mailboxes = tuple(mailboxes)
 
             if self.mailboxes == ('ALL', ):
                 # Special value meaning all mailboxes in account
@@ -1688,16 +2607,143 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         except imaplib.IMAP4.error, o:
             raise getmailOperationError('IMAP error (%s)' % o)
 
+    def _get_password(self):
+        '''Get the password, if it isn't configured and will be needed to log
+        in.
+        '''
+        if (self.conf.get('password', None) is None
+                and not (HAVE_KERBEROS_GSS and self.conf['use_kerberos'])):
+            self.conf['password'] = get_password(
+                self, self.conf['username'], self.conf['server'], 
+                self.received_with, self.log
+            )
+
+    def session_key(self):
+        if self._credentials is None:
+            # Taken before the password is looked up or prompted for, so the
+            # key stays the same once it has been; only a digest is kept
+            self._credentials = sha1(repr(
+                (self.conf.get('password', None),
+                 self.conf.get('passwordeval', None))
+            )).hexdigest()
+        return ((self.SSL, self.conf['server'], self.conf['port'],
+                 self.conf['username'], self._credentials)
+                + tuple([self.conf.get(name, None)
+                         for name in IMAP_SESSION_PARAMETERS]))
+
+    def use_session(self, session):
+        '''Take over session, an IMAPSession released by a retriever with the
+        same session_key(), when initialized, instead of connecting and
+        logging in.
+        '''
+        self._session = session
+
+    def _adopt_session(self):
+        '''Take over the session given to use_session(), if there is one and
+        the server still answers on it.  Returns True if it was taken over.
+        '''
+        session = self._session
+        self._session = None
+        if session is None:
+            return False
+        try:
+            (typ, dat) = session.conn.noop()
+            if typ != 'OK':
+                raise imaplib.IMAP4.error('NOOP returned %s %s' % (typ, dat))
+        except (imaplib.IMAP4.error, socket.error), o:
+            self.log.debug('%s unusable (%s), connecting again'
+                           % (session, o) + os.linesep)
+            session.close()
+            return False
+        self.conn = session.conn
+        self.received_from = session.received_from
+        self.supports_idle = session.supports_idle
+        self.log.debug('reusing %s' % session + os.linesep)
+        return True
+
+    def release_session(self):
+        '''End the session as quit() does, but without logging out, and
+        return it as an IMAPSession for use_session() of a retriever with
+        the same session_key().  Returns None if there is no session.
+        '''
+        self.log.trace()
+        if not self.conn:
+            return None
+        session = None
+        try:
+            if self.mailbox_selected is not False:
+                self.close_mailbox()
+            self._imap_sync()
+            session = IMAPSession(self.conn, self.received_from,
+                                  self.supports_idle)
+        except imaplib.IMAP4.error, o:
+            self.log.warning('IMAP error ending session (%s)' % o
+                             + os.linesep)
+            try:
+                self.conn.logout()
+            except (imaplib.IMAP4.error, socket.error):
+                pass
+        RetrieverSkeleton.quit(self)
+        self.conn = None
+        self.pipeline = None
+        return session
+
+    def _login(self):
+        '''Log in on a new connection.'''
+        try:
+            self.log.trace('logging in' + os.linesep)
+            if self.conf['use_kerberos'] and HAVE_KERBEROS_GSS:
+                self.conn.authenticate('GSSAPI', self.gssauth)
+            elif self.conf['use_cram_md5']:
+                self._parse_imapcmdresponse(
+                    'login_cram_md5', self.conf['username'],
+                    self.conf['password']
+                )
+            else:
+                self._parse_imapcmdresponse('login', self.conf['username'],
+                                            self.conf['password'])
+        except imaplib.IMAP4.abort, o:
+            raise getmailLoginRefusedError(o)
+        except imaplib.IMAP4.error, o:
+            raise getmailCredentialError(o)
+
+        self.log.trace('logged in' + os.linesep)
+        # Some IMAP servers change the available capabilities after 
+        # authentication, i.e. they present a limited set before login.
+        # The Python stlib IMAP4 class doesn't take this into account
+        # and just checks the capabilities immediately after connecting.
+        # Force a re-check now that we've authenticated.
+        try:
+            (typ, dat) = self.conn.capability()
+        except imaplib.IMAP4.abort, o:
+            raise getmailConnectionError('IMAP error (%s)' % o)
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+        if dat == [None]:
+            # No response, don't update the stored capabilities
+            self.log.warn('no post-login CAPABILITY response from server\n')
+        else:
+            self.conn.capabilities = tuple(dat[-1].upper().split())
+
+        if 'IDLE' in self.conn.capabilities:
+            self.supports_idle = True
+            imaplib.Commands['IDLE'] = ('AUTH', 'SELECTED')
+
     def abort(self):
         self.log.trace()
         RetrieverSkeleton.abort(self)
+        if self._session is not None:
+            # Never taken over
+            self._session.close()
+            self._session = None
         if not self.conn:
             return
         try:
             self.quit()
-        except (imaplib.IMAP4.error, socket.error), o:
+        except (imaplib.IMAP4.error, socket.error, getmailOperationError), o:
             pass
         self.conn = None
+        self.pipeline = None
 
     def go_idle(self, folder, timeout=300):
         """Initiates IMAP's IDLE mode if the server supports it
@@ -1724,6 +2770,7 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             sock = self.conn.socket()
 
         # Based on current imaplib IDLE patch: http://bugs.python.org/issue11245
+        self._imap_sync()
         self.conn.untagged_responses = {}
         self.conn.select(folder)
         tag = self.conn._command('IDLE')
@@ -1772,12 +2819,14 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         try:
             if self.mailbox_selected is not False:
                 self.close_mailbox()
+            self._imap_sync()
             self.conn.logout()
         except imaplib.IMAP4.error, o:
             #raise getmailOperationError('IMAP error (%s)' % o)
             self.log.warning('IMAP error during logout (%s)' % o + os.linesep)
         RetrieverSkeleton.quit(self)
         self.conn = None
+        self.pipeline = None
 
 
 #######################################
@@ -1817,29 +2866,352 @@ class MultidropIMAPRetrieverBase(IMAPRetrieverBase):
                 'invalid envelope_recipient specification format (%s)' % o
             )
 
-    def _getmsgbyid(self, msgid):
+    def _setenvelope(self, msgid, msg):
         self.log.trace()
-        msg = IMAPRetrieverBase._getmsgbyid(self, msgid)
-        data = {}
-        for (name, encoded_value) in msg.headers():
-            name = name.lower()
-            for (val, encoding) in decode_header(encoded_value):
-                val = val.strip()
-                if name in data:
-                    data[name].append(val)
-                else:
-                    data[name] = [val]
-
+        values = []
+        # Only the fields wanted are decoded
+        for encoded_value in msg.header_fields(
+            (self.envrecipname, )
+        )[self.envrecipname]:
+            values.extend([val.strip() for (val, encoding)
+                           in decode_header(encoded_value)])
+            if len(values) > self.envrecipnum:
+                break
         try:
-            line = data[self.envrecipname][self.envrecipnum]
-        except (KeyError, IndexError), unused:
+            line = values[self.envrecipnum]
+        except IndexError:
             raise getmailConfigurationError(
                 'envelope_recipient specified header missing (%s)'
                 % self.conf['envelope_recipient']
             )
         msg.recipient = address_no_brackets(line.strip())
+
+
+#######################################
+class LocalRetrieverBase(RetrieverSkeleton):
+    '''Base class for retrievers reading a local message store rather than a
+    server.
+
+    There is no connection to make, and a store is a single mailbox.  Its
+    path, which is also reported as where messages were received from, takes
+    the place of the server and username in the name of the oldmail file.
+    '''
+    def __init__(self, **args):
+        RetrieverSkeleton.__init__(self, **args)
+        self.log.trace()
+
+    def _oldmail_basename(self):
+        return 'oldmail-%s-%s' % (self.received_with.lower(),
+                                  self.conf['path'])
+
+    def initialize(self, options):
+        self.log.trace()
+        # Local stores don't have different mailboxes
+        self.mailboxes = (None, )
+        RetrieverSkeleton.initialize(self, options)
+        self.received_from = self.conf['path']
+
+    def select_mailbox(self, mailbox):
+        assert mailbox is None, (
+            'local stores do not support mailbox selection (%s)' % mailbox
+        )
+        if self.mailbox_selected is not False:
+            self.write_oldmailfile(self.mailbox_selected)
+
+        self._clear_state()
+
+        if self.oldmail_exists(mailbox):
+            self.read_oldmailfile(mailbox)
+        self.mailbox_selected = mailbox
+
+        self._getmsglist()
+
+    def _setlist(self, msgids):
+        '''Record the messages found in the store, in the order given.'''
+        self.sorted_msgnum_msgid = [(i + 1, msgid)
+                                    for (i, msgid) in enumerate(msgids)]
+        for (msgnum, msgid) in self.sorted_msgnum_msgid:
+            self.msgnum_by_msgid[msgid] = msgnum
+            self.msgid_by_msgnum[msgnum] = msgid
+        self.log.debug('got %d message IDs' % len(msgids) + os.linesep)
+        self._remove_vanished(self.msgnum_by_msgid)
+        self.gotmsglist = True
+
+
+#######################################
+class MaildirRetrieverBase(LocalRetrieverBase):
+    '''Base class for retrievers reading messages from a maildir.
+
+    A message's ID is the unique part of the name of its file, which stays
+    the same when a mail reader moves the file from new to cur or changes
+    its flags.  Messages are listed in the order they were delivered in.
+    Sizes are taken from the ",S=" part of file names which have one; other
+    files are only stat()ed when their sizes are needed.  Deleting a message
+    removes its file.
+    '''
+    def _clear_state(self):
+        LocalRetrieverBase._clear_state(self)
+        # Names of message files, relative to the maildir, by msgid
+        self.msgfiles = {}
+
+    def _getmsglist(self):
+        self.log.trace()
+        msglist = []
+        for subdir in MAILDIR_SUBDIRS:
+            path = os.path.join(self.conf['path'], subdir)
+            try:
+                names = os.listdir(path)
+            except OSError, o:
+                raise getmailOperationError('failed to list %s (%s)'
+                                            % (path, o))
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                msgid = name.split(MAILDIR_INFO_SEP, 1)[0]
+                if msgid in self.msgfiles:
+                    self.log.debug('ignoring %s/%s, a copy of %s'
+                                   % (subdir, name, self.msgfiles[msgid])
+                                   + os.linesep)
+                    continue
+                self.msgfiles[msgid] = os.path.join(subdir, name)
+                # Unique parts start with the time of delivery
+                secs = msgid.split('.', 1)[0]
+                if secs.isdigit():
+                    msglist.append((int(secs), msgid))
+                else:
+                    msglist.append((0, msgid))
+        msglist.sort()
+        self._setlist([msgid for (unused, msgid) in msglist])
+
+    def _findmsg(self, msgid):
+        '''Look for the file of a message which has been moved or renamed
+        since the maildir was listed.  Returns True if it was found.
+        '''
+        for subdir in MAILDIR_SUBDIRS:
+            try:
+                names = os.listdir(os.path.join(self.conf['path'], subdir))
+            except OSError:
+                continue
+            for name in names:
+                if name.split(MAILDIR_INFO_SEP, 1)[0] == msgid:
+                    self.msgfiles[msgid] = os.path.join(subdir, name)
+                    return True
+        return False
+
+    def _openmsg(self, msgid):
+        filename = self.msgfiles[msgid]
+        try:
+            try:
+                return open(os.path.join(self.conf['path'], filename), 'rb')
+            except IOError, o:
+                if o.errno != errno.ENOENT or not self._findmsg(msgid):
+                    raise
+                return open(os.path.join(self.conf['path'],
+                                         self.msgfiles[msgid]), 'rb')
+        except IOError, o:
+            raise getmailRetrievalError('failed to open %s (%s)'
+                                        % (filename, o))
+
+    def _getmsgsizebyid(self, msgid):
+        if msgid in self.msgsizes:
+            return self.msgsizes[msgid]
+        match = MAILDIR_SIZE_RE.search(msgid)
+        if match:
+            size = int(match.group(1))
+        else:
+            f = self._openmsg(msgid)
+            try:
+                size = os.fstat(f.fileno()).st_size
+            finally:
+                f.close()
+        self.msgsizes[msgid] = size
+        return size
+
+    def _getmsgbyid(self, msgid):
+        self.log.debug('msgid %s' % msgid + os.linesep)
+        f = self._openmsg(msgid)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        msg = Message(fromstring=data or os.linesep)
+        self._setenvelope(msgid, msg)
+        return msg
+
+    def _getheaderbyid(self, msgid):
+        self.log.trace()
+        f = self._openmsg(msgid)
+        try:
+            lines = []
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line:
+                    break
+                lines.append(line)
+        finally:
+            f.close()
+        msg = Message(fromlines=lines + [''])
+        self._setenvelope(msgid, msg)
+        return msg
+
+    def _delmsgbyid(self, msgid):
+        self.log.trace()
+        filename = self.msgfiles[msgid]
+        try:
+            try:
+                os.unlink(os.path.join(self.conf['path'], filename))
+            except OSError, o:
+                if o.errno != errno.ENOENT or not self._findmsg(msgid):
+                    raise
+                os.unlink(os.path.join(self.conf['path'],
+                                       self.msgfiles[msgid]))
+        except OSError, o:
+            raise getmailOperationError('failed to delete %s (%s)'
+                                        % (filename, o))
+
+
+#######################################
+class MboxRetrieverBase(LocalRetrieverBase):
+    '''Base class for retrievers reading messages from an mbox file.
+
+    The file is memory-mapped and scanned for From_ lines once, when the
+    mailbox is selected, and messages are then copied out of the map as they
+    are retrieved, with the mboxrd quoting of From_ lines in their bodies
+    undone.  The file is locked against writers (with a shared lock of the
+    same type the Mboxrd destination takes) until the session ends.
+
+    mbox files don't give messages identifiers, so a message's ID is a digest
+    of its From_ line and header, leaving out the header fields mail readers
+    add or rewrite (see MBOX_VOLATILE_FIELDS_RE).  Copies of a message are
+    told apart by their order in the file.  Messages can't be deleted.
+    '''
+    def __init__(self, **args):
+        self.mboxfile = None
+        self.mbox = None
+        LocalRetrieverBase.__init__(self, **args)
+
+    def _clear_state(self):
+        LocalRetrieverBase._clear_state(self)
+        self._close_mbox()
+        # (From_ line start, message start, header end, message end) in the
+        # file, by msgid
+        self.msgranges = {}
+
+    def initialize(self, options):
+        self.log.trace()
+        if self.conf['locktype'] not in ('lockf', 'flock'):
+            raise getmailConfigurationError('unknown mbox lock type: %s'
+                                            % self.conf['locktype'])
+        if (options.get('delete') or options.get('delete_after')
+                or options.get('delete_bigger_than')):
+            raise getmailConfigurationError(
+                '%s cannot delete messages; unset delete, delete_after, and '
+                'delete_bigger_than' % self
+            )
+        LocalRetrieverBase.initialize(self, options)
+
+    def _open_mbox(self):
+        path = self.conf['path']
+        try:
+            self.mboxfile = open(path, 'rb')
+            if self.conf['locktype'] == 'flock':
+                fcntl.flock(self.mboxfile, fcntl.LOCK_SH)
+            else:
+                fcntl.lockf(self.mboxfile, fcntl.LOCK_SH)
+            size = os.fstat(self.mboxfile.fileno()).st_size
+            # An empty file can't be mapped, and has no messages
+            if size:
+                self.mbox = mmap.mmap(self.mboxfile.fileno(), size,
+                                      access=mmap.ACCESS_READ)
+        except EnvironmentError, o:
+            self._close_mbox()
+            raise getmailOperationError('failed to read mbox %s (%s)'
+                                        % (path, o))
+
+    def _close_mbox(self):
+        if self.mbox is not None:
+            self.mbox.close()
+            self.mbox = None
+        if self.mboxfile is not None:
+            # Closing the file releases the lock
+            self.mboxfile.close()
+            self.mboxfile = None
+
+    def _getmsglist(self):
+        self.log.trace()
+        self._open_mbox()
+        mbox = self.mbox
+        msgids = []
+        if mbox is not None:
+            if mbox[:5] != 'From ':
+                raise getmailOperationError('%s is not an mbox file'
+                                            % self.conf['path'])
+            starts = []
+            pos = 0
+            while pos >= 0:
+                starts.append(pos)
+                pos = mbox.find('\nFrom ', pos)
+                if pos >= 0:
+                    pos += 1
+            starts.append(len(mbox))
+            copies = {}
+            for i in xrange(len(starts) - 1):
+                (start, end) = (starts[i], starts[i + 1])
+                msgstart = mbox.find('\n', start, end) + 1 or end
+                # The blank line before the next From_ line is not part of
+                # the message
+                if end - msgstart >= 2 and mbox[end - 2:end] == '\n\n':
+                    end -= 1
+                headerend = mbox.find('\n\n', msgstart, end) + 1 or end
+                digest = sha1(mbox[start:msgstart])
+                digest.update(MBOX_VOLATILE_FIELDS_RE.sub(
+                    '', mbox[msgstart:headerend]
+                ))
+                msgid = digest.hexdigest()
+                copies[msgid] = copies.get(msgid, 0) + 1
+                if copies[msgid] > 1:
+                    msgid = '%s.%d' % (msgid, copies[msgid])
+                self.msgranges[msgid] = (start, msgstart, headerend, end)
+                self.msgsizes[msgid] = end - msgstart
+                msgids.append(msgid)
+        self._setlist(msgids)
+
+    def _msgrange(self, msgid):
+        if self.mbox is None or msgid not in self.msgranges:
+            raise getmailOperationError('no such message ID %s' % msgid)
+        return self.msgranges[msgid]
+
+    def _setsender(self, msg, start, msgstart):
+        '''Take the sender from the From_ line, if the message has no
+        Return-Path: header field.
+        '''
+        if msg.sender != 'unknown':
+            return
+        parts = self.mbox[start:msgstart].split(None, 2)
+        if len(parts) > 1:
+            msg.sender = address_no_brackets(parts[1])
+
+    def _getmsgbyid(self, msgid):
+        self.log.debug('msgid %s' % msgid + os.linesep)
+        (start, msgstart, headerend, end) = self._msgrange(msgid)
+        msg = Message(fromstring=MBOX_QUOTED_FROMLINE_RE.sub(
+            r'\1', self.mbox[msgstart:end]
+        ) or os.linesep)
+        self._setsender(msg, start, msgstart)
+        self._setenvelope(msgid, msg)
         return msg
 
+    def _getheaderbyid(self, msgid):
+        self.log.trace()
+        (start, msgstart, headerend, end) = self._msgrange(msgid)
+        msg = Message(fromstring=self.mbox[msgstart:headerend] + os.linesep)
+        self._setsender(msg, start, msgstart)
+        self._setenvelope(msgid, msg)
+        return msg
+
+    def _delmsgbyid(self, msgid):
+        raise getmailOperationError('%s cannot delete messages' % self)
+
 
 # Choose right POP-over-SSL mix-in based on Python version being used.
 if sys.hexversion >= 0x02040000:
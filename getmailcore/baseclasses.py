@@ -22,15 +22,30 @@ __all__ = [
 
 import sys
 import os
-import time
-import signal
 import types
+import errno
+import fcntl
+import select
+import tempfile
+import threading
 
 from getmailcore.exceptions import *
 from getmailcore.compatibility import *
 import getmailcore.logging
 from getmailcore.utilities import eval_bool, expand_user_vars
 
+# Size of reads from and writes to pipes connected to child processes
+PIPE_CHUNK = 65536
+
+# Held while creating a child's pipes and forking it, so that when children
+# are run from several threads, none inherits another's pipes
+_fork_lock = threading.Lock()
+
+#######################################
+def _set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
 #
 # Base classes
 #
@@ -341,57 +356,192 @@ class ForkingBase(object):
         log - an object of type getmailcore.logging.Logger()
 
     '''
-    def _child_handler(self, sig, stackframe):
-        self.log.trace('handler called for signal %s' % sig)
-        try:
-            pid, r = os.wait()
-        except OSError, o:
-            # No children on SIGCHLD.  Can't happen?
-            self.log.warning('handler called, but no children (%s)' % o)
-            return
-        signal.signal(signal.SIGCHLD, self.__orig_handler)
-        self.__child_pid = pid
-        self.__child_status = r
-        self.log.trace('handler reaped child %s with status %s' % (pid, r))
-        self.__child_exited = True
-
-    def _prepare_child(self):
-        self.log.trace('')
-        self.__child_exited = False
-        self.__child_pid = None
-        self.__child_status = None
-        self.__orig_handler = signal.signal(signal.SIGCHLD, self._child_handler)
-
-    def _wait_for_child(self, childpid):
-        while not self.__child_exited:
-            # Could implement a maximum wait time here
-            self.log.trace('waiting for child %d' % childpid)
-            time.sleep(1.0)
-            #raise getmailDeliveryError('failed waiting for commands %s %d (%s)'
-            #                           % (self.conf['command'], childpid, o))
-        if self.__child_pid != childpid:
+    def _child_exitcode(self, childpid, pid, status):
+        if pid != childpid:
             #self.log.error('got child pid %d, not %d' % (pid, childpid))
             raise getmailOperationError(
                 'got child pid %d, not %d'
-                % (self.__child_pid, childpid)
+                % (pid, childpid)
             )
-        if os.WIFSTOPPED(self.__child_status):
+        if os.WIFSTOPPED(status):
             raise getmailOperationError(
                 'child pid %d stopped by signal %d'
-                % (self.__child_pid, os.WSTOPSIG(self.__child_status))
+                % (pid, os.WSTOPSIG(status))
             )
-        if os.WIFSIGNALED(self.__child_status):
+        if os.WIFSIGNALED(status):
             raise getmailOperationError(
                 'child pid %d killed by signal %d'
-                % (self.__child_pid, os.WTERMSIG(self.__child_status))
+                % (pid, os.WTERMSIG(status))
             )
-        if not os.WIFEXITED(self.__child_status):
-            raise getmailOperationError('child pid %d failed to exit'
-                                        % self.__child_pid)
-        exitcode = os.WEXITSTATUS(self.__child_status)
+        if not os.WIFEXITED(status):
+            raise getmailOperationError('child pid %d failed to exit' % pid)
+        exitcode = os.WEXITSTATUS(status)
 
         return exitcode
 
+    def _run_child(self, child, data, seekable_stdin=False):
+        '''Fork, and call child() in the child process with data available on
+        its stdin and its stdout and stderr connected to pipes.
+
+        child() is called once file descriptors 0, 1, and 2 are set up, and
+        must exec() a program or leave with os._exit().  The data is written
+        to a pipe, unless seekable_stdin is set, in which case it is written
+        to an unlinked temporary file.  Neither is synced to disk; the data
+        is never needed again once the child exits.  If data is None, the
+        child inherits getmail's stdin.
+
+        getmail may have other threads running, holding locks the child
+        would inherit held, so child() must not log or look up users and
+        groups; do that in the parent and use _exec_child().  Errors are
+        reported by writing to file descriptor 2.
+
+        The child is reaped with waitpid() once its output is exhausted.
+        Safe to call from several threads at once; the pipes are closed on
+        exec() in every other child, so each child sees the end of its input
+        when its own parent closes it.
+
+        Returns a tuple (childpid, exitcode, stdout, stderr).
+        '''
+        self.log.trace()
+        stdinfile = None
+        stdin_w = None
+        stdin_r = None
+        if seekable_stdin and data is not None:
+            stdinfile = tempfile.TemporaryFile()
+            stdinfile.write(data)
+            stdinfile.flush()
+            stdinfile.seek(0)
+        _fork_lock.acquire()
+        try:
+            if stdinfile is not None:
+                stdin_r = stdinfile.fileno()
+            elif data is not None:
+                (stdin_r, stdin_w) = os.pipe()
+            (stdout_r, stdout_w) = os.pipe()
+            (stderr_r, stderr_w) = os.pipe()
+            for fd in (stdin_r, stdin_w, stdout_r, stdout_w, stderr_r,
+                       stderr_w):
+                if fd is not None:
+                    _set_cloexec(fd)
+            childpid = os.fork()
+        finally:
+            _fork_lock.release()
+        if not childpid:
+            # Child
+            try:
+                if stdin_r is not None:
+                    os.dup2(stdin_r, 0)
+                os.dup2(stdout_w, 1)
+                os.dup2(stderr_w, 2)
+                for fd in (stdin_r, stdin_w, stdout_r, stdout_w, stderr_r,
+                           stderr_w):
+                    if fd is not None and fd > 2:
+                        os.close(fd)
+                child()
+            finally:
+                # child() must not return into the parent's code
+                os._exit(127)
+        self.log.debug('spawned child %d\n' % childpid)
+
+        # Parent
+        os.close(stdout_w)
+        os.close(stderr_w)
+        if stdinfile is not None:
+            stdinfile.close()
+        elif stdin_r is not None:
+            os.close(stdin_r)
+        try:
+            (out, err) = self._pump_child(data, stdin_w, stdout_r, stderr_r)
+        finally:
+            exitcode = self._reap_child(childpid)
+        return (childpid, exitcode, out, err)
+
+    def _exec_child(self, args, uid=None, gid=None, env=None):
+        '''For use as the child() of _run_child().  Switch to gid and uid,
+        if they are given and not 0, and exec args[0] with argument list
+        args, and environment env if it is not None.  Only leaves through
+        os._exit().
+        '''
+        try:
+            if gid:
+                os.setgid(gid)
+            if uid:
+                os.setuid(uid)
+            if env is None:
+                os.execv(args[0], args)
+            else:
+                os.execve(args[0], args, env)
+        except OSError, o:
+            os.write(2, 'exec of %s failed (%s)' % (args[0], o))
+        os._exit(127)
+
+    def _pump_child(self, data, stdin_w, stdout_r, stderr_r):
+        '''Write data to stdin_w, if it is not None, while collecting
+        everything written to stdout_r and stderr_r.  Waits on all three at
+        once, so a child which writes a lot before (or instead of) reading
+        its input cannot deadlock against getmail.  Closes the descriptors.
+        '''
+        output = {stdout_r : [], stderr_r : []}
+        readers = [stdout_r, stderr_r]
+        writers = []
+        offset = 0
+        if stdin_w is not None:
+            if data:
+                fcntl.fcntl(stdin_w, fcntl.F_SETFL,
+                            fcntl.fcntl(stdin_w, fcntl.F_GETFL)
+                            | os.O_NONBLOCK)
+                writers.append(stdin_w)
+            else:
+                os.close(stdin_w)
+        try:
+            while readers or writers:
+                try:
+                    (r, w, unused) = select.select(readers, writers, [])
+                except select.error, o:
+                    if o.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if w:
+                    try:
+                        offset += os.write(stdin_w,
+                                           data[offset:offset + PIPE_CHUNK])
+                    except OSError, o:
+                        if o.errno == errno.EPIPE:
+                            # Child does not want the rest of its input
+                            offset = len(data)
+                        elif o.errno not in (errno.EINTR, errno.EAGAIN):
+                            raise
+                    if offset >= len(data):
+                        writers.remove(stdin_w)
+                        os.close(stdin_w)
+                for fd in r:
+                    try:
+                        chunk = os.read(fd, PIPE_CHUNK)
+                    except OSError, o:
+                        if o.errno == errno.EINTR:
+                            continue
+                        raise
+                    if chunk:
+                        output[fd].append(chunk)
+                    else:
+                        readers.remove(fd)
+                        os.close(fd)
+        finally:
+            for fd in readers + writers:
+                os.close(fd)
+        return (''.join(output[stdout_r]), ''.join(output[stderr_r]))
+
+    def _reap_child(self, childpid):
+        while True:
+            try:
+                (pid, status) = os.waitpid(childpid, 0)
+                break
+            except OSError, o:
+                if o.errno != errno.EINTR:
+                    raise
+        self.log.trace('reaped child %s with status %s' % (pid, status))
+        return self._child_exitcode(childpid, pid, status)
+
 
 # For Python 2.3, which lacks the sorted() builtin
 if sys.hexversion < 0x02040000:
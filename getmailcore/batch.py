@@ -0,0 +1,183 @@
+#!/usr/bin/env python2.3
+'''Reading many messages for delivery by one process.
+
+getmail_maildir and getmail_mbox normally deliver a single message read from
+stdin.  In batch mode they instead deliver every message in an mbox stream or
+in a directory of message files.  The messages are read here and parsed and
+serialized for delivery, optionally by several worker processes, so the
+delivering process only has to write them out.
+'''
+
+__all__ = [
+    'prepare_messages',
+    'read_directory',
+    'read_mbox',
+]
+
+import os
+import re
+import itertools
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python < 2.6; messages are prepared serially
+    multiprocessing = None
+
+from getmailcore.exceptions import *
+from getmailcore.message import Message
+from getmailcore.utilities import address_no_brackets
+
+RE_QUOTED_FROMLINE = re.compile(r'^>(>*From )', re.MULTILINE)
+
+# Messages handed to a worker process at a time, and number of such chunks
+# in each window of messages read ahead of delivery
+PREPARE_CHUNK = 16
+PREPARE_WINDOW_CHUNKS = 4
+# Python 2 only lets a wait for results be interrupted by a signal if it has
+# a timeout
+PREPARE_TIMEOUT = 24 * 60 * 60
+
+#######################################
+def read_mbox(f):
+    '''Read messages from an mbox stream.
+
+    Yields (label, sender, data) for each message, where sender is the
+    envelope sender from the message's From_ line.  The quoting of From_
+    lines in message bodies is undone, treating the input as mboxrd.
+    '''
+    num = 0
+    sender = None
+    lines = []
+    for line in f:
+        if line.startswith('From '):
+            if num:
+                yield ('message %d' % num, sender, _mbox_message(lines))
+            num += 1
+            parts = line.split(None, 2)
+            if len(parts) > 1:
+                sender = address_no_brackets(parts[1])
+            else:
+                sender = None
+            lines = []
+        elif num:
+            lines.append(line)
+        elif line.strip():
+            raise getmailConfigurationError('input is not an mbox (first '
+                                            'line does not start with From)')
+    if num:
+        yield ('message %d' % num, sender, _mbox_message(lines))
+
+def _mbox_message(lines):
+    # The blank line before the next From_ line separates messages and is not
+    # part of the message
+    if lines and not lines[-1].strip():
+        lines = lines[:-1]
+    return RE_QUOTED_FROMLINE.sub(r'\1', ''.join(lines))
+
+#######################################
+def read_directory(path):
+    '''Read messages from files in a directory, or in the new and cur
+    subdirectories of a maildir.
+
+    Yields (label, sender, data) for each message, where label is the path of
+    the file and sender is None.  Files are read in order of their names;
+    files whose names start with a dot are skipped.
+    '''
+    if (os.path.isdir(os.path.join(path, 'new'))
+            and os.path.isdir(os.path.join(path, 'cur'))):
+        directories = [os.path.join(path, 'new'), os.path.join(path, 'cur')]
+    else:
+        directories = [path]
+    for directory in directories:
+        try:
+            names = os.listdir(directory)
+        except OSError, o:
+            raise getmailConfigurationError('cannot read directory %s (%s)'
+                                            % (directory, o))
+        names.sort()
+        for name in names:
+            if name.startswith('.'):
+                continue
+            filename = os.path.join(directory, name)
+            if not os.path.isfile(filename):
+                continue
+            try:
+                f = open(filename, 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+            except IOError, o:
+                raise getmailConfigurationError('cannot read %s (%s)'
+                                                % (filename, o))
+            yield (filename, None, data)
+
+#######################################
+def _prepare(item):
+    '''Parse and serialize one message; run in worker processes.'''
+    (label, sender, data, recipient, kwargs) = item
+    try:
+        if not data:
+            raise getmailDeliveryError('empty message')
+        msg = Message(fromstring=data)
+        if sender is not None:
+            msg.sender = sender
+        msg.recipient = recipient
+        return (label, msg.flatten(True, False, **kwargs), None)
+    except StandardError, o:
+        return (label, None, str(o))
+
+def _items(messages, sender, recipient, kwargs):
+    for (label, msgsender, data) in messages:
+        if msgsender is None:
+            msgsender = sender
+        yield (label, msgsender, data, recipient, kwargs)
+
+def _windows(items, size):
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+def _prepare_parallel(items, jobs):
+    pool = multiprocessing.Pool(jobs)
+    pending = None
+    size = jobs * PREPARE_CHUNK * PREPARE_WINDOW_CHUNKS
+    for window in _windows(items, size):
+        result = pool.map_async(_prepare, window, PREPARE_CHUNK)
+        if pending is not None:
+            for prepared in pending.get(PREPARE_TIMEOUT):
+                yield prepared
+        pending = result
+    if pending is not None:
+        for prepared in pending.get(PREPARE_TIMEOUT):
+            yield prepared
+    pool.close()
+    pool.join()
+
+def prepare_messages(messages, sender=None, recipient=None, jobs=1,
+                     **kwargs):
+    '''Parse and serialize messages for delivery.
+
+    messages is an iterable of (label, sender, data), as produced by
+    read_mbox() and read_directory().  sender is used for messages without an
+    envelope sender of their own, and recipient for all of them; if sender is
+    None too, it is taken from the message's Return-Path: header field.
+    kwargs are passed to Message.flatten().
+
+    Returns an iterator of (label, data, error) for each message, in order;
+    data is the message ready for delivery, or None and error says why it
+    could not be parsed.  With jobs greater than 1, messages are parsed by
+    that many worker processes, a window of messages at a time, while earlier
+    ones are delivered.  Without the multiprocessing module (Python < 2.6)
+    they are always parsed in this process.
+    '''
+    items = _items(messages, sender, recipient, kwargs)
+    if jobs <= 1 or multiprocessing is None:
+        return itertools.imap(_prepare, items)
+    return _prepare_parallel(items, jobs)
@@ -26,7 +26,6 @@ __all__ = [
 
 import os
 import re
-import tempfile
 import types
 import email.Utils
 
@@ -35,6 +34,20 @@ import pwd
 from getmailcore.exceptions import *
 from getmailcore.utilities import *
 from getmailcore.baseclasses import *
+from getmailcore.message import *
+
+# Header fields MultiGuesser looks for addresses in; it stops at the first
+# group in which it finds any
+GUESSER_FIELDNAMES = (
+    ('delivered-to', ),
+    ('envelope-to', ),
+    ('x-envelope-to', ),
+    ('apparently-to', ),
+    ('resent-to', 'resent-cc', 'resent-bcc'),
+    ('to', 'cc', 'bcc'),
+)
+GUESSER_FIELDS = tuple([field for fields in GUESSER_FIELDNAMES
+                        for field in fields])
 
 #######################################
 class DeliverySkeleton(ConfigurableBase):
@@ -68,6 +81,9 @@ class DeliverySkeleton(ConfigurableBase):
                         and deliver it, returning a string describing the
                         result.
 
+    Sub-classes which can deliver several messages at once from different
+    threads can take a max_parallel parameter; see max_parallel().
+
     See the Maildir class for a good, simple example.
     '''
     def __init__(self, **args):
@@ -98,6 +114,17 @@ class DeliverySkeleton(ConfigurableBase):
         msg.received_by = self.received_by
         return self._deliver_message(msg, delivered_to, received)
 
+    def max_parallel(self):
+        '''Return the number of messages which may be delivered at once.'''
+        return self.conf.get('max_parallel', 1)
+
+    def _check_max_parallel(self):
+        if self.conf['max_parallel'] < 1:
+            raise getmailConfigurationError(
+                'max_parallel must be at least 1 (%s)'
+                % self.conf['max_parallel']
+            )
+
 #######################################
 class Maildir(DeliverySkeleton, ForkingBase):
     '''Maildir destination.
@@ -118,6 +145,9 @@ class Maildir(DeliverySkeleton, ForkingBase):
         self.log.trace()
         self.hostname = localhostname()
         self.dcount = 0
+        # Set once a delivery has succeeded; the maildir is only verified
+        # before the first delivery
+        self.__maildir_checked = False
         try:
             self.conf['filemode'] = int(self.conf['filemode'], 8)
         except ValueError, o:
@@ -131,36 +161,24 @@ class Maildir(DeliverySkeleton, ForkingBase):
     def showconf(self):
         self.log.info('Maildir(%s)\n' % self._confstring())
 
-    def __deliver_message_maildir(self, uid, gid, msg, delivered_to, received,
-                                  stdout, stderr):
+    def __deliver_message_maildir(self, uid, gid, data):
         '''Delivery method run in separate child process.
         '''
         try:
-            if os.name == 'posix':
-                if uid:
-                    change_uidgid(None, uid, gid)
-                if os.geteuid() == 0:
-                    raise getmailConfigurationError(
-                        'refuse to deliver mail as root'
-                    )
-                if os.getegid() == 0:
-                    raise getmailConfigurationError(
-                        'refuse to deliver mail as GID 0'
-                    )
+            if gid is not None:
+                os.setgid(gid)
+            if uid is not None:
+                os.setuid(uid)
             f = deliver_maildir(
-                self.conf['path'], msg.flatten(delivered_to, received),
-                self.hostname, self.dcount, self.conf['filemode']
+                self.conf['path'], data, self.hostname, self.dcount,
+                self.conf['filemode'], not self.__maildir_checked
             )
-            stdout.write(f)
-            stdout.flush()
-            os.fsync(stdout.fileno())
+            os.write(1, f)
             os._exit(0)
         except StandardError, o:
             # Child process; any error must cause us to exit nonzero for parent
             # to detect it
-            stderr.write('maildir delivery process failed (%s)' % o)
-            stderr.flush()
-            os.fsync(stderr.fileno())
+            os.write(2, 'maildir delivery process failed (%s)' % o)
             os._exit(127)
 
     def _deliver_message(self, msg, delivered_to, received):
@@ -181,24 +199,17 @@ class Maildir(DeliverySkeleton, ForkingBase):
                     raise getmailConfigurationError(
                         'refuse to deliver mail as GID 0'
                     )
-        self._prepare_child()
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
-        childpid = os.fork()
-
-        if not childpid:
-            # Child
-            self.__deliver_message_maildir(uid, gid, msg, delivered_to,
-                                           received, stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
-
-        # Parent
-        exitcode = self._wait_for_child(childpid)
-
-        stdout.seek(0)
-        stderr.seek(0)
-        out = stdout.read().strip()
-        err = stderr.read().strip()
+            elif os.geteuid() == 0:
+                raise getmailDeliveryError('refuse to deliver mail as root')
+            elif os.getegid() == 0:
+                raise getmailDeliveryError('refuse to deliver mail as GID 0')
+        # Generate the message here, so the child does not have to
+        data = msg.flatten(delivered_to, received)
+        (childpid, exitcode, out, err) = self._run_child(
+            lambda: self.__deliver_message_maildir(uid, gid, data), None
+        )
+        out = out.strip()
+        err = err.strip()
 
         self.log.debug('maildir delivery process %d exited %d\n'
                        % (childpid, exitcode))
@@ -208,6 +219,7 @@ class Maildir(DeliverySkeleton, ForkingBase):
                                        % (childpid, exitcode, err))
 
         self.dcount += 1
+        self.__maildir_checked = True
         self.log.debug('maildir file %s' % out)
         return self
 
@@ -245,92 +257,27 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
     def showconf(self):
         self.log.info('Mboxrd(%s)\n' % self._confstring())
 
-    def __deliver_message_mbox(self, uid, gid, msg, delivered_to, received,
-                               stdout, stderr):
+    def __deliver_message_mbox(self, uid, gid, data):
         '''Delivery method run in separate child process.
         '''
         try:
-            if os.name == 'posix':
-                if uid:
-                    change_uidgid(None, uid, gid)
-                if os.geteuid() == 0:
-                    raise getmailConfigurationError(
-                        'refuse to deliver mail as root'
-                    )
-                if os.getegid() == 0:
-                    raise getmailConfigurationError(
-                        'refuse to deliver mail as GID 0'
-                    )
-
-            if not os.path.exists(self.conf['path']):
-                raise getmailDeliveryError('mboxrd does not exist (%s)'
-                                           % self.conf['path'])
-            if not os.path.isfile(self.conf['path']):
-                raise getmailDeliveryError('not an mboxrd file (%s)'
-                                           % self.conf['path'])
-
-            # Open mbox file, refusing to create it if it doesn't exist
-            fd = os.open(self.conf['path'], os.O_RDWR)
-            status_old = os.fstat(fd)
-            f = os.fdopen(fd, 'r+b')
-            lock_file(f, self.conf['locktype'])
-            # Check if it _is_ an mbox file.  mbox files must start with "From "
-            # in their first line, or are 0-length files.
-            f.seek(0, 0)
-            first_line = f.readline()
-            if first_line and not first_line.startswith('From '):
-                # Not an mbox file; abort here
-                unlock_file(f, self.conf['locktype'])
-                raise getmailDeliveryError('not an mboxrd file (%s)'
-                                           % self.conf['path'])
-            # Seek to end
-            f.seek(0, 2)
-            try:
-                # Write out message plus blank line with native EOL
-                f.write(msg.flatten(delivered_to, received, include_from=True,
-                                    mangle_from=True) + os.linesep)
-                f.flush()
-                os.fsync(fd)
-                status_new = os.fstat(fd)
-                # Reset atime
-                try:
-                    os.utime(self.conf['path'], (status_old.st_atime,
-                             status_new.st_mtime))
-                except OSError, o:
-                    # Not root or owner; readers will not be able to reliably
-                    # detect new mail.  But you shouldn't be delivering to
-                    # other peoples' mboxes unless you're root, anyways.
-                    stdout.write('failed to updated mtime/atime of mbox')
-                    stdout.flush()
-                    os.fsync(stdout.fileno())
-
-                unlock_file(f, self.conf['locktype'])
-
-            except IOError, o:
-                try:
-                    if not f.closed:
-                        # If the file was opened and we know how long it was,
-                        # try to truncate it back to that length
-                        # If it's already closed, or the error occurred at
-                        # close(), then there's not much we can do.
-                        f.truncate(status_old.st_size)
-                except KeyboardInterrupt:
-                    raise
-                except StandardError:
-                    pass
-                raise getmailDeliveryError(
-                    'failure writing message to mbox file "%s" (%s)'
-                    % (self.conf['path'], o)
-                )
+            if gid is not None:
+                os.setgid(gid)
+            if uid is not None:
+                os.setuid(uid)
+            if not deliver_mbox(self.conf['path'], [data],
+                                self.conf['locktype']):
+                # Not root or owner; readers will not be able to reliably
+                # detect new mail.  But you shouldn't be delivering to other
+                # peoples' mboxes unless you're root, anyways.
+                os.write(1, 'failed to updated mtime/atime of mbox')
 
             os._exit(0)
 
         except StandardError, o:
             # Child process; any error must cause us to exit nonzero for parent
             # to detect it
-            stderr.write('mbox delivery process failed (%s)' % o)
-            stderr.flush()
-            os.fsync(stderr.fileno())
+            os.write(2, 'mbox delivery process failed (%s)' % o)
             os._exit(127)
 
     def _deliver_message(self, msg, delivered_to, received):
@@ -353,24 +300,18 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
                 raise getmailConfigurationError(
                     'refuse to deliver mail as GID 0'
                 )
-        self._prepare_child()
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
-        childpid = os.fork()
-
-        if not childpid:
-            # Child
-            self.__deliver_message_mbox(uid, gid, msg, delivered_to, received,
-                                        stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
-
-        # Parent
-        exitcode = self._wait_for_child(childpid)
-
-        stdout.seek(0)
-        stderr.seek(0)
-        out = stdout.read().strip()
-        err = stderr.read().strip()
+            if uid is None and os.geteuid() == 0:
+                raise getmailDeliveryError('refuse to deliver mail as root')
+            if gid is None and os.getegid() == 0:
+                raise getmailDeliveryError('refuse to deliver mail as GID 0')
+        # Generate the message here, so the child does not have to
+        data = msg.flatten(delivered_to, received, include_from=True,
+                           mangle_from=True)
+        (childpid, exitcode, out, err) = self._run_child(
+            lambda: self.__deliver_message_mbox(uid, gid, data), None
+        )
+        out = out.strip()
+        err = err.strip()
 
         self.log.debug('mboxrd delivery process %d exited %d\n'
                        % (childpid, exitcode))
@@ -436,6 +377,10 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
             allowed when running as root.  The default is not to allow such
             behaviour.
 
+      max_parallel (integer, optional) - the number of qmail-local processes
+            which may run at once.  Messages for the same envelope recipient
+            are still delivered one at a time, in order.  The default is 1.
+
     For example, if getmail is run as user "exampledotorg", which has virtual
     domain "example.org" delegated to it with a virtualdomains entry of
     "example.org:exampledotorg", and messages are retrieved with envelope
@@ -462,10 +407,12 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
                            default="('', '')"),
         ConfBool(name='strip_delivered_to', required=False, default=False),
         ConfBool(name='allow_root_commands', required=False, default=False),
+        ConfInt(name='max_parallel', required=False, default=1),
     )
 
     def initialize(self):
         self.log.trace()
+        self._check_max_parallel()
 
     def __str__(self):
         self.log.trace()
@@ -474,55 +421,8 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
     def showconf(self):
         self.log.info('MDA_qmaillocal(%s)\n' % self._confstring())
 
-    def _deliver_qmaillocal(self, msg, msginfo, delivered_to, received, stdout,
-            stderr):
-        try:
-            args = (
-                self.conf['qmaillocal'], self.conf['qmaillocal'],
-                '--', self.conf['user'], self.conf['homedir'],
-                msginfo['local'], msginfo['dash'], msginfo['ext'],
-                self.conf['localdomain'], msginfo['sender'],
-                self.conf['defaultdelivery']
-            )
-            self.log.debug('about to execl() with args %s\n' % str(args))
-            # Modify message
-            if self.conf['strip_delivered_to']:
-                msg.remove_header('delivered-to')
-                # Also don't insert a Delivered-To: header.
-                delivered_to = None
-            # Write out message
-            msgfile = tempfile.TemporaryFile()
-            msgfile.write(msg.flatten(delivered_to, received))
-            msgfile.flush()
-            os.fsync(msgfile.fileno())
-            # Rewind
-            msgfile.seek(0)
-            # Set stdin to read from this file
-            os.dup2(msgfile.fileno(), 0)
-            # Set stdout and stderr to write to files
-            os.dup2(stdout.fileno(), 1)
-            os.dup2(stderr.fileno(), 2)
-            change_usergroup(self.log, self.conf['user'], self.conf['group'])
-            # At least some security...
-            if ((os.geteuid() == 0 or os.getegid() == 0)
-                    and not self.conf['allow_root_commands']):
-                raise getmailConfigurationError(
-                    'refuse to invoke external commands as root '
-                    'or GID 0 by default'
-                )
-
-            os.execl(*args)
-        except StandardError, o:
-            # Child process; any error must cause us to exit nonzero for parent
-            # to detect it
-            stderr.write('exec of qmail-local failed (%s)' % o)
-            stderr.flush()
-            os.fsync(stderr.fileno())
-            os._exit(127)
-
     def _deliver_message(self, msg, delivered_to, received):
         self.log.trace()
-        self._prepare_child()
         if msg.recipient == None:
             raise getmailConfigurationError(
                 'MDA_qmaillocal destination requires a message source that '
@@ -557,23 +457,38 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
         self.log.debug('recipient: set dash to "%s", ext to "%s"\n'
                        % (msginfo['dash'], msginfo['ext']))
 
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
-        childpid = os.fork()
-
-        if not childpid:
-            # Child
-            self._deliver_qmaillocal(msg, msginfo, delivered_to, received,
-                                     stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
-
-        # Parent
-        exitcode = self._wait_for_child(childpid)
+        (uid, gid) = usergroup_ids(self.conf['user'], self.conf['group'])
+        # At least some security...
+        if ((not uid and os.geteuid() == 0 or not gid and os.getegid() == 0)
+                and not self.conf['allow_root_commands']):
+            raise getmailDeliveryError(
+                'refuse to invoke external commands as root '
+                'or GID 0 by default'
+            )
+        args = (
+            self.conf['qmaillocal'], '--', self.conf['user'],
+            self.conf['homedir'], msginfo['local'], msginfo['dash'],
+            msginfo['ext'], self.conf['localdomain'], msginfo['sender'],
+            self.conf['defaultdelivery']
+        )
+        self.log.debug('about to execv() with args %s\n' % str(args))
+        if self.conf['strip_delivered_to']:
+            # Strip the header fields from a copy; the message may still be
+            # delivered to other destinations.  Also don't insert a
+            # Delivered-To: header.
+            stripped = Message(fromstring=msg.flatten(False, received))
+            stripped.copyattrs(msg)
+            stripped.remove_header('delivered-to')
+            data = stripped.flatten(False, False)
+        else:
+            data = msg.flatten(delivered_to, received)
 
-        stdout.seek(0)
-        stderr.seek(0)
-        out = stdout.read().strip()
-        err = stderr.read().strip()
+        # qmail-local requires seekable input
+        (childpid, exitcode, out, err) = self._run_child(
+            lambda: self._exec_child(args, uid, gid), data, True
+        )
+        out = out.strip()
+        err = err.strip()
 
         self.log.debug('qmail-local %d exited %d\n' % (childpid, exitcode))
 
@@ -639,6 +554,16 @@ class MDA_external(DeliverySkeleton, ForkingBase):
 
       ignore_stderr (boolean, optional) - if set, getmail will not consider the
             program writing to stderr to be an error.  The default is False.
+
+      seekable_stdin (boolean, optional) - if set, the message is given to
+            the program in a temporary file instead of through a pipe, for
+            programs which need to seek on their standard input.  The default
+            is False.
+
+      max_parallel (integer, optional) - the number of instances of the
+            program which may run at once.  Messages for the same envelope
+            recipient are still delivered one at a time, in order.  The
+            default is 1.
     '''
     _confitems = (
         ConfInstance(name='configparser', required=False),
@@ -649,10 +574,13 @@ class MDA_external(DeliverySkeleton, ForkingBase):
         ConfBool(name='allow_root_commands', required=False, default=False),
         ConfBool(name='unixfrom', required=False, default=False),
         ConfBool(name='ignore_stderr', required=False, default=False),
+        ConfBool(name='seekable_stdin', required=False, default=False),
+        ConfInt(name='max_parallel', required=False, default=1),
     )
 
     def initialize(self):
         self.log.trace()
+        self._check_max_parallel()
         self.conf['command'] = os.path.basename(self.conf['path'])
         if not os.access(self.conf['path'], os.X_OK):
             raise getmailConfigurationError('%s not executable'
@@ -671,51 +599,8 @@ class MDA_external(DeliverySkeleton, ForkingBase):
     def showconf(self):
         self.log.info('MDA_external(%s)\n' % self._confstring())
 
-    def _deliver_command(self, msg, msginfo, delivered_to, received,
-                         stdout, stderr):
-        try:
-            # Write out message with native EOL convention
-            msgfile = tempfile.TemporaryFile()
-            msgfile.write(msg.flatten(delivered_to, received,
-                                      include_from=self.conf['unixfrom']))
-            msgfile.flush()
-            os.fsync(msgfile.fileno())
-            # Rewind
-            msgfile.seek(0)
-            # Set stdin to read from this file
-            os.dup2(msgfile.fileno(), 0)
-            # Set stdout and stderr to write to files
-            os.dup2(stdout.fileno(), 1)
-            os.dup2(stderr.fileno(), 2)
-            change_usergroup(self.log, self.conf['user'], self.conf['group'])
-            # At least some security...
-            if ((os.geteuid() == 0 or os.getegid() == 0)
-                    and not self.conf['allow_root_commands']):
-                raise getmailConfigurationError(
-                    'refuse to invoke external commands as root '
-                    'or GID 0 by default'
-                )
-            args = [self.conf['path'], self.conf['path']]
-            msginfo['mailbox'] = self.retriever.mailbox_selected or ''
-            for arg in self.conf['arguments']:
-                arg = expand_user_vars(arg)
-                for (key, value) in msginfo.items():
-                    arg = arg.replace('%%(%s)' % key, value)
-                args.append(arg)
-            self.log.debug('about to execl() with args %s\n' % str(args))
-            os.execl(*args)
-        except StandardError, o:
-            # Child process; any error must cause us to exit nonzero for parent
-            # to detect it
-            stderr.write('exec of command %s failed (%s)'
-                         % (self.conf['command'], o))
-            stderr.flush()
-            os.fsync(stderr.fileno())
-            os._exit(127)
-
     def _deliver_message(self, msg, delivered_to, received):
         self.log.trace()
-        self._prepare_child()
         msginfo = {}
         msginfo['sender'] = msg.sender
         if msg.recipient != None:
@@ -723,24 +608,32 @@ class MDA_external(DeliverySkeleton, ForkingBase):
             msginfo['domain'] = msg.recipient.lower().split('@')[-1]
             msginfo['local'] = '@'.join(msg.recipient.split('@')[:-1])
         self.log.debug('msginfo "%s"\n' % msginfo)
-
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
-        childpid = os.fork()
-
-        if not childpid:
-            # Child
-            self._deliver_command(msg, msginfo, delivered_to, received,
-                                  stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
-
-        # Parent
-        exitcode = self._wait_for_child(childpid)
-
-        stdout.seek(0)
-        stderr.seek(0)
-        out = stdout.read().strip()
-        err = stderr.read().strip()
+        (uid, gid) = usergroup_ids(self.conf['user'], self.conf['group'])
+        # At least some security...
+        if ((not uid and os.geteuid() == 0 or not gid and os.getegid() == 0)
+                and not self.conf['allow_root_commands']):
+            raise getmailDeliveryError(
+                'refuse to invoke external commands as root '
+                'or GID 0 by default'
+            )
+        args = [self.conf['path']]
+        msginfo['mailbox'] = self.retriever.mailbox_selected or ''
+        for arg in self.conf['arguments']:
+            arg = expand_user_vars(arg)
+            for (key, value) in msginfo.items():
+                arg = arg.replace('%%(%s)' % key, value)
+            args.append(arg)
+        self.log.debug('about to execv() with args %s\n' % str(args))
+
+        # Message with native EOL convention
+        (childpid, exitcode, out, err) = self._run_child(
+            lambda: self._exec_child(args, uid, gid),
+            msg.flatten(delivered_to, received,
+                        include_from=self.conf['unixfrom']),
+            self.conf['seekable_stdin']
+        )
+        out = out.strip()
+        err = err.strip()
 
         self.log.debug('command %s %d exited %d\n'
                        % (self.conf['command'], childpid, exitcode))
@@ -1041,22 +934,16 @@ class MultiGuesser(MultiSorterBase):
         self.log.trace()
         matched = []
         header_addrs = []
-        fieldnames = (
-            ('delivered-to', ),
-            ('envelope-to', ),
-            ('x-envelope-to', ),
-            ('apparently-to', ),
-            ('resent-to', 'resent-cc', 'resent-bcc'),
-            ('to', 'cc', 'bcc'),
-        )
-        for fields in fieldnames:
+        # All the fields are found in one pass over the header
+        values = msg.header_fields(GUESSER_FIELDS)
+        for fields in GUESSER_FIELDNAMES:
             for field in fields:
                 self.log.debug(
                     'looking for addresses in %s header fields\n' % field
                 )
                 header_addrs.extend(
                     [addr for (name, addr) in email.Utils.getaddresses(
-                        msg.get_all(field, [])
+                        values[field]
                      ) if addr]
                 )
             if header_addrs:
@@ -0,0 +1,203 @@
+#!/usr/bin/env python2.3
+'''Index of delivered messages, for suppressing duplicates of a message
+retrieved through several accounts or mailboxes.
+
+The index is kept in the getmail directory and shared by all rc files which
+enable it.  Each record is a digest of a message's Message-ID: field together
+with either its size on the server (which can be checked from the message
+header alone, before the message is retrieved) or a digest of its body (which
+catches copies with different header fields, such as the same list message
+received at two addresses).  Messages without a Message-ID: field are never
+considered duplicates.
+
+A Bloom filter of the records is saved alongside them, so that most lookups
+are answered without reading the records at all.
+'''
+
+__all__ = [
+    'DuplicateIndex',
+]
+
+import os
+import time
+import array
+
+try:
+    from hashlib import sha1
+except ImportError:
+    # Python < 2.5
+    from sha import new as sha1
+
+from getmailcore.utilities import updatefile, lock_file, unlock_file
+import getmailcore.logging
+
+INDEX_FILENAME = 'duplicates'
+BLOOM_SUFFIX = '.bloom'
+LOCK_SUFFIX = '.lock'
+
+# Bloom filter sizing; 10 bits per record and 7 hash functions give a false
+# positive rate of about 1%.
+BLOOM_BITS_PER_RECORD = 10
+BLOOM_HASHES = 7
+BLOOM_MIN_BITS = 8192
+
+#######################################
+class DuplicateIndex(object):
+    '''A persistent index of digests of delivered messages.
+
+    retention is the time, in seconds, records are kept for.  New records are
+    only written to disk by save().
+    '''
+    def __init__(self, getmaildir, retention):
+        self.log = getmailcore.logging.Logger()
+        self.filename = os.path.join(getmaildir, INDEX_FILENAME)
+        self.retention = retention
+        self.now = int(time.time())
+        # Records on disk, digest -> timestamp; only read if the Bloom filter
+        # says a digest might be present.
+        self.records = None
+        self.new = {}
+        self.bloom = None
+        self.bloombits = 0
+        self._read_bloom()
+
+    def __str__(self):
+        return 'DuplicateIndex(filename="%s")' % self.filename
+
+    def _read_bloom(self):
+        try:
+            f = open(self.filename + BLOOM_SUFFIX, 'rb')
+            try:
+                bits = int(f.readline())
+                data = f.read()
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            # No usable filter; lookups will read the records
+            return
+        if bits <= 0 or len(data) * 8 < bits:
+            return
+        self.bloom = array.array('B', data)
+        self.bloombits = bits
+
+    def _read_records(self):
+        records = {}
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return records
+        try:
+            for line in f:
+                try:
+                    (digest, timestamp) = line.split()
+                    records[digest] = int(timestamp)
+                except ValueError:
+                    # malformed
+                    continue
+        finally:
+            f.close()
+        self.log.moreinfo('read %d duplicate index records%s'
+                          % (len(records), os.linesep))
+        return records
+
+    def _bloom_positions(self, digest, bits):
+        # Double hashing from two independent parts of the digest
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:32], 16) | 1
+        return [(h1 + i * h2) % bits for i in range(BLOOM_HASHES)]
+
+    def _contains(self, digest):
+        if digest in self.new:
+            return True
+        if self.bloom is not None:
+            for pos in self._bloom_positions(digest, self.bloombits):
+                if not self.bloom[pos >> 3] & (1 << (pos & 7)):
+                    return False
+        if self.records is None:
+            self.records = self._read_records()
+        timestamp = self.records.get(digest, None)
+        return (timestamp is not None
+                and self.now - timestamp <= self.retention)
+
+    def _message_id(self, msg):
+        for value in msg.get_all('message-id', []):
+            value = str(value).strip()
+            if value:
+                return value
+        return None
+
+    def header_key(self, msg, size):
+        '''Return the digest identifying a message by its Message-ID: field
+        and size on the server, which needs only the message header.  Returns
+        None if the message has no Message-ID: field.
+        '''
+        msgid = self._message_id(msg)
+        if msgid is None:
+            return None
+        return sha1('size\0%s\0%d' % (msgid, size)).hexdigest()
+
+    def message_keys(self, msg, size):
+        '''Return a list of digests identifying a retrieved message.'''
+        key = self.header_key(msg, size)
+        if key is None:
+            return []
+        keys = [key]
+        body_digest = msg.body_digest()
+        if body_digest is not None:
+            keys.append(sha1('body\0%s\0%s' % (self._message_id(msg),
+                                               body_digest)).hexdigest())
+        return keys
+
+    def contains(self, keys):
+        '''Return True if any of the digests is in the index.'''
+        for key in keys:
+            if key is not None and self._contains(key):
+                return True
+        return False
+
+    def add(self, keys):
+        for key in keys:
+            if key is not None:
+                self.new[key] = self.now
+
+    def save(self):
+        '''Merge new records into the index on disk, dropping expired ones.'''
+        if not self.new:
+            return
+        lockf = os.fdopen(os.open(self.filename + LOCK_SUFFIX,
+                                  os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                                  0600), 'ab')
+        try:
+            lock_file(lockf, 'flock')
+            # Another getmail process may have added records since they were
+            # read
+            records = self._read_records()
+            records.update(self.new)
+            for (digest, timestamp) in records.items():
+                if self.now - timestamp > self.retention:
+                    del records[digest]
+            bits = max(BLOOM_MIN_BITS, len(records) * BLOOM_BITS_PER_RECORD)
+            bloom = array.array('B', [0]) * ((bits + 7) // 8)
+            for digest in records:
+                for pos in self._bloom_positions(digest, bits):
+                    bloom[pos >> 3] |= 1 << (pos & 7)
+            # Write the filter first; if writing the records then fails, the
+            # filter still covers them and lookups only fall back to reading
+            # the records more often.
+            f = updatefile(self.filename + BLOOM_SUFFIX)
+            f.write('%d\n' % bits)
+            f.write(bloom.tostring())
+            f.close()
+            f = updatefile(self.filename)
+            for (digest, timestamp) in records.items():
+                f.write('%s %d\n' % (digest, timestamp))
+            f.close()
+            self.log.moreinfo('wrote %d duplicate index records%s'
+                              % (len(records), os.linesep))
+        finally:
+            unlock_file(lockf, 'flock')
+            lockf.close()
+        self.records = records
+        self.bloom = bloom
+        self.bloombits = bits
+        self.new = {}
@@ -14,6 +14,7 @@ __all__ = [
     'getmailCredentialError',
     'getmailLoginRefusedError',
     'getmailMailboxSelectError',
+    'getmailConnectionError',
 ]
 
 # Base class for all getmail exceptions
@@ -75,3 +76,9 @@ class getmailMailboxSelectError(getmailOperationError):
     command -- no such mailbox, no permissions, etc.
     '''
     pass
+
+class getmailConnectionError(getmailOperationError):
+    '''Error raised when the connection to the server is lost partway through
+    a session, so that it may be worth reconnecting.
+    '''
+    pass
@@ -13,8 +13,8 @@ __all__ = [
 ]
 
 import os
-import tempfile
 import types
+import cStringIO
 
 from getmailcore.exceptions import *
 from getmailcore.compatibility import *
@@ -69,8 +69,10 @@ class FilterSkeleton(ConfigurableBase):
             )
         self.log.trace('done\n')
 
-    def filter_message(self, msg, retriever):
-        self.log.trace()
+    def _run_filter(self, msg, retriever):
+        '''Run the filter on the message.  Returns the filtered message, or
+        None if the message is to be dropped.
+        '''
         msg.received_from = retriever.received_from
         msg.received_with = retriever.received_with
         msg.received_by = retriever.received_by
@@ -91,6 +93,21 @@ class FilterSkeleton(ConfigurableBase):
                     'filter %s returned %d but wrote to stderr: %s\n'
                     % (self, exitcode, err)
                 )
+        return newmsg
+
+    def check_message(self, msg, retriever):
+        '''Run the filter on a message (usually just its header) only to decide
+        whether to keep it.  Returns False if the message is to be dropped.
+        The filter's output is discarded.
+        '''
+        self.log.trace()
+        return self._run_filter(msg, retriever) is not None
+
+    def filter_message(self, msg, retriever):
+        self.log.trace()
+        newmsg = self._run_filter(msg, retriever)
+        if newmsg is None:
+            return None
 
         # Check the filter was sane
         if len(newmsg.headers()) < len(msg.headers()):
@@ -162,6 +179,17 @@ class Filter_external(FilterSkeleton, ForkingBase):
 
       ignore_stderr (boolean, optional) - if set, getmail will not consider the
             program writing to stderr to be an error.  The default is False.
+
+      headers_only (boolean, optional) - if set, the filter is given only the
+            message header, before the message body is retrieved, and only
+            decides whether the message is dropped; its output is ignored.
+            Messages dropped this way are never downloaded.  The default is
+            False.
+
+      seekable_stdin (boolean, optional) - if set, the message is given to
+            the program in a temporary file instead of through a pipe, for
+            programs which need to seek on their standard input.  The default
+            is False.
     '''
     _confitems = (
         ConfFile(name='path'),
@@ -175,6 +203,8 @@ class Filter_external(FilterSkeleton, ForkingBase):
         ConfString(name='group', required=False, default=None),
         ConfBool(name='allow_root_commands', required=False, default=False),
         ConfBool(name='ignore_stderr', required=False, default=False),
+        ConfBool(name='headers_only', required=False, default=False),
+        ConfBool(name='seekable_stdin', required=False, default=False),
         ConfInstance(name='configparser', required=False),
     )
 
@@ -214,42 +244,20 @@ class Filter_external(FilterSkeleton, ForkingBase):
         self.log.trace()
         self.log.info('Filter_external(%s)\n' % self._confstring())
 
-    def _filter_command(self, msg, msginfo, stdout, stderr):
-        try:
-            # Write out message with native EOL convention
-            msgfile = tempfile.TemporaryFile()
-            msgfile.write(msg.flatten(False, False,
-                                      include_from=self.conf['unixfrom']))
-            msgfile.flush()
-            os.fsync(msgfile.fileno())
-            # Rewind
-            msgfile.seek(0)
-            # Set stdin to read from this file
-            os.dup2(msgfile.fileno(), 0)
-            # Set stdout and stderr to write to files
-            os.dup2(stdout.fileno(), 1)
-            os.dup2(stderr.fileno(), 2)
-            change_usergroup(None, self.conf['user'], self.conf['group'])
-            args = [self.conf['path'], self.conf['path']]
-            for arg in self.conf['arguments']:
-                arg = expand_user_vars(arg)
-                for (key, value) in msginfo.items():
-                    arg = arg.replace('%%(%s)' % key, value)
-                args.append(arg)
-            # Can't log this; if --trace is on, it will be written to the
-            # message passed to the filter.
-            #self.log.debug('about to execl() with args %s\n' % str(args))
-            os.execl(*args)
-        except StandardError, o:
-            # Child process; any error must cause us to exit nonzero for parent
-            # to detect it
-            self.log.critical('exec of filter %s failed (%s)'
-                              % (self.conf['command'], o))
-            os._exit(127)
+    def _command_args(self, msginfo):
+        '''Return the argument list for the filter command, with the
+        replacements in msginfo made in its arguments.'''
+        args = [self.conf['path']]
+        for arg in self.conf['arguments']:
+            arg = expand_user_vars(arg)
+            for (key, value) in msginfo.items():
+                arg = arg.replace('%%(%s)' % key, value)
+            args.append(arg)
+        self.log.debug('about to execv() with args %s\n' % str(args))
+        return args
 
     def _filter_message(self, msg):
         self.log.trace()
-        self._prepare_child()
         msginfo = {}
         msginfo['sender'] = msg.sender
         if msg.recipient != None:
@@ -265,26 +273,21 @@ class Filter_external(FilterSkeleton, ForkingBase):
                 'refuse to invoke external commands as root by default'
             )
 
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
-        childpid = os.fork()
-
-        if not childpid:
-            # Child
-            self._filter_command(msg, msginfo, stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
-
-        # Parent
-        exitcode = self._wait_for_child(childpid)
+        (uid, gid) = usergroup_ids(self.conf['user'], self.conf['group'])
+        args = self._command_args(msginfo)
 
-        stdout.seek(0)
-        stderr.seek(0)
-        err = stderr.read().strip()
+        # Message with native EOL convention
+        (childpid, exitcode, out, err) = self._run_child(
+            lambda: self._exec_child(args, uid, gid),
+            msg.flatten(False, False, include_from=self.conf['unixfrom']),
+            self.conf['seekable_stdin']
+        )
+        err = err.strip()
 
         self.log.debug('command %s %d exited %d\n' % (self.conf['command'],
                                                       childpid, exitcode))
 
-        newmsg = Message(fromfile=stdout)
+        newmsg = Message(fromfile=cStringIO.StringIO(out))
 
         return (exitcode, newmsg, err)
 
@@ -292,9 +295,17 @@ class Filter_external(FilterSkeleton, ForkingBase):
 class Filter_classifier(Filter_external):
     '''Filter which runs the message through an external command, adding the
     command's output to the message header.  Takes the same parameters as
-    Filter_external.  If the command prints nothing, no header fields are
-    added.
+    Filter_external, except headers_only.  If the command prints nothing, no
+    header fields are added.
     '''
+    def initialize(self):
+        self.log.trace()
+        Filter_external.initialize(self)
+        if self.conf['headers_only']:
+            raise getmailConfigurationError(
+                'Filter_classifier does not support headers_only'
+            )
+
     def __str__(self):
         self.log.trace()
         return 'Filter_classifier %s (%s)' % (self.conf['command'],
@@ -306,7 +317,6 @@ class Filter_classifier(Filter_external):
 
     def _filter_message(self, msg):
         self.log.trace()
-        self._prepare_child()
         msginfo = {}
         msginfo['sender'] = msg.sender
         if msg.recipient != None:
@@ -322,26 +332,21 @@ class Filter_classifier(Filter_external):
                 'refuse to invoke external commands as root by default'
             )
 
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
-        childpid = os.fork()
-
-        if not childpid:
-            # Child
-            self._filter_command(msg, msginfo, stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
-
-        # Parent
-        exitcode = self._wait_for_child(childpid)
+        (uid, gid) = usergroup_ids(self.conf['user'], self.conf['group'])
+        args = self._command_args(msginfo)
 
-        stdout.seek(0)
-        stderr.seek(0)
-        err = stderr.read().strip()
+        # Message with native EOL convention
+        (childpid, exitcode, out, err) = self._run_child(
+            lambda: self._exec_child(args, uid, gid),
+            msg.flatten(False, False, include_from=self.conf['unixfrom']),
+            self.conf['seekable_stdin']
+        )
+        err = err.strip()
 
         self.log.debug('command %s %d exited %d\n' % (self.conf['command'],
                                                       childpid, exitcode))
 
-        for line in [line.strip() for line in stdout.readlines()
+        for line in [line.strip() for line in out.splitlines()
                      if line.strip()]:
             # Output from filter can be in any random text encoding and may
             # not even be valid, which causes problems when trying to stick
@@ -409,44 +414,8 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
         self.log.trace()
         self.log.info('Filter_TMDA(%s)\n' % self._confstring())
 
-    def _filter_command(self, msg, stdout, stderr):
-        try:
-            # Write out message with native EOL convention
-            msgfile = tempfile.TemporaryFile()
-            msgfile.write(msg.flatten(True, True, include_from=True))
-            msgfile.flush()
-            os.fsync(msgfile.fileno())
-            # Rewind
-            msgfile.seek(0)
-            # Set stdin to read from this file
-            os.dup2(msgfile.fileno(), 0)
-            # Set stdout and stderr to write to files
-            os.dup2(stdout.fileno(), 1)
-            os.dup2(stderr.fileno(), 2)
-            change_usergroup(None, self.conf['user'], self.conf['group'])
-            args = [self.conf['path'], self.conf['path']]
-            # Set environment for TMDA
-            os.environ['SENDER'] = msg.sender
-            os.environ['RECIPIENT'] = msg.recipient
-            os.environ['EXT'] = self.conf['conf-break'].join(
-                '@'.join(msg.recipient.split('@')[:-1]).split(
-                    self.conf['conf-break']
-                )[1:]
-            )
-            self.log.trace('SENDER="%(SENDER)s",RECIPIENT="%(RECIPIENT)s"'
-                           ',EXT="%(EXT)s"' % os.environ)
-            self.log.debug('about to execl() with args %s\n' % str(args))
-            os.execl(*args)
-        except StandardError, o:
-            # Child process; any error must cause us to exit nonzero for parent
-            # to detect it
-            self.log.critical('exec of filter %s failed (%s)'
-                              % (self.conf['command'], o))
-            os._exit(127)
-
     def _filter_message(self, msg):
         self.log.trace()
-        self._prepare_child()
         if msg.recipient == None or msg.sender == None:
             raise getmailConfigurationError(
                 'TMDA requires the message envelope and therefore a multidrop '
@@ -460,20 +429,27 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
                 'refuse to invoke external commands as root by default'
             )
 
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
-        childpid = os.fork()
-
-        if not childpid:
-            # Child
-            self._filter_command(msg, stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
-
-        # Parent
-        exitcode = self._wait_for_child(childpid)
-
-        stderr.seek(0)
-        err = stderr.read().strip()
+        (uid, gid) = usergroup_ids(self.conf['user'], self.conf['group'])
+        args = [self.conf['path']]
+        # Set environment for TMDA
+        env = os.environ.copy()
+        env['SENDER'] = msg.sender
+        env['RECIPIENT'] = msg.recipient
+        env['EXT'] = self.conf['conf-break'].join(
+            '@'.join(msg.recipient.split('@')[:-1]).split(
+                self.conf['conf-break']
+            )[1:]
+        )
+        self.log.trace('SENDER="%(SENDER)s",RECIPIENT="%(RECIPIENT)s"'
+                       ',EXT="%(EXT)s"' % env)
+        self.log.debug('about to execv() with args %s\n' % str(args))
+
+        # Message with native EOL convention
+        (childpid, exitcode, unused, err) = self._run_child(
+            lambda: self._exec_child(args, uid, gid, env),
+            msg.flatten(True, True, include_from=True)
+        )
+        err = err.strip()
 
         self.log.debug('command %s %d exited %d\n' % (self.conf['command'],
                                                       childpid, exitcode))
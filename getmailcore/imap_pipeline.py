@@ -0,0 +1,268 @@
+#!/usr/bin/env python2.3
+'''Pipelined IMAP commands on an imaplib connection.
+
+imaplib sends one tagged command and reads responses until that command
+completes before anything else can be sent, so every command costs a full
+round trip.  IMAPPipeline sends commands on the same connection without
+waiting for earlier ones to complete, reads responses as they arrive, and
+hands each untagged response to the command in flight it belongs to.
+
+The connection, login, and commands which change the connection's state
+(SELECT, CLOSE, EXPUNGE, IDLE, LOGOUT) are still handled by imaplib; call
+sync() before using the imaplib connection directly, so that it never sees a
+response to a pipelined command.  Untagged responses no pipelined command
+claims are dropped, except the few imaplib acts on, which are stored in the
+connection's untagged_responses.
+'''
+
+__all__ = [
+    'IMAPPipeline',
+]
+
+import re
+import socket
+import imaplib
+
+# Commands in flight at once, by default
+PIPELINE_DEPTH = 8
+
+RE_FETCH_UID = re.compile(r'\bUID (\d+)')
+
+# Untagged responses no pipelined command claims which imaplib still acts on;
+# the rest (EXISTS, RECENT, EXPUNGE, unsolicited FETCHes, ...) are read by
+# nothing, and would pile up for the rest of the session
+IMAPLIB_UNTAGGED = ('READ-ONLY', )
+
+#######################################
+class IMAPCommand(object):
+    '''A command sent by an IMAPPipeline, and the responses to it received so
+    far.
+
+    untagged is the type of untagged response (such as FETCH) the command
+    collects; if uids is not None, only FETCH responses for those UIDs are
+    collected, and if msgnums is not None, only FETCH responses for message
+    numbers in that (first, last) range.  When the command completes, typ is
+    its completion result (OK, NO, or BAD), text its completion text, and data
+    the untagged responses, in the form imaplib returns them.  If callback is
+    given, each untagged response is instead passed to it as it arrives, as a
+    list of the parts data would have been extended with, and data stays
+    empty.
+    '''
+    def __init__(self, tag, name, args, untagged=None, uids=None,
+                 msgnums=None, callback=None, deferred=False):
+        self.tag = tag
+        self.name = name
+        self.args = args
+        self.untagged = untagged
+        self.uids = uids
+        self.msgnums = msgnums
+        self.callback = callback
+        self.deferred = deferred
+        self.typ = None
+        self.text = None
+        self.data = []
+
+    def __str__(self):
+        return '%s %s' % (self.name, ' '.join([str(arg) for arg in self.args]))
+
+    def done(self):
+        return self.typ is not None
+
+    def wants(self, typ, parts):
+        if typ != self.untagged:
+            return False
+        first = parts[0]
+        if isinstance(first, tuple):
+            first = first[0]
+        if self.msgnums is not None:
+            try:
+                msgnum = int(first.split(None, 1)[0])
+            except (IndexError, ValueError):
+                return False
+            if not self.msgnums[0] <= msgnum <= self.msgnums[1]:
+                return False
+        if self.uids is None:
+            return True
+        m = RE_FETCH_UID.search(first)
+        if not m and len(parts) > 1 and isinstance(parts[-1], str):
+            # Some servers send the UID after the literal
+            m = RE_FETCH_UID.search(parts[-1])
+        return bool(m) and m.group(1) in self.uids
+
+    def result(self):
+        '''Return (typ, data) like imaplib's command methods.'''
+        if self.typ != 'OK':
+            return (self.typ, [self.text])
+        if self.untagged is None:
+            return (self.typ, [self.text])
+        return (self.typ, self.data or [None])
+
+#######################################
+class IMAPPipeline(object):
+    '''Send commands on an imaplib connection without waiting for earlier
+    commands to complete.
+
+    submit() sends a command and returns it; wait() reads responses until it
+    completes.  At most depth commands are in flight; submitting another first
+    reads responses until one completes.  A deferred command is one nobody
+    will wait() for, such as a STORE whose result only matters if it fails;
+    failures of deferred commands are raised by the next sync().
+    '''
+    def __init__(self, conn, depth=PIPELINE_DEPTH):
+        self.conn = conn
+        self.depth = depth
+        self.inflight = []
+        self.failed = []
+
+    def __str__(self):
+        return 'IMAPPipeline(depth=%d)' % self.depth
+
+    def submit(self, name, *args, **kwargs):
+        '''Send a command.  Keyword arguments are those of IMAPCommand.
+        '''
+        while len(self.inflight) >= self.depth:
+            self._read_response()
+        tag = self.conn._new_tag()
+        # imaplib must not expect a response to this tag
+        del self.conn.tagged_commands[tag]
+        args = [self.conn._checkquote(arg) for arg in args if arg is not None]
+        command = IMAPCommand(tag, name, args, **kwargs)
+        line = '%s %s' % (tag, command)
+        try:
+            self.conn.send('%s%s' % (line, imaplib.CRLF))
+        except socket.error, o:
+            raise imaplib.IMAP4.abort('socket error: %s' % o)
+        self.inflight.append(command)
+        return command
+
+    def uid(self, name, *args, **kwargs):
+        '''Send a UID command; FETCH and STORE responses are collected by UID.
+        '''
+        name = name.upper()
+        if name in ('FETCH', 'STORE'):
+            kwargs.setdefault('untagged', 'FETCH')
+            kwargs.setdefault('uids', _uidset(args[0]))
+        elif name in ('SEARCH', 'SORT', 'THREAD'):
+            kwargs.setdefault('untagged', name)
+        return self.submit('UID %s' % name, *args, **kwargs)
+
+    def wait(self, command):
+        '''Read responses until command completes, and return (typ, data) as
+        imaplib would.
+        '''
+        while not command.done():
+            self._read_response()
+        return command.result()
+
+    def execute(self, name, *args, **kwargs):
+        return self.wait(self.submit(name, *args, **kwargs))
+
+    def sync(self):
+        '''Wait for all commands in flight to complete.  Raises
+        imaplib.IMAP4.error if any deferred command failed.
+        '''
+        while self.inflight:
+            self._read_response()
+        if self.failed:
+            failed = self.failed
+            self.failed = []
+            raise imaplib.IMAP4.error(
+                'command %s returned %s %s'
+                % (failed[0], failed[0].typ, failed[0].text)
+            )
+
+    def _read_response(self):
+        if not self.inflight:
+            # Can't happen
+            raise AssertionError('no IMAP command in flight')
+        line = self.conn._get_line()
+        if not line.startswith('*'):
+            if imaplib.Continuation.match(line):
+                # No pipelined command sends literals
+                raise imaplib.IMAP4.abort('unexpected continuation: %s'
+                                          % line)
+            m = self.conn.tagre.match(line)
+            if not m:
+                raise imaplib.IMAP4.abort('unexpected response: %s' % line)
+            self._complete(m.group('tag'), m.group('type'), m.group('data'))
+            return
+        m = imaplib.Untagged_response.match(line)
+        data2 = None
+        if not m:
+            m = imaplib.Untagged_status.match(line)
+            if m:
+                data2 = m.group('data2')
+        if not m:
+            raise imaplib.IMAP4.abort('unexpected response: %s' % line)
+        typ = m.group('type')
+        dat = m.group('data') or ''
+        if data2:
+            dat = '%s %s' % (dat, data2)
+        # Read any literals, and the rest of the response after each
+        parts = []
+        m = imaplib.Literal.match(dat)
+        while m:
+            literal = self.conn.read(int(m.group('size')))
+            parts.append((dat, literal))
+            dat = self.conn._get_line()
+            m = imaplib.Literal.match(dat)
+        parts.append(dat)
+        if typ == 'BYE':
+            raise imaplib.IMAP4.abort('server closed connection: %s' % dat)
+        claimant = None
+        for command in self.inflight:
+            if command.wants(typ, parts):
+                claimant = command
+                if command.uids is not None:
+                    # A command waiting for this UID takes it before one
+                    # collecting a range of messages
+                    break
+        if claimant is not None:
+            if claimant.callback is not None:
+                claimant.callback(parts)
+            else:
+                claimant.data.extend(parts)
+            return
+        # Not for a pipelined command; keep it only if imaplib needs it
+        if typ in IMAPLIB_UNTAGGED:
+            for part in parts:
+                self.conn._append_untagged(typ, part)
+        if typ in ('OK', 'NO', 'BAD'):
+            m = imaplib.Response_code.match(dat)
+            if m and m.group('type') in IMAPLIB_UNTAGGED:
+                self.conn._append_untagged(m.group('type'), m.group('data'))
+
+    def _complete(self, tag, typ, text):
+        for (i, command) in enumerate(self.inflight):
+            if command.tag == tag:
+                break
+        else:
+            raise imaplib.IMAP4.abort('unexpected tagged response: %s %s %s'
+                                      % (tag, typ, text))
+        del self.inflight[i]
+        command.typ = typ
+        command.text = text
+        if command.deferred and typ != 'OK':
+            self.failed.append(command)
+
+#######################################
+def _uidset(s):
+    '''Return the UIDs in a UID set of numbers and ranges, or None if the set
+    is open-ended.
+    '''
+    uids = {}
+    for part in str(s).split(','):
+        if ':' in part:
+            (first, last) = part.split(':', 1)
+            if first == '*' or last == '*':
+                return None
+            (first, last) = (int(first), int(last))
+            if first > last:
+                (first, last) = (last, first)
+            for uid in xrange(first, last + 1):
+                uids[str(uid)] = None
+        elif part == '*':
+            return None
+        else:
+            uids[part] = None
+    return uids
@@ -50,6 +50,15 @@ class _Logger(object):
         '''
         self.handlers = []
 
+    def _logs(self, msglevel):
+        '''Return True if messages of level <msglevel> are output anywhere.'''
+        if not self.handlers:
+            return True
+        for handler in self.handlers:
+            if handler['minlevel'] <= msglevel <= handler['maxlevel']:
+                return True
+        return False
+
     def log(self, msglevel, msgtxt):
         '''Log a message of level <msglevel> containing text <msgtxt>.'''
         for handler in self.handlers:
@@ -79,6 +88,9 @@ class _Logger(object):
         The message will be prefixed with filename, line number, and function
         name of the calling code.
         '''
+        if not self._logs(TRACE):
+            # Finding the caller is slow, and this is called all the time
+            return
         trace = traceback.extract_stack()[-2]
         msg = '%s [%s:%i] %s' % (trace[FUNCNAME] + '()',
             os.path.basename(trace[FILENAME]),
@@ -17,6 +17,11 @@ import email.Errors
 import email.Utils
 import email.Parser
 from email.Generator import Generator
+try:
+    from hashlib import sha1
+except ImportError:
+    # Python < 2.5
+    from sha import new as sha1
 try:
     from email.header import Header
 except ImportError, o:
@@ -47,6 +52,8 @@ message_attributes = (
 )
 
 RE_FROMLINE = re.compile(r'^(>*From )', re.MULTILINE)
+RE_HEADER_END = re.compile(r'\r?\n\r?\n')
+RE_FOLD = re.compile(r'\r?\n(?=[ \t])')
 
 
 #######################################
@@ -88,6 +95,7 @@ class Message(object):
     __slots__ = (
         '__msg',
         '__raw',
+        '__flattened',
         #'log',
         'sender',
         'received_by',
@@ -102,6 +110,8 @@ class Message(object):
         self.received_from = None
         self.received_with = None
         self.__raw = None
+        # Serialized message body, keyed by mangle_from; see flatten()
+        self.__flattened = {}
         parser = email.Parser.Parser()
 
         # Message is instantiated with fromlines for POP3, fromstring for
@@ -163,8 +173,6 @@ class Message(object):
             fromline = ''
         # Write the Return-Path: header
         rpline = format_header('Return-Path', '<%s>' % self.sender)
-        # Remove previous Return-Path: header fields.
-        del self.__msg['Return-Path']
         if delivered_to:
             dtline = format_header('Delivered-To', self.recipient or 'unknown')
         else:
@@ -180,17 +188,8 @@ class Message(object):
             receivedline = format_header('Received', content)
         else:
             receivedline = ''
-        # From_ handled above, always tell the generator not to include it
         try:
-            tmpf = cStringIO.StringIO()
-            gen = Generator(tmpf, False, 0)
-            gen.flatten(self.__msg, False)
-            strmsg = tmpf.getvalue()
-            if mangle_from:
-                # do mboxrd-style "From " line quoting
-                strmsg = RE_FROMLINE.sub(r'>\1', strmsg)
-            return (fromline + rpline + dtline + receivedline 
-                    + os.linesep.join(strmsg.splitlines() + ['']))
+            body = self.__flatten_body(mangle_from)
         except TypeError, o:
             # email module chokes on some badly-misformatted messages, even
             # late during flatten().  Hope this is fixed in Python 2.4.
@@ -200,17 +199,96 @@ class Message(object):
                 raise getmailDeliveryError('failed to parse retrieved message '
                                            'and could not recover (%s)' % o)
             self.__msg = corrupt_message(o, fromstring=self.__raw)
+            self.__flattened = {}
             return self.flatten(delivered_to, received, mangle_from,
                                 include_from)
+        return fromline + rpline + dtline + receivedline + body
+
+    def __flatten_body(self, mangle_from):
+        '''Return the message as written by the generator, with native EOL.
+
+        The result is cached until the header is changed, so a message
+        delivered to several destinations is only generated once for each
+        mangle_from setting.  The header fields written by flatten() itself
+        contain timestamps and are not cached.
+        '''
+        try:
+            return self.__flattened[mangle_from]
+        except KeyError:
+            pass
+        # Remove previous Return-Path: header fields; flatten() writes its own.
+        del self.__msg['Return-Path']
+        # From_ handled in flatten(), always tell the generator not to include
+        # it
+        tmpf = cStringIO.StringIO()
+        gen = Generator(tmpf, False, 0)
+        gen.flatten(self.__msg, False)
+        strmsg = tmpf.getvalue()
+        if mangle_from:
+            # do mboxrd-style "From " line quoting
+            strmsg = RE_FROMLINE.sub(r'>\1', strmsg)
+        body = os.linesep.join(strmsg.splitlines() + [''])
+        self.__flattened[mangle_from] = body
+        return body
+
+    def prepare_flatten(self, mangle_from=False):
+        '''Generate and cache the message for later calls to flatten().
+
+        Destinations and filters call this before forking, so that the child
+        processes they create for each message share the result instead of
+        each generating the message again.
+        '''
+        try:
+            self.__flatten_body(mangle_from)
+        except TypeError:
+            # flatten() will deal with it
+            pass
+
+    def body_digest(self):
+        '''Return a hex SHA-1 digest of the message body as retrieved, with
+        line endings normalized, or None if the message was not constructed
+        from retrieved data.
+        '''
+        if self.__raw is None:
+            return None
+        parts = RE_HEADER_END.split(self.__raw, 1)
+        if len(parts) < 2:
+            body = ''
+        else:
+            body = parts[1].replace('\r\n', '\n').rstrip('\n')
+        return sha1(body).hexdigest()
 
     def add_header(self, name, content):
         self.__msg[name] = Header(content.rstrip(), 'utf-8')
+        self.__flattened = {}
 
     def remove_header(self, name):
         del self.__msg[name]
+        self.__flattened = {}
 
     def headers(self):
         return self.__msg._headers
 
+    def header_fields(self, names):
+        '''Return a dictionary of each of the header field names in names
+        (lowercase) to a list of the values of the fields of that name, in
+        order, unfolded and with surrounding whitespace removed.
+
+        The header is gone through once, whatever the number of names, and
+        only the values returned are converted to strings.  Values are not
+        decoded.
+        '''
+        fields = {}
+        for name in names:
+            fields[name] = []
+        for (name, value) in self.__msg._headers:
+            name = name.lower()
+            if name in fields:
+                value = str(value)
+                if '\n' in value:
+                    value = RE_FOLD.sub('', value)
+                fields[name].append(value.strip())
+        return fields
+
     def get_all(self, name, failobj=None):
         return self.__msg.get_all(name, failobj)
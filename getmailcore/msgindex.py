@@ -0,0 +1,428 @@
+#!/usr/bin/env python2.3
+'''Compact per-mailbox message indexes.
+
+An IMAP msgid is "<uidvalidity>/<uid>", and every message in a mailbox shares
+the same UIDVALIDITY.  Keeping a Python string, dict entry, and size for each
+message costs a few hundred bytes per message, which adds up to hundreds of MB
+for a mailbox of millions of messages.  mailboxindex keeps the UIDs and sizes
+of the messages in a mailbox in typed arrays instead, and makes msgid strings
+only when asked for one.  oldmailmap keeps the msgids and timestamps read from
+an oldmail file as ranges of consecutive UIDs retrieved at the same time.
+'''
+
+__all__ = [
+    'mailboxindex',
+    'msgid_sortkey',
+    'oldmailmap',
+]
+
+import array
+import bisect
+
+# Typecode for arrays of 32-bit unsigned IMAP UIDs and message sizes
+if array.array('I').itemsize >= 4:
+    UINT32_TYPECODE = 'I'
+else:
+    UINT32_TYPECODE = 'L'
+UINT32_MAX = 2 ** 32 - 1
+
+# msgids made by mailboxindex, with their (uidvalidity, uid), so that looking
+# them up again doesn't parse them; emptied when it reaches this size
+PARSED_CACHE_SIZE = 4096
+_parsed = {}
+
+#######################################
+def _splitmsgid(msgid):
+    '''Return (uidvalidity, uid) for an IMAP msgid, or None for any other
+    msgid, including IMAP ones not in the form str(int(uid)).
+    '''
+    if not isinstance(msgid, str):
+        return None
+    parts = _parsed.get(msgid)
+    if parts is not None:
+        return parts
+    try:
+        (uidvalidity, uid) = msgid.split('/', 1)
+    except ValueError:
+        return None
+    if not (uid.isdigit() and uidvalidity.isdigit()):
+        return None
+    n = int(uid)
+    if n > UINT32_MAX or str(n) != uid:
+        return None
+    return (uidvalidity, n)
+
+def msgid_sortkey(msgid):
+    '''Sort key putting IMAP msgids in UID order.'''
+    parts = _splitmsgid(msgid)
+    if parts is None:
+        return (1, msgid)
+    return (0, parts)
+
+#######################################
+class mailboxindex(object):
+    '''The UIDs and sizes of the messages in a selected IMAP mailbox, in
+    mailbox order.
+
+    Indexing it returns msgids.  Messages must be appended in mailbox order,
+    in which IMAP UIDs always increase, so a msgid's position is found by
+    binary search; a server which lists them otherwise still works, through a
+    dict built the first time it's needed.
+    '''
+    def __init__(self, uidvalidity=None):
+        self.uidvalidity = str(uidvalidity)
+        self.uids = array.array(UINT32_TYPECODE)
+        self.sizes = array.array(UINT32_TYPECODE)
+        self.ordered = True
+        self._positions = None
+        # Last find(), as (msgid, position)
+        self._last = (None, -1)
+
+    def __str__(self):
+        return 'mailboxindex(%s, %d messages)' % (self.uidvalidity,
+                                                  len(self.uids))
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getitem__(self, i):
+        uid = self.uids[i]
+        msgid = '%s/%d' % (self.uidvalidity, uid)
+        # Usually looked up in this index and the oldmail file next
+        if len(_parsed) >= PARSED_CACHE_SIZE:
+            _parsed.clear()
+        _parsed[msgid] = (self.uidvalidity, uid)
+        return msgid
+
+    def __contains__(self, msgid):
+        return self.find(msgid) != -1
+
+    def append(self, uid, size):
+        if self.uids and uid <= self.uids[-1]:
+            self.ordered = False
+        self.uids.append(uid)
+        self.sizes.append(size)
+        self._last = (None, -1)
+        if self._positions is not None:
+            self._positions.setdefault(uid, len(self.uids) - 1)
+
+    def find(self, msgid):
+        '''Return the position of msgid in the mailbox, or -1.'''
+        if msgid == self._last[0]:
+            # The message being retrieved is looked up repeatedly
+            return self._last[1]
+        # Called for every message, so _splitmsgid() only when the msgid
+        # wasn't made here
+        parts = _parsed.get(msgid) or _splitmsgid(msgid)
+        uids = self.uids
+        if parts is None or parts[0] != self.uidvalidity or not uids:
+            i = -1
+        elif not self.ordered:
+            i = self._unordered_find(parts[1])
+        else:
+            uid = parts[1]
+            # Right first time unless messages have been expunged before it
+            i = uid - uids[0]
+            if not (0 <= i < len(uids) and uids[i] == uid):
+                i = bisect.bisect_left(uids, uid)
+                if not (i < len(uids) and uids[i] == uid):
+                    i = -1
+        self._last = (msgid, i)
+        return i
+
+    def _unordered_find(self, uid):
+        if self._positions is None:
+            self._positions = {}
+            for i in xrange(len(self.uids) - 1, -1, -1):
+                self._positions[self.uids[i]] = i
+        return self._positions.get(uid, -1)
+
+    def missing(self, first, last):
+        '''Return the UIDs from first to last of messages not in the mailbox.
+        '''
+        if not self.ordered:
+            return [uid for uid in xrange(first, last + 1)
+                    if self._unordered_find(uid) == -1]
+        uids = self.uids
+        lo = bisect.bisect_left(uids, first)
+        hi = bisect.bisect_right(uids, last)
+        if hi - lo == last - first + 1:
+            # All still there, the usual case
+            return []
+        missing = []
+        uid = first
+        for i in xrange(lo, hi):
+            missing.extend(xrange(uid, uids[i]))
+            uid = uids[i] + 1
+        missing.extend(xrange(uid, last + 1))
+        return missing
+
+    def uid(self, msgid):
+        '''Return the UID of msgid as a string, or None if it isn't in the
+        mailbox.
+        '''
+        i = self.find(msgid)
+        if i == -1:
+            return None
+        return str(self.uids[i])
+
+    def size(self, msgid):
+        '''Return the size of msgid, or None if it isn't in the mailbox.'''
+        i = self.find(msgid)
+        if i == -1:
+            return None
+        return int(self.sizes[i])
+
+#######################################
+class oldmailmap(object):
+    '''A mapping of msgids to the times they were retrieved.
+
+    IMAP msgids are stored, for each UIDVALIDITY, as sorted ranges of
+    consecutive UIDs with the same timestamp, in parallel arrays of first
+    UID, last UID, and timestamp.  Since getmail retrieves messages in UID
+    order and records them all with the time of the session, an oldmail file
+    of millions of messages usually becomes a few ranges.  Any other msgids
+    (POP UIDLs) are kept in a dict.
+
+    Adding msgids in increasing UID order, as read from an oldmail file
+    written by this class, is fast; other insertions and deletions may have
+    to move part of the arrays, so many msgids are better deleted at once
+    with discard().
+    '''
+    def __init__(self):
+        self._ranges = {}
+        self._other = {}
+        self._count = 0
+        # Index of the range the last get() found, by UIDVALIDITY
+        self._hint = {}
+
+    def __str__(self):
+        return 'oldmailmap(%d msgids in %d ranges, %d others)' % (
+            self._count - len(self._other),
+            sum([len(r[0]) for r in self._ranges.values()]), len(self._other)
+        )
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, uidvalidity, uid):
+        '''Return (ranges, i), where ranges are the ranges for uidvalidity and
+        i the index of the last range starting at or before uid, or -1.
+        '''
+        ranges = self._ranges.get(uidvalidity)
+        if ranges is None:
+            return (None, -1)
+        return (ranges, bisect.bisect_right(ranges[0], uid) - 1)
+
+    def get(self, msgid, default=None):
+        parts = _parsed.get(msgid) or _splitmsgid(msgid)
+        if parts is None:
+            return self._other.get(msgid, default)
+        (uidvalidity, uid) = parts
+        ranges = self._ranges.get(uidvalidity)
+        if ranges is None:
+            return default
+        (firsts, lasts, timestamps) = ranges
+        # Messages are looked up in UID order, usually in the same range as
+        # the last one; ranges don't overlap, so any range found holding uid
+        # is the right one, even if the ranges have changed since
+        i = self._hint.get(uidvalidity, 0)
+        if not (i < len(firsts) and firsts[i] <= uid <= lasts[i]):
+            i = bisect.bisect_right(firsts, uid) - 1
+            if i == -1 or lasts[i] < uid:
+                return default
+            self._hint[uidvalidity] = i
+        return timestamps[i]
+
+    def __getitem__(self, msgid):
+        timestamp = self.get(msgid)
+        if timestamp is None:
+            raise KeyError(msgid)
+        return timestamp
+
+    def __contains__(self, msgid):
+        return self.get(msgid) is not None
+
+    has_key = __contains__
+
+    def __setitem__(self, msgid, timestamp):
+        parts = _splitmsgid(msgid)
+        if parts is None:
+            if msgid not in self._other:
+                self._count += 1
+            self._other[msgid] = timestamp
+            return
+        (uidvalidity, uid) = parts
+        ranges = self._ranges.get(uidvalidity)
+        if ranges is not None and uid > ranges[1][-1]:
+            # Past the last range, as when reading an oldmail file
+            (firsts, lasts, timestamps) = ranges
+            self._count += 1
+            if lasts[-1] == uid - 1 and timestamps[-1] == timestamp:
+                lasts[-1] = uid
+            else:
+                firsts.append(uid)
+                lasts.append(uid)
+                timestamps.append(timestamp)
+            return
+        current = self.get(msgid)
+        if current == timestamp:
+            return
+        if current is not None:
+            del self[msgid]
+        (ranges, i) = self._find(uidvalidity, uid)
+        if ranges is None:
+            ranges = (array.array(UINT32_TYPECODE),
+                      array.array(UINT32_TYPECODE), array.array('l'))
+            self._ranges[uidvalidity] = ranges
+        (firsts, lasts, timestamps) = ranges
+        self._count += 1
+        extends = (i != -1 and lasts[i] == uid - 1
+                   and timestamps[i] == timestamp)
+        precedes = (i + 1 < len(firsts) and firsts[i + 1] == uid + 1
+                    and timestamps[i + 1] == timestamp)
+        if extends and precedes:
+            # Fills the gap between two ranges
+            lasts[i] = lasts[i + 1]
+            for a in ranges:
+                del a[i + 1]
+        elif extends:
+            lasts[i] = uid
+        elif precedes:
+            firsts[i + 1] = uid
+        elif i + 1 == len(firsts):
+            firsts.append(uid)
+            lasts.append(uid)
+            timestamps.append(timestamp)
+        else:
+            firsts.insert(i + 1, uid)
+            lasts.insert(i + 1, uid)
+            timestamps.insert(i + 1, timestamp)
+
+    def __delitem__(self, msgid):
+        parts = _splitmsgid(msgid)
+        if parts is None:
+            del self._other[msgid]
+            self._count -= 1
+            return
+        (uidvalidity, uid) = parts
+        (ranges, i) = self._find(uidvalidity, uid)
+        if i == -1 or ranges[1][i] < uid:
+            raise KeyError(msgid)
+        (firsts, lasts, timestamps) = ranges
+        self._count -= 1
+        if firsts[i] == lasts[i]:
+            for a in ranges:
+                del a[i]
+            if not firsts:
+                del self._ranges[uidvalidity]
+        elif firsts[i] == uid:
+            firsts[i] = uid + 1
+        elif lasts[i] == uid:
+            lasts[i] = uid - 1
+        else:
+            # Split the range
+            firsts.insert(i + 1, uid + 1)
+            lasts.insert(i + 1, lasts[i])
+            timestamps.insert(i + 1, timestamps[i])
+            lasts[i] = uid - 1
+
+    def discard(self, msgids):
+        '''Delete msgids, skipping any which aren't in the map.  The ranges
+        of each UIDVALIDITY are rebuilt once, however many are deleted.
+        '''
+        deleted = {}
+        for msgid in msgids:
+            parts = _splitmsgid(msgid)
+            if parts is None:
+                if msgid in self._other:
+                    del self._other[msgid]
+                    self._count -= 1
+            else:
+                deleted.setdefault(parts[0], []).append(parts[1])
+        for (uidvalidity, uids) in deleted.items():
+            ranges = self._ranges.get(uidvalidity)
+            if ranges is None:
+                continue
+            uids.sort()
+            (firsts, lasts, timestamps) = ranges
+            kept = (array.array(UINT32_TYPECODE),
+                    array.array(UINT32_TYPECODE), array.array('l'))
+            j = 0
+            for i in xrange(len(firsts)):
+                (first, last) = (firsts[i], lasts[i])
+                while j < len(uids) and uids[j] <= last:
+                    uid = uids[j]
+                    j += 1
+                    if uid < first:
+                        # Not in the map, or deleted already
+                        continue
+                    if uid > first:
+                        kept[0].append(first)
+                        kept[1].append(uid - 1)
+                        kept[2].append(timestamps[i])
+                    self._count -= 1
+                    first = uid + 1
+                if first <= last:
+                    kept[0].append(first)
+                    kept[1].append(last)
+                    kept[2].append(timestamps[i])
+            if kept[0]:
+                self._ranges[uidvalidity] = kept
+            else:
+                del self._ranges[uidvalidity]
+
+    def vanished(self, present, cutoff):
+        '''Return the msgids retrieved before cutoff which are not in present,
+        a mailboxindex or a mapping keyed by msgid.  Messages still in a
+        mailboxindex are skipped without making their msgids.
+        '''
+        vanished = []
+        uidvalidities = self._ranges.keys()
+        uidvalidities.sort()
+        for uidvalidity in uidvalidities:
+            (firsts, lasts, timestamps) = self._ranges[uidvalidity]
+            indexed = (isinstance(present, mailboxindex)
+                       and present.uidvalidity == uidvalidity)
+            for i in xrange(len(firsts)):
+                if timestamps[i] >= cutoff:
+                    continue
+                if indexed:
+                    vanished.extend([
+                        '%s/%d' % (uidvalidity, uid)
+                        for uid in present.missing(firsts[i], lasts[i])
+                    ])
+                    continue
+                for uid in xrange(firsts[i], lasts[i] + 1):
+                    msgid = '%s/%d' % (uidvalidity, uid)
+                    if msgid not in present:
+                        vanished.append(msgid)
+        for (msgid, timestamp) in self._other.iteritems():
+            if timestamp < cutoff and msgid not in present:
+                vanished.append(msgid)
+        return vanished
+
+    def iteritems(self):
+        '''Yield (msgid, timestamp) pairs, IMAP ones in UID order.'''
+        uidvalidities = self._ranges.keys()
+        uidvalidities.sort()
+        for uidvalidity in uidvalidities:
+            (firsts, lasts, timestamps) = self._ranges[uidvalidity]
+            for i in xrange(len(firsts)):
+                timestamp = timestamps[i]
+                for uid in xrange(firsts[i], lasts[i] + 1):
+                    yield ('%s/%d' % (uidvalidity, uid), timestamp)
+        for item in self._other.iteritems():
+            yield item
+
+    def iterkeys(self):
+        for (msgid, unused) in self.iteritems():
+            yield msgid
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
@@ -0,0 +1,294 @@
+#!/usr/bin/env python2.3
+'''Retrieval of messages ahead of their delivery, and concurrent delivery.
+
+A Prefetcher downloads messages in a background thread while the main thread
+filters and delivers the ones already retrieved, so the network and the local
+delivery work overlap.  Only retrieval happens in the background; all
+decisions about a message, and all recording of it as delivered or deleted,
+still happen in the main thread in the original order.
+
+A DeliveryPool delivers messages from several threads at once, for
+destinations which run a program for each message.  The main thread records
+each message as delivered, and deletes it, once its delivery has finished.
+'''
+
+__all__ = [
+    'DeliveryPool',
+    'Prefetcher',
+]
+
+import sys
+import threading
+import Queue
+
+import getmailcore.logging
+from getmailcore.profiling import phase
+
+# Time to wait between checks when stopping the background thread
+STOP_POLL_INTERVAL = 0.1
+
+# Messages the background thread has retrieved are dropped from its list of
+# submitted messages once there are this many
+AHEAD_TRIM = 1024
+
+# Python 2 only lets a wait on a condition be interrupted by a signal if it has
+# a timeout
+WAIT_INTERVAL = 1.0
+
+#######################################
+class Prefetcher(object):
+    '''Retrieve messages from a retriever in a background thread.
+
+    Messages are requested with submit(), in the order they will be asked for,
+    and collected with getmsg().  At most depth retrieved messages are held
+    waiting for getmsg() at any time.  getmsg() for a message which was not
+    submitted retrieves it directly.  Errors raised while retrieving a message
+    are raised again by getmsg() for that message.
+
+    The retriever's lock serializes the background thread's use of the
+    connection with the main thread's.
+    '''
+    def __init__(self, retriever, depth):
+        self.log = getmailcore.logging.Logger()
+        self.retriever = retriever
+        self.depth = depth
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue(depth)
+        self.submitted = []
+        # Every submitted message, in order, for the background thread to
+        # request ahead; only appended to by the main thread, and only
+        # trimmed by the background thread
+        self.ahead = []
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run,
+                                       name='getmail prefetch')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __str__(self):
+        return 'Prefetcher(%s, depth=%d)' % (self.retriever, self.depth)
+
+    def _request_ahead(self, current, asked):
+        '''Request the submitted messages in self.ahead from the one at index
+        current, which is about to be retrieved, for as long as the retriever
+        accepts them.  Messages before index asked have been accepted already.
+        Returns the new (current, asked).
+        '''
+        # Those before the current one have been retrieved
+        asked = max(asked, current)
+        while asked < len(self.ahead):
+            if not phase('fetch', self.retriever.request_message,
+                         self.ahead[asked]):
+                # Offered again once the retriever has room
+                break
+            asked += 1
+        if current >= AHEAD_TRIM:
+            del self.ahead[:current]
+            asked -= current
+            current = 0
+        return (current, asked)
+
+    def _run(self):
+        # Index in self.ahead of the message being retrieved, and of the
+        # first message after it the retriever hasn't accepted a request for
+        current = -1
+        asked = 0
+        while True:
+            msgid = self.requests.get()
+            if msgid is None or self.stopping:
+                break
+            current += 1
+            try:
+                # Let the retriever start on this message and the ones to be
+                # retrieved after it, if it can request them before the first
+                # arrives
+                (current, asked) = self._request_ahead(current, asked)
+                msg = phase('fetch', self.retriever.getmsg, msgid)
+                self.results.put((msgid, msg, None))
+            except:
+                # imaplib and poplib errors are not StandardErrors; anything
+                # not handed back would leave getmsg() waiting forever
+                self.results.put((msgid, None, sys.exc_info()))
+
+    def pending(self):
+        '''Return the number of submitted messages not yet collected.'''
+        return len(self.submitted)
+
+    def ready(self, msgid):
+        '''Return True if getmsg(msgid) should not have to wait on the
+        retriever: msgid was submitted, and a prefetched message is waiting.
+        '''
+        return msgid in self.submitted and not self.results.empty()
+
+    def submit(self, msgid):
+        self.submitted.append(msgid)
+        self.ahead.append(msgid)
+        self.requests.put(msgid)
+
+    def getmsg(self, msgid):
+        if msgid not in self.submitted:
+            return self.retriever.getmsg(msgid)
+        while self.submitted:
+            expected = self.submitted.pop(0)
+            (gotid, msg, exc_info) = self.results.get()
+            if gotid != expected:
+                # Can't happen
+                raise AssertionError('prefetched %s, expected %s'
+                                     % (gotid, expected))
+            if gotid != msgid:
+                # Retrieved, but no longer wanted
+                self.log.debug('prefetched message %s not used\n' % gotid)
+                continue
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return msg
+
+    def stop(self):
+        '''Stop the background thread, discarding any messages not collected.
+        '''
+        self.stopping = True
+        self.requests.put(None)
+        while self.thread.isAlive():
+            # Make room in case the thread is waiting to hand over a message
+            try:
+                while True:
+                    self.results.get_nowait()
+            except Queue.Empty:
+                pass
+            self.thread.join(STOP_POLL_INTERVAL)
+        self.submitted = []
+        self.ahead = []
+
+#######################################
+class DeliveryPool(object):
+    '''Deliver messages to a destination from up to workers threads at once.
+
+    Messages are handed over with submit(), each with a key, normally its
+    envelope recipient.  Messages with the same key are delivered one at a
+    time, in the order they were submitted; messages with different keys may
+    be delivered at the same time.  submit() waits while workers messages are
+    already waiting to be delivered, so only so many are held in memory.
+
+    finished() returns the deliveries which have finished since it was last
+    called, as a list of (tag, result, exc_info), where tag is what was given
+    to submit(), result is what the destination's deliver_message() returned,
+    and exc_info is sys.exc_info() for the exception it raised, if any.
+    wait() first waits for all submitted deliveries to finish.
+    '''
+    def __init__(self, destination, workers):
+        self.log = getmailcore.logging.Logger()
+        self.destination = destination
+        self.workers = workers
+        self.cond = threading.Condition()
+        # Messages not yet being delivered, as (key, tag, args), in order
+        self.queue = []
+        # Keys of the messages being delivered
+        self.busy = {}
+        self.done = []
+        self.stopping = False
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._run,
+                                 name='getmail delivery %d' % (i + 1))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def __str__(self):
+        return 'DeliveryPool(%s, workers=%d)' % (self.destination,
+                                                 self.workers)
+
+    def _next(self):
+        '''Take the first message from the queue for which no earlier
+        message with the same key is being delivered.  Called with the
+        condition held.
+        '''
+        for (i, item) in enumerate(self.queue):
+            if item[0] not in self.busy:
+                del self.queue[i]
+                return item
+        return None
+
+    def _run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                item = self._next()
+                while item is None and not self.stopping:
+                    self.cond.wait()
+                    item = self._next()
+                if item is None:
+                    return
+                (key, tag, args) = item
+                self.busy[key] = None
+                # Room in the queue
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+            try:
+                result = phase('deliver', self.destination.deliver_message,
+                               *args)
+                exc_info = None
+            except:
+                # Handed back whatever it is, or wait() would never return
+                result = None
+                exc_info = sys.exc_info()
+            self.cond.acquire()
+            try:
+                del self.busy[key]
+                self.done.append((tag, result, exc_info))
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+    def pending(self):
+        '''Return the number of submitted messages not yet delivered.'''
+        self.cond.acquire()
+        try:
+            return len(self.queue) + len(self.busy)
+        finally:
+            self.cond.release()
+
+    def submit(self, key, tag, msg, delivered_to=True, received=True):
+        self.cond.acquire()
+        try:
+            while len(self.queue) >= self.workers:
+                self.cond.wait(WAIT_INTERVAL)
+            self.queue.append((key, tag, (msg, delivered_to, received)))
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def finished(self):
+        self.cond.acquire()
+        try:
+            done = self.done
+            self.done = []
+        finally:
+            self.cond.release()
+        return done
+
+    def wait(self):
+        self.cond.acquire()
+        try:
+            while self.queue or self.busy:
+                self.cond.wait(WAIT_INTERVAL)
+        finally:
+            self.cond.release()
+        return self.finished()
+
+    def stop(self):
+        '''Stop the threads once the deliveries in progress have finished,
+        discarding any messages not yet being delivered.
+        '''
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.queue = []
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for t in self.threads:
+            while t.isAlive():
+                t.join(STOP_POLL_INTERVAL)
+        self.threads = []
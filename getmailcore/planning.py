@@ -0,0 +1,102 @@
+#!/usr/bin/env python2.3
+'''Planning the order in which a mailbox's messages are retrieved.
+
+By default getmail works through a mailbox in the order the server lists it,
+and stops when max_messages_per_session or max_bytes_per_session is reached,
+so one very large message near the start can use up a session's byte budget
+ahead of many small ones.  The retrieve_order option instead plans the
+session from the message sizes the retriever has already listed: the
+messages to retrieve are chosen and ordered first, so as many of them as
+possible fit within the budgets.
+'''
+
+__all__ = [
+    'RETRIEVE_ORDERS',
+    'plan_retrieval',
+]
+
+RETRIEVE_ORDERS = (
+    # As listed by the server; the mailbox is not planned at all
+    'server',
+    # Smallest messages first; the most messages within a byte budget
+    'smallest-first',
+    # Most recently arrived messages first
+    'newest-first',
+    # Earliest arrived messages first, skipping any which don't fit
+    'oldest-first',
+    # Alternately the earliest arrived and the smallest remaining message, so
+    # small messages aren't held up by large ones, and large ones still get
+    # their turn
+    'fair',
+)
+
+#######################################
+def _interleave(msgids, sizes):
+    # Stable, so equal sizes stay in server order
+    by_size = sorted(range(len(msgids)), key=sizes.__getitem__)
+    taken = [False] * len(msgids)
+    order = []
+    oldest = 0
+    smallest = 0
+    while len(order) < len(msgids):
+        while taken[oldest]:
+            oldest += 1
+        taken[oldest] = True
+        order.append(msgids[oldest])
+        while smallest < len(by_size) and taken[by_size[smallest]]:
+            smallest += 1
+        if smallest < len(by_size):
+            taken[by_size[smallest]] = True
+            order.append(msgids[by_size[smallest]])
+    return order
+
+#######################################
+def plan_retrieval(retriever, order, wanted, max_messages=None,
+                   max_bytes=None):
+    '''Plan the retrieval of the messages in the mailbox selected in
+    retriever.
+
+    wanted(msgid) says whether a message would be retrieved at all (it is
+    new, or read_all is set, and isn't too large); max_messages and max_bytes
+    are what is left of the session's budgets, or None for no limit.  Messages
+    are taken in the given order, skipping any too large for what remains of
+    the byte budget, until the budgets are used up.
+
+    Returns (planned, msgids), where planned are the messages to retrieve in
+    the order to retrieve them, and msgids all the messages in the order to
+    process them: the planned ones, then the rest in server order, so that
+    old messages are still considered for deletion.  For the "server" order,
+    returns None; the mailbox is processed as listed.
+    '''
+    if order == 'server':
+        return None
+    if order not in RETRIEVE_ORDERS:
+        # Checked when the configuration is read
+        raise ValueError('unknown retrieve_order %s' % order)
+    msgids = [msgid for msgid in retriever if wanted(msgid)]
+    sizes = [retriever.getmsgsize(msgid) for msgid in msgids]
+    if order == 'smallest-first':
+        ordered = [msgids[i] for i in sorted(range(len(msgids)),
+                                             key=sizes.__getitem__)]
+    elif order == 'newest-first':
+        ordered = msgids[:]
+        ordered.reverse()
+    elif order == 'fair':
+        ordered = _interleave(msgids, sizes)
+    else:
+        ordered = msgids
+    size_of = dict(zip(msgids, sizes))
+    planned = []
+    used = 0
+    for msgid in ordered:
+        if max_messages is not None and len(planned) >= max_messages:
+            break
+        size = size_of[msgid]
+        if max_bytes is not None and used + size > max_bytes:
+            # Doesn't fit; smaller ones later on still might
+            continue
+        planned.append(msgid)
+        used += size
+    included = dict.fromkeys(planned)
+    rest = [msgid for msgid in retriever if msgid not in included]
+    return (planned, planned + rest)
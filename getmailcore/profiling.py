@@ -0,0 +1,244 @@
+#!/usr/bin/env python2.3
+'''Low-overhead profiling of a getmail session, broken down by phase.
+
+A Profiler samples the stacks of getmail's threads from a background thread
+at a fixed interval of wall-clock time, so time spent waiting on the network
+or a delivery command shows up as well as time spent computing, and nothing
+is added to the cost of each function call as with the profile modules.
+getmail marks what each thread is doing with phase(), and samples are tagged
+with the phase of the thread they were taken from.
+
+Profiler.write() saves two files:  a pstats file, which can be read with the
+pstats module or tools which understand its output, and a file of collapsed
+stacks, one "frame;frame;... count" line per distinct stack, as read by
+flamegraph.pl and similar tools.  The pstats file is built from the samples,
+so its call counts are numbers of samples rather than of calls.
+'''
+
+__all__ = [
+    'PHASES',
+    'Profiler',
+    'phase',
+    'set_phase',
+]
+
+import sys
+import time
+import marshal
+import threading
+import thread
+
+from getmailcore.exceptions import *
+
+# Phases getmail marks; samples from a thread in none of them are tagged
+# "other"
+PHASES = (
+    'connect',
+    'list',
+    'fetch',
+    'filter',
+    'deliver',
+    'state-write',
+)
+OTHER_PHASE = 'other'
+
+# Seconds between samples
+SAMPLE_INTERVAL = 0.01
+
+# Suffix of the collapsed stacks file written alongside the pstats file
+COLLAPSED_SUFFIX = '.collapsed'
+
+# The running Profiler, if any, and the phase of each thread, by thread ID
+_profiler = None
+_phases = {}
+
+#######################################
+def set_phase(name):
+    '''Mark the calling thread as being in phase name, or in no phase if name
+    is None, and return the phase it was in.
+    '''
+    if _profiler is None:
+        return None
+    ident = thread.get_ident()
+    previous = _phases.get(ident)
+    _phases[ident] = name
+    return previous
+
+def phase(name, function, *args, **kwargs):
+    '''Call function with the calling thread in phase name, and return what
+    it returns.
+    '''
+    if _profiler is None:
+        return function(*args, **kwargs)
+    previous = set_phase(name)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        set_phase(previous)
+
+# Left out of sampled stacks, as it would be in every one
+_PHASE_CODE = phase.func_code
+
+#######################################
+def _funcname(func):
+    '''Name a function, as (filename, first line number, name), for a
+    collapsed stack.
+    '''
+    (filename, lineno, name) = func
+    if filename == '~':
+        return name
+    return '%s (%s:%d)' % (name, filename, lineno)
+
+#######################################
+class Profiler(object):
+    '''Sample the stacks of all other threads every interval seconds while
+    running.
+    '''
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        if not hasattr(sys, '_current_frames'):
+            raise getmailConfigurationError(
+                'profiling requires Python 2.5 or higher'
+            )
+        self.interval = interval
+        # Sample counts, by (thread name, phase, stack), where a stack is a
+        # tuple of functions from the outermost in
+        self.samples = {}
+        self.ticks = 0
+        self.elapsed = 0.0
+        self.main_thread = threading.currentThread().getName()
+        self.stopping = False
+        self.thread = None
+
+    def __str__(self):
+        return 'Profiler(interval=%s)' % self.interval
+
+    def start(self):
+        global _profiler
+        if _profiler is not None:
+            raise getmailOperationError('a profiler is already running')
+        _profiler = self
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run,
+                                       name='getmail profiler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        global _profiler
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.thread.join()
+        self.thread = None
+        _profiler = None
+        _phases.clear()
+
+    def _run(self):
+        me = thread.get_ident()
+        started = time.time()
+        while not self.stopping:
+            time.sleep(self.interval)
+            self._sample(me)
+            self.ticks += 1
+        self.elapsed += time.time() - started
+
+    def _sample(self, me):
+        names = {}
+        for t in threading.enumerate():
+            # Thread.ident is new in Python 2.6
+            ident = getattr(t, 'ident', None)
+            if ident is not None:
+                names[ident] = t.getName()
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                if code is not _PHASE_CODE:
+                    stack.append((code.co_filename, code.co_firstlineno,
+                                  code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            key = (names.get(ident, 'thread %s' % ident),
+                   _phases.get(ident) or OTHER_PHASE, tuple(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def seconds_per_sample(self):
+        '''Return the wall-clock time each sample stands for; a little more
+        than the interval, as the sampling thread has to wait its turn to
+        run.
+        '''
+        if not self.ticks:
+            return self.interval
+        return self.elapsed / self.ticks
+
+    def phase_times(self):
+        '''Return [(phase, seconds), ...] for the main thread, in the order
+        of PHASES, for the phases it was sampled in.
+        '''
+        counts = {}
+        for ((threadname, phasename, unused), count) in self.samples.items():
+            if threadname == self.main_thread:
+                counts[phasename] = counts.get(phasename, 0) + count
+        scale = self.seconds_per_sample()
+        return [(phasename, counts[phasename] * scale)
+                for phasename in PHASES + (OTHER_PHASE, )
+                if phasename in counts]
+
+    def _stats(self):
+        '''Return the samples as a pstats dictionary:
+        {function: (primitive calls, calls, own time, cumulative time,
+        {caller: calls})}, with each phase as a pseudo-function at the root
+        of the stacks sampled in it.
+        '''
+        scale = self.seconds_per_sample()
+        entries = {}
+        for ((unused, phasename, stack), count) in self.samples.items():
+            funcs = [('~', 0, '<phase %s>' % phasename)] + list(stack)
+            counted = {}
+            for (i, func) in enumerate(funcs):
+                entry = entries.get(func)
+                if entry is None:
+                    entry = entries[func] = [0, 0, 0.0, 0.0, {}]
+                if func not in counted:
+                    # Once per sample, however deep the recursion
+                    counted[func] = None
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += count * scale
+                if i:
+                    callers = entry[4]
+                    callers[funcs[i - 1]] = (callers.get(funcs[i - 1], 0)
+                                             + count)
+            entries[funcs[-1]][2] += count * scale
+        stats = {}
+        for (func, (cc, nc, tt, ct, callers)) in entries.items():
+            stats[func] = (cc, nc, tt, ct, callers)
+        return stats
+
+    def write(self, path):
+        '''Write the pstats file path and the collapsed stacks file path +
+        COLLAPSED_SUFFIX.  Returns the name of the latter.
+        '''
+        f = open(path, 'wb')
+        try:
+            marshal.dump(self._stats(), f)
+        finally:
+            f.close()
+        collapsed = path + COLLAPSED_SUFFIX
+        lines = []
+        for ((threadname, phasename, stack), count) in self.samples.items():
+            frames = [threadname.replace(';', ':'), 'phase %s' % phasename]
+            frames.extend([_funcname(func).replace(';', ':')
+                           for func in stack])
+            lines.append('%s %d' % (';'.join(frames), count))
+        lines.sort()
+        f = open(collapsed, 'wb')
+        try:
+            for line in lines:
+                # flamegraph.pl and friends expect Unix line endings
+                f.write(line + '\n')
+        finally:
+            f.close()
+        return collapsed
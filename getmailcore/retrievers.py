@@ -17,6 +17,8 @@ Currently implemented:
   SimpleIMAPSSLRetriever - the above, for IMAP-over-SSL.
   MultidropIMAPRetriever
   MultidropIMAPSSLRetriever
+  MaildirRetriever
+  MboxRetriever
 '''
 
 __all__ = [
@@ -31,6 +33,8 @@ __all__ = [
     'SimpleIMAPSSLRetriever',
     'MultidropIMAPRetriever',
     'MultidropIMAPSSLRetriever',
+    'MaildirRetriever',
+    'MboxRetriever',
 ]
 
 import os
@@ -144,17 +148,21 @@ class BrokenUIDLPOP3RetrieverBase(POP3RetrieverBase):
         '''Short-circuit writing the oldmail file.'''
         self.log.trace()
 
+    def _journal_delivered(self, msgid):
+        '''Message numbers mean nothing in another session; don't journal
+        them.'''
+        self.log.trace()
+
     def _getmsglist(self):
         '''Don't rely on UIDL; instead, use just the message number.'''
         self.log.trace()
         try:
-            (response, msglist, octets) = self.conn.list()
-            for line in msglist:
-                msgnum = int(line.split()[0])
-                msgsize = int(line.split()[1])
+            for line in self._longcmd('LIST'):
+                parts = line.split()
+                msgnum = int(parts[0])
                 self.msgnum_by_msgid[msgnum] = msgnum
                 self.msgid_by_msgnum[msgnum] = msgnum
-                self.msgsizes[msgnum] = msgsize
+                self.msgsizes[msgnum] = int(parts[1])
             self.sorted_msgnum_msgid = sorted(self.msgid_by_msgnum.items())
         except poplib.error_proto, o:
             raise getmailOperationError('POP error (%s)' % o)
@@ -344,10 +352,8 @@ class MultidropSDPSRetriever(SimplePOP3Retriever, POP3initMixIn):
         self.log.info('MultidropSDPSRetriever(%s)' % self._confstring()
                       + os.linesep)
 
-    def _getmsgbyid(self, msgid):
+    def _setenvelope(self, msgid, msg):
         self.log.trace()
-        msg = SimplePOP3Retriever._getmsgbyid(self, msgid)
-
         # The magic of SDPS is the "*ENV" command.  Implement it:
         try:
             msgnum = self._getmsgnumbyid(msgid)
@@ -360,7 +366,6 @@ class MultidropSDPSRetriever(SimplePOP3Retriever, POP3initMixIn):
             raise getmailOperationError('short *ENV response (%s)' % lines)
         msg.sender = lines[2]
         msg.recipient = lines[3]
-        return msg
 
 #######################################
 class SimpleIMAPRetriever(IMAPRetrieverBase, IMAPinitMixIn):
@@ -537,3 +542,52 @@ class MultidropIMAPSSLRetriever(MultidropIMAPRetrieverBase, IMAPSSLinitMixIn):
         self.log.trace()
         self.log.info('MultidropIMAPSSLRetriever(%s)' % self._confstring()
                       + os.linesep)
+
+#######################################
+class MaildirRetriever(MaildirRetrieverBase):
+    '''Retriever class for reading messages from a local maildir, such as an
+    archive of mail retrieved earlier.
+    '''
+    _confitems = (
+        ConfInstance(name='configparser', required=False),
+        ConfDirectory(name='getmaildir', required=False, default='~/.getmail/'),
+
+        ConfMaildirPath(name='path'),
+    )
+    received_from = None
+    received_with = 'Maildir'
+    received_by = localhostname()
+
+    def __str__(self):
+        self.log.trace()
+        return 'MaildirRetriever:%s' % self.conf.get('path', 'path')
+
+    def showconf(self):
+        self.log.trace()
+        self.log.info('MaildirRetriever(%s)' % self._confstring()
+                      + os.linesep)
+
+#######################################
+class MboxRetriever(MboxRetrieverBase):
+    '''Retriever class for reading messages from a local mboxrd file, such as
+    an archive of mail retrieved earlier.
+    '''
+    _confitems = (
+        ConfInstance(name='configparser', required=False),
+        ConfDirectory(name='getmaildir', required=False, default='~/.getmail/'),
+
+        ConfFile(name='path'),
+        ConfString(name='locktype', required=False, default='lockf'),
+    )
+    received_from = None
+    received_with = 'mbox'
+    received_by = localhostname()
+
+    def __str__(self):
+        self.log.trace()
+        return 'MboxRetriever:%s' % self.conf.get('path', 'path')
+
+    def showconf(self):
+        self.log.trace()
+        self.log.info('MboxRetriever(%s)' % self._confstring()
+                      + os.linesep)
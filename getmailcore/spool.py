@@ -0,0 +1,246 @@
+#!/usr/bin/env python2.3
+'''A local spool of retrieved messages awaiting delivery.
+
+With the spool_dir option, getmail writes each retrieved message, once it has
+passed the filters, to a spool directory instead of delivering it, and only
+then records it as retrieved (and deletes it from the server, if configured
+to).  The spooled messages are delivered after the sessions with the servers
+are over, so a slow or failing destination doesn't hold a session open, and
+a message which can't be delivered is retried from the spool instead of
+being retrieved again.  A failed delivery is retried on later runs, after a
+delay which doubles with each attempt.
+
+A spool directory has tmp and new subdirectories, as a maildir does, and
+messages are written to it the same way.  Each file holds the envelope of a
+message, one "name: value" line per item, then a blank line, then the
+message.  The names of the files of messages whose delivery has failed have
+the number of attempts and the time of the next one appended.
+'''
+
+__all__ = [
+    'Spool',
+    'SpooledMessage',
+]
+
+import os
+import re
+import time
+import errno
+import fcntl
+
+from getmailcore.exceptions import *
+from getmailcore.message import Message
+from getmailcore.utilities import deliver_maildir, localhostname
+import getmailcore.logging
+
+SPOOL_VERSION = '1'
+LOCK_FILENAME = 'lock'
+
+# Seconds before the first retry of a failed delivery; doubled for each later
+# attempt, up to RETRY_MAX_DELAY
+RETRY_DELAY = 60
+RETRY_MAX_DELAY = 6 * 60 * 60
+
+RE_DEFERRED = re.compile(r'^(?P<name>.+),a(?P<attempts>\d+),t(?P<due>\d+)$')
+# The time a message was spooled, and the count of messages spooled before it
+# by the same process, from the name deliver_maildir() gave its file
+RE_SPOOLED = re.compile(
+    r'^(?P<secs>\d+)\.M(?P<usecs>\d+)P\d+(Q(?P<count>\d+))?'
+)
+
+#######################################
+def _split_name(filename):
+    '''Return (name, attempts, due) for a spool file name.'''
+    match = RE_DEFERRED.match(filename)
+    if match is None:
+        return (filename, 0, 0)
+    return (match.group('name'), int(match.group('attempts')),
+            int(match.group('due')))
+
+def _spooled_order(name):
+    '''Return a key sorting spool file names in the order the messages were
+    spooled.
+    '''
+    match = RE_SPOOLED.match(name)
+    if match is None:
+        return (0, 0, 0, name)
+    return (int(match.group('secs')), int(match.group('usecs')),
+            int(match.group('count') or 0), name)
+
+#######################################
+class SpooledMessage(object):
+    '''A message read back from a spool.
+
+    Besides the message, carries what destinations use of a retriever (see
+    DeliverySkeleton.retriever_info()), as it was when the message was
+    retrieved.
+    '''
+    def __init__(self, filename, msg, envelope):
+        self.filename = filename
+        (unused, self.attempts, unused) = _split_name(filename)
+        self.msg = msg
+        self.received_from = envelope.get('received-from')
+        self.received_with = envelope.get('received-with')
+        self.received_by = envelope.get('received-by')
+        self.mailbox_selected = envelope.get('mailbox') or False
+        msg.recipient = envelope.get('recipient')
+
+    def __str__(self):
+        return 'SpooledMessage(%s)' % self.filename
+
+#######################################
+class Spool(object):
+    '''A spool directory, created if it doesn't exist.'''
+    def __init__(self, path):
+        self.log = getmailcore.logging.Logger()
+        self.path = path
+        self.hostname = localhostname()
+        self.count = 0
+        self.lockfile = None
+        for sub in ('tmp', 'new'):
+            subdir = os.path.join(path, sub)
+            if os.path.isdir(subdir):
+                continue
+            try:
+                os.makedirs(subdir, 0700)
+            except OSError, o:
+                raise getmailConfigurationError(
+                    'failed to create spool directory %s (%s)' % (subdir, o)
+                )
+
+    def __str__(self):
+        return 'Spool(%s)' % self.path
+
+    def _sync_new(self):
+        '''Sync the directory holding the spooled messages, so that files
+        added to or removed from it stay that way.
+        '''
+        fd = os.open(os.path.join(self.path, 'new'), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def add(self, msg, retriever):
+        '''Write msg, retrieved by retriever, to the spool, and return the
+        name of its file once it is safely on disk.
+        '''
+        self.log.trace()
+        envelope = ['getmail-spool: %s' % SPOOL_VERSION]
+        for (name, value) in (
+            ('recipient', msg.recipient),
+            ('received-from', retriever.received_from),
+            ('received-with', retriever.received_with),
+            ('received-by', retriever.received_by),
+            ('mailbox', retriever.mailbox_selected),
+        ):
+            if value:
+                envelope.append('%s: %s'
+                                % (name, ' '.join(str(value).splitlines())))
+        data = (os.linesep.join(envelope + ['', ''])
+                + msg.flatten(False, False))
+        filename = deliver_maildir(self.path, data, self.hostname, self.count,
+                                   check_maildir=False)
+        self.count += 1
+        try:
+            self._sync_new()
+        except OSError, o:
+            # The message isn't recorded as retrieved, so it will be
+            # retrieved and spooled again; don't leave this copy to be
+            # delivered as well
+            try:
+                os.unlink(os.path.join(self.path, 'new', filename))
+            except OSError:
+                pass
+            raise getmailDeliveryError('failed to sync spool %s (%s)'
+                                       % (self.path, o))
+        return filename
+
+    def lock(self):
+        '''Take the lock for delivering the spooled messages.  Returns False
+        if another process holds it.
+        '''
+        self.lockfile = open(os.path.join(self.path, LOCK_FILENAME), 'ab')
+        try:
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, o:
+            self.lockfile.close()
+            self.lockfile = None
+            if o.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def unlock(self):
+        if self.lockfile is None:
+            return
+        try:
+            self._sync_new()
+        finally:
+            self.lockfile.close()
+            self.lockfile = None
+
+    def due(self, now=None):
+        '''Return the file names of the messages due to be delivered, in the
+        order they were spooled.
+        '''
+        if now is None:
+            now = int(time.time())
+        due = []
+        for filename in os.listdir(os.path.join(self.path, 'new')):
+            if filename.startswith('.'):
+                continue
+            (name, unused, when) = _split_name(filename)
+            if when <= now:
+                due.append((_spooled_order(name), filename))
+        due.sort()
+        return [filename for (unused, filename) in due]
+
+    def load(self, filename):
+        '''Return a SpooledMessage for the spool file filename.'''
+        self.log.trace()
+        path = os.path.join(self.path, 'new', filename)
+        try:
+            f = open(path, 'rb')
+        except IOError, o:
+            raise getmailDeliveryError('failed to open spooled message %s '
+                                       '(%s)' % (path, o))
+        try:
+            envelope = {}
+            while True:
+                line = f.readline()
+                if not line:
+                    raise getmailDeliveryError('spooled message %s is '
+                                               'truncated' % path)
+                line = line.rstrip('\r\n')
+                if not line:
+                    break
+                (name, value) = (line.split(':', 1) + [''])[:2]
+                envelope[name.strip().lower()] = value.strip()
+            if envelope.get('getmail-spool') != SPOOL_VERSION:
+                raise getmailDeliveryError('%s is not a spooled message'
+                                           % path)
+            msg = Message(fromfile=f)
+        finally:
+            f.close()
+        return SpooledMessage(filename, msg, envelope)
+
+    def remove(self, filename):
+        '''Remove a delivered message from the spool.  Removals are synced to
+        disk when the lock is released.
+        '''
+        os.unlink(os.path.join(self.path, 'new', filename))
+
+    def defer(self, filename, now=None):
+        '''Record a failed delivery of a spooled message.  Returns the number
+        of seconds until it will be retried.
+        '''
+        if now is None:
+            now = int(time.time())
+        (name, attempts, unused) = _split_name(filename)
+        attempts += 1
+        delay = min(RETRY_DELAY * 2 ** min(attempts - 1, 30), RETRY_MAX_DELAY)
+        os.rename(os.path.join(self.path, 'new', filename),
+                  os.path.join(self.path, 'new', '%s,a%d,t%d'
+                               % (name, attempts, now + delay)))
+        return delay
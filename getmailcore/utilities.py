@@ -5,6 +5,7 @@
 __all__ = [
     'address_no_brackets',
     'change_usergroup',
+    'usergroup_ids',
     'change_uidgid',
     'decode_crappy_text',
     'format_header',
@@ -14,12 +15,14 @@ __all__ = [
     'check_ssl_fingerprints',
     'check_ssl_ciphers',
     'deliver_maildir',
+    'deliver_mbox',
     'eval_bool',
     'expand_user_vars',
     'is_maildir',
     'localhostname',
     'lock_file',
     'logfile',
+    'syslogsender',
     'mbox_from_escape',
     'safe_open',
     'unlock_file',
@@ -36,7 +39,7 @@ import socket
 import signal
 import stat
 import time
-import glob
+import errno
 import re
 import fcntl
 import pwd
@@ -44,6 +47,9 @@ import grp
 import getpass
 import commands
 import sys
+import atexit
+import threading
+import Queue
 
 # hashlib only present in python2.5, ssl in python2.6; used together
 # in SSL functionality below
@@ -68,6 +74,11 @@ except ImportError:
 from getmailcore.exceptions import *
 
 logtimeformat = '%Y-%m-%d %H:%M:%S'
+# Buffering of message log lines; see logfile
+LOGFILE_BUFFER_SIZE = 8192
+LOGFILE_FLUSH_INTERVAL = 5
+# Time allowed at exit for queued syslog messages to be sent; see syslogsender
+SYSLOG_CLOSE_TIMEOUT = 5
 _bool_values = {
     'true'  : True,
     'yes'   : True,
@@ -163,14 +174,28 @@ class updatefile(object):
 #######################################
 class logfile(object):
     '''A class for locking and appending timestamped data lines to a log file.
+
+    Lines are buffered, and written out together under a single lock when
+    the buffer exceeds LOGFILE_BUFFER_SIZE bytes, when the oldest buffered
+    line is LOGFILE_FLUSH_INTERVAL seconds old, and when flush() or close()
+    is called.  A timer thread writes them out at that age if nothing else
+    does, so they aren't held while getmail waits on a server.  close() is
+    called when the object is deleted and when the program exits.
     '''
     def __init__(self, filename):
         self.closed = False
         self.filename = filename
+        self.buffer = []
+        self.buffered = 0
+        self.oldest = None
+        self.timer = None
+        # Held while the buffer is used, which the timer thread also does
+        self.lock = threading.Lock()
         try:
             self.file = open(expand_user_vars(self.filename), 'ab')
         except IOError, (code, msg):
             raise IOError('%s, opening file "%s"' % (msg, self.filename))
+        atexit.register(self.close)
 
     def __del__(self):
         self.close()
@@ -181,20 +206,100 @@ class logfile(object):
     def close(self):
         if self.closed:
             return
-        self.file.flush()
-        self.file.close()
-        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+            self.closed = True
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.buffer:
+                return
+            data = ''.join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            self.oldest = None
+            try:
+                lock_file(self.file, 'flock')
+                # Seek to end
+                self.file.seek(0, 2)
+                self.file.write(data)
+                self.file.flush()
+            finally:
+                unlock_file(self.file, 'flock')
+        finally:
+            self.lock.release()
 
     def write(self, s):
+        now = time.time()
+        line = (time.strftime(logtimeformat, time.localtime(now))
+                + ' ' + s.rstrip() + os.linesep)
+        self.lock.acquire()
         try:
-            lock_file(self.file, 'flock')
-            # Seek to end
-            self.file.seek(0, 2)
-            self.file.write(time.strftime(logtimeformat, time.localtime())
-                            + ' ' + s.rstrip() + os.linesep)
-            self.file.flush()
+            self.buffer.append(line)
+            self.buffered += len(line)
+            if self.oldest is None:
+                self.oldest = now
+                self.timer = threading.Timer(LOGFILE_FLUSH_INTERVAL,
+                                             self.flush)
+                self.timer.setDaemon(True)
+                self.timer.start()
+            due = (self.buffered >= LOGFILE_BUFFER_SIZE
+                   or now - self.oldest >= LOGFILE_FLUSH_INTERVAL)
         finally:
-            unlock_file(self.file, 'flock')
+            self.lock.release()
+        if due:
+            self.flush()
+
+#######################################
+class syslogsender(object):
+    '''A class for sending messages to syslog from a background thread, so
+    a slow or hung syslog daemon cannot hold up the caller.
+
+    Messages still queued when close() is called are given up to
+    SYSLOG_CLOSE_TIMEOUT seconds to be sent.  close() is called when the
+    program exits.
+    '''
+    def __init__(self, ident, facility):
+        import syslog
+        self.syslog = syslog.syslog
+        syslog.openlog(ident, 0, facility)
+        self.closed = False
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run,
+                                       name='getmail syslog')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def __str__(self):
+        return 'syslogsender()'
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.syslog(*item)
+            except StandardError:
+                pass
+
+    def send(self, priority, message):
+        if not self.closed:
+            self.queue.put((priority, message))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(SYSLOG_CLOSE_TIMEOUT)
 
 #######################################
 def format_params(d, maskitems=('password', ), skipitems=()):
@@ -251,14 +356,49 @@ def is_maildir(d):
     return True
 
 #######################################
-def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0600):
+def _open_urandom():
+    '''Open /dev/urandom once for the session.  The descriptor is unbuffered,
+    so that forked delivery children sharing it never reuse bytes buffered by
+    their parent, and is not passed to programs run by getmail.
+    '''
+    try:
+        fd = os.open('/dev/urandom', os.O_RDONLY)
+    except OSError:
+        return None
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD)
+                | fcntl.FD_CLOEXEC)
+    return fd
+
+_urandom_fd = _open_urandom()
+
+#######################################
+def _maildir_random():
+    '''Return a hex string of random bytes for a maildir filename, or an empty
+    string if no entropy source is available.
+    '''
+    if _urandom_fd is None:
+        return ''
+    try:
+        data = os.read(_urandom_fd, 8)
+    except OSError:
+        return ''
+    return ''.join(['%02x' % ord(char) for char in data])
+
+#######################################
+def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0600,
+                    check_maildir=True):
     '''Reliably deliver a mail message into a Maildir.  Uses Dan Bernstein's
     documented rules for maildir delivery, and the updated naming convention
     for new files (modern delivery identifiers).  See
     http://cr.yp.to/proto/maildir.html and
     http://qmail.org/man/man5/maildir.html for details.
+
+    Uniqueness of the filename comes from its random component and from
+    creating the file exclusively; the maildir is never listed, so delivery
+    time does not depend on the number of messages already in it.  Callers
+    which have already verified the maildir can pass check_maildir=False.
     '''
-    if not is_maildir(maildirpath):
+    if check_maildir and not is_maildir(maildirpath):
         raise getmailDeliveryError('not a Maildir (%s)' % maildirpath)
 
     # Set a 24-hour alarm for this delivery
@@ -274,66 +414,72 @@ def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0600):
     dir_tmp = os.path.join(maildirpath, 'tmp')
     dir_new = os.path.join(maildirpath, 'new')
 
-    for unused in range(3):
+    def new_filename():
         t = time.time()
         info['secs'] = int(t)
         info['usecs'] = int((t - int(t)) * 1000000)
         info['unique'] = 'M%(usecs)dP%(pid)s' % info
         if info['deliverycount'] is not None:
             info['unique'] += 'Q%(deliverycount)s' % info
-        try:
-            info['unique'] += 'R%s' % ''.join(
-                ['%02x' % ord(char)
-                 for char in open('/dev/urandom', 'rb').read(8)]
-            )
-        except StandardError:
-            pass
+        info['random'] = _maildir_random()
+        if info['random']:
+            info['unique'] += 'R%(random)s' % info
+        return '%(secs)s.%(unique)s.%(hostname)s' % info
 
-        filename = '%(secs)s.%(unique)s.%(hostname)s' % info
+    # Open file to write; the file must not already exist
+    for unused in range(3):
+        filename = new_filename()
         fname_tmp = os.path.join(dir_tmp, filename)
-        fname_new = os.path.join(dir_new, filename)
-
-        # File must not already exist
-        if os.path.exists(fname_tmp):
-            # djb says sleep two seconds and try again
-            time.sleep(2)
-            continue
-
-        # Be generous and check cur/file[:...] just in case some other, dumber
-        # MDA is in use.  We wouldn't want them to clobber us and have the user
-        # blame us for their bugs.
-        curpat = os.path.join(maildirpath, 'cur', filename) + ':*'
-        collision = glob.glob(curpat)
-        if collision:
-            # There is a message in maildir/cur/ which could be clobbered by
-            # a dumb MUA, and which shouldn't be there.  Abort.
-            raise getmailDeliveryError('collision with %s' % collision)
-
-        # Found an unused filename
+        try:
+            fd = os.open(fname_tmp, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                         filemode)
+        except OSError, o:
+            if o.errno == errno.EEXIST:
+                # Without a random component, only the clock can make the
+                # next name different
+                if not info['random']:
+                    time.sleep(2)
+                continue
+            signal.alarm(0)
+            raise getmailDeliveryError('failure opening %s (%s)'
+                                       % (fname_tmp, o))
         break
     else:
         signal.alarm(0)
         raise getmailDeliveryError('failed to allocate file in maildir')
 
-    # Get user & group of maildir
-    s_maildir = os.stat(maildirpath)
-
-    # Open file to write
     try:
-        f = safe_open(fname_tmp, 'wb', filemode)
+        f = os.fdopen(fd, 'wb')
         f.write(data)
         f.flush()
         os.fsync(f.fileno())
         f.close()
 
-    except IOError, o:
+    except (IOError, OSError), o:
         signal.alarm(0)
+        try:
+            os.unlink(fname_tmp)
+        except OSError:
+            pass
         raise getmailDeliveryError('failure writing file %s (%s)'
                                    % (fname_tmp, o))
 
-    # Move message file from Maildir/tmp to Maildir/new
+    # Move message file from Maildir/tmp to Maildir/new.  link() refuses to
+    # replace an existing file, so a name clash in new/ is detected here
+    # rather than by scanning the directory beforehand.
+    fname_new = os.path.join(dir_new, filename)
     try:
-        os.link(fname_tmp, fname_new)
+        for unused in range(3):
+            try:
+                os.link(fname_tmp, fname_new)
+                break
+            except OSError, o:
+                if o.errno != errno.EEXIST:
+                    raise
+                filename = new_filename()
+                fname_new = os.path.join(dir_new, filename)
+        else:
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST))
         os.unlink(fname_tmp)
 
     except OSError:
@@ -355,6 +501,72 @@ def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0600):
 
     return filename
 
+#######################################
+def deliver_mbox(mboxpath, messages, locktype='lockf'):
+    '''Append messages to an existing mboxrd file, taking the lock and
+    syncing the file once for all of them.  Each message must already be
+    serialized with its From_ line and quoting; a blank line is written after
+    each.
+
+    Either all the messages are written, or the file is truncated back to its
+    previous length and getmailDeliveryError raised.  Returns False if the
+    file's access time could not be preserved, so that mail readers may not
+    notice the new mail, and True otherwise.
+    '''
+    if not os.path.exists(mboxpath):
+        raise getmailDeliveryError('mboxrd does not exist (%s)' % mboxpath)
+    if not os.path.isfile(mboxpath):
+        raise getmailDeliveryError('not an mboxrd file (%s)' % mboxpath)
+
+    # Open mbox file, refusing to create it if it doesn't exist
+    fd = os.open(mboxpath, os.O_RDWR)
+    status_old = os.fstat(fd)
+    f = os.fdopen(fd, 'r+b')
+    try:
+        lock_file(f, locktype)
+        try:
+            # Check if it _is_ an mbox file.  mbox files must start with
+            # "From " in their first line, or are 0-length files.
+            f.seek(0, 0)
+            first_line = f.readline()
+            if first_line and not first_line.startswith('From '):
+                raise getmailDeliveryError('not an mboxrd file (%s)'
+                                           % mboxpath)
+            # Seek to end
+            f.seek(0, 2)
+            size_old = f.tell()
+            try:
+                for data in messages:
+                    # Write out message plus blank line with native EOL
+                    f.write(data + os.linesep)
+                f.flush()
+                os.fsync(fd)
+            except IOError, o:
+                try:
+                    # Try to truncate it back to its previous length
+                    f.truncate(size_old)
+                except KeyboardInterrupt:
+                    raise
+                except StandardError:
+                    pass
+                raise getmailDeliveryError(
+                    'failure writing message to mbox file "%s" (%s)'
+                    % (mboxpath, o)
+                )
+            status_new = os.fstat(fd)
+            # Reset atime
+            try:
+                os.utime(mboxpath, (status_old.st_atime, status_new.st_mtime))
+            except OSError:
+                # Not root or owner; readers will not be able to reliably
+                # detect new mail.
+                return False
+            return True
+        finally:
+            unlock_file(f, locktype)
+    finally:
+        f.close()
+
 #######################################
 def mbox_from_escape(s):
     '''Escape spaces, tabs, and newlines in the envelope sender address.'''
@@ -395,25 +607,32 @@ def uid_of_user(user):
         raise getmailConfigurationError('no such specified user (%s)' % o)
 
 #######################################
-def change_usergroup(logger=None, user=None, _group=None):
+def usergroup_ids(user=None, _group=None):
     '''
-    Change the current effective GID and UID to those specified by user and
-    _group.
+    Return a tuple (uid, gid) of the UID of user and the GID of _group, with
+    None for either not specified.
     '''
     uid = None
     gid = None
     if _group:
-        if logger:
-            logger.debug('Getting GID for specified group %s\n' % _group)
         try:
             gid = grp.getgrnam(_group).gr_gid
         except KeyError, o:
             raise getmailConfigurationError('no such specified group (%s)' % o)
     if user:
-        if logger:
-            logger.debug('Getting UID for specified user %s\n' % user)
         uid = uid_of_user(user)
+    return (uid, gid)
 
+#######################################
+def change_usergroup(logger=None, user=None, _group=None):
+    '''
+    Change the current effective GID and UID to those specified by user and
+    _group.
+    '''
+    if logger:
+        logger.debug('Getting UID and GID for specified user %s and group '
+                     '%s\n' % (user, _group))
+    (uid, gid) = usergroup_ids(user, _group)
     change_uidgid(logger, uid, gid)
 
 #######################################